@@ -34,6 +34,8 @@ from ._const import Arch
 from ._const import Version
 from ._const import Edition
 from ._const import Lang
+from ._const import DiskAllocation
+from ._const import MemoryBackend
 from ._const import get_archs_by_version
 from ._const import get_editions_by_version
 
@@ -48,7 +50,19 @@ from ._prototype import ScriptInChroot
 
 from ._workdir import WorkDir
 
+from ._addon_store import AddonStore
+from ._addon_store import StoredAddon
+
+from ._image_delta import ImageDelta
+
 from ._vm import Vm
+from ._vm_pool import VmPool
+from ._vm_pool import VmLease
+from ._screen_monitor import ScreenMonitor
+from ._memory_reclaimer import MemoryReclaimer
+from ._memory_reclaimer import get_host_memory_savings
+
+from ._guest_agent import GuestAgent, GuestAgentBridge
 
 from ._builder import Builder
 from ._builder import BuildStep
@@ -56,3 +70,9 @@ from ._builder import BuildStep
 from ._errors import SettingsError
 from ._errors import InstallMediaError
 from ._errors import WorkDirError
+from ._errors import GuestAgentError
+from ._errors import GuestAgentFileNotFoundError
+from ._errors import AddonStoreError
+from ._errors import DiskImageError
+from ._errors import StorageLayoutError
+from ._errors import VmError
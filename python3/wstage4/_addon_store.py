@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import contextlib
+import concurrent.futures
+from ._const import Arch, Version
+from ._errors import AddonStoreError
+
+
+class AddonStore:
+    """
+    This class manipulates a local content-addressed addon store.
+
+    Layout of the store directory:
+        blobs/<sha256[:2]>/<sha256>              file content, read-only, shared by all addons
+        manifests/<version>/<arch>/<name>.json    file list of an addon
+        tmp/                                      staging area for atomic inserts
+        lock                                      shared by inserts, exclusive by garbage collection
+    """
+
+    def __init__(self, path):
+        assert path is not None
+
+        self._path = path
+        self._blobDir = os.path.join(path, "blobs")
+        self._manifestDir = os.path.join(path, "manifests")
+        self._tmpDir = os.path.join(path, "tmp")
+        self._lockFile = os.path.join(path, "lock")
+
+    @property
+    def path(self):
+        return self._path
+
+    def initialize(self):
+        for d in [self._path, self._blobDir, self._manifestDir, self._tmpDir]:
+            os.makedirs(d, exist_ok=True)
+
+    def has_addon(self, version, arch, name):
+        return os.path.exists(self._manifestPath(version, arch, name))
+
+    def get_addon(self, version, arch, name):
+        fullfn = self._manifestPath(version, arch, name)
+        if not os.path.exists(fullfn):
+            raise AddonStoreError("addon \"%s\" is not in store" % (name))
+        with open(fullfn, "r") as f:
+            data = json.load(f)
+
+        ret = StoredAddon(name)
+        for item in data["files"]:
+            blobPath = self._blobPath(item["sha256"])
+            if not os.path.exists(blobPath):
+                raise AddonStoreError("blob %s of addon \"%s\" is missing" % (item["sha256"], name))
+            ret._files.append((item["path"], blobPath, item["sha256"], item["size"]))
+        return ret
+
+    def add_blob(self, filepath):
+        """Insert a file into the store, returns its sha256, duplicated content is stored only once"""
+
+        with self._lock(fcntl.LOCK_SH):
+            return self._addBlob(filepath)
+
+    def add_addon(self, version, arch, name, file_dict):
+        """file_dict maps relative path in addon to host file path"""
+
+        with self._lock(fcntl.LOCK_SH):
+            fileList = []
+            for relPath in sorted(file_dict.keys()):
+                assert not relPath.startswith("/")
+                fileList.append({
+                    "path": relPath,
+                    "sha256": self._addBlob(file_dict[relPath]),
+                    "size": os.path.getsize(file_dict[relPath]),
+                })
+
+            fullfn = self._manifestPath(version, arch, name)
+            os.makedirs(os.path.dirname(fullfn), exist_ok=True)
+            self._atomicWrite(fullfn, json.dumps({"name": name, "files": fileList}, indent=4).encode("utf-8"))
+
+    def remove_addon(self, version, arch, name):
+        os.unlink(self._manifestPath(version, arch, name))
+
+    def verify(self, max_workers=None, remove_corrupted=False):
+        """Re-hash all blobs in parallel, returns the list of sha256 whose content does not match"""
+
+        blobList = list(self._iterBlobs())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            ret = [sha for sha, ok in zip(blobList, executor.map(self._verifyBlob, blobList)) if not ok]
+        if remove_corrupted:
+            for sha in ret:
+                os.unlink(self._blobPath(sha))
+        return ret
+
+    def gc(self):
+        """Remove blobs referenced by no manifest, returns the number of bytes freed"""
+
+        with self._lock(fcntl.LOCK_EX):
+            refSet = set()
+            for dirpath, dirnames, filenames in os.walk(self._manifestDir):
+                for fn in filenames:
+                    with open(os.path.join(dirpath, fn), "r") as f:
+                        refSet |= set([x["sha256"] for x in json.load(f)["files"]])
+
+            ret = 0
+            for sha in self._iterBlobs():
+                if sha not in refSet:
+                    fullfn = self._blobPath(sha)
+                    ret += os.path.getsize(fullfn)
+                    os.unlink(fullfn)
+
+            # no insert is running, left-overs in tmp are garbage of crashed inserts
+            for fn in os.listdir(self._tmpDir):
+                os.unlink(os.path.join(self._tmpDir, fn))
+
+            return ret
+
+    def _addBlob(self, filepath):
+        fd, tmpPath = tempfile.mkstemp(dir=self._tmpDir)
+        try:
+            h = hashlib.sha256()
+            with os.fdopen(fd, "wb") as dst:
+                with open(filepath, "rb") as src:
+                    while True:
+                        buf = src.read(1024 * 1024)
+                        if len(buf) == 0:
+                            break
+                        h.update(buf)
+                        dst.write(buf)
+                dst.flush()
+                os.fsync(dst.fileno())
+
+            sha = h.hexdigest()
+            fullfn = self._blobPath(sha)
+            if not os.path.exists(fullfn):
+                os.makedirs(os.path.dirname(fullfn), exist_ok=True)
+                os.chmod(tmpPath, 0o444)
+                os.rename(tmpPath, fullfn)
+            return sha
+        finally:
+            if os.path.exists(tmpPath):
+                os.unlink(tmpPath)
+
+    def _atomicWrite(self, fullfn, buf):
+        fd, tmpPath = tempfile.mkstemp(dir=self._tmpDir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(buf)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmpPath, fullfn)
+        finally:
+            if os.path.exists(tmpPath):
+                os.unlink(tmpPath)
+
+    def _verifyBlob(self, sha):
+        h = hashlib.sha256()
+        with open(self._blobPath(sha), "rb") as f:
+            while True:
+                buf = f.read(1024 * 1024)
+                if len(buf) == 0:
+                    break
+                h.update(buf)
+        return h.hexdigest() == sha
+
+    def _iterBlobs(self):
+        for d in sorted(os.listdir(self._blobDir)):
+            for sha in sorted(os.listdir(os.path.join(self._blobDir, d))):
+                yield sha
+
+    def _blobPath(self, sha):
+        return os.path.join(self._blobDir, sha[:2], sha)
+
+    def _manifestPath(self, version, arch, name):
+        assert isinstance(version, Version)
+        assert isinstance(arch, Arch)
+        return os.path.join(self._manifestDir, version.name.lower().replace("_", "-"), arch.name.lower().replace("_", "-"), name + ".json")
+
+    @contextlib.contextmanager
+    def _lock(self, op):
+        with open(self._lockFile, "a") as f:
+            fcntl.flock(f, op)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class StoredAddon:
+
+    def __init__(self, name):
+        self._name = name
+        self._files = []            # [(relative-path, blob-path, sha256, size)]
+
+    @property
+    def name(self):
+        return self._name
+
+    def get_files(self):
+        """Returns list of (relative-path, blob-path)"""
+        return [(x[0], x[1]) for x in self._files]
+
+    def get_digest(self):
+        """Digest of the whole addon, it changes whenever any file is changed"""
+        h = hashlib.sha256()
+        for relPath, blobPath, sha, size in self._files:
+            h.update(("%s\0%s\n" % (relPath, sha)).encode("utf-8"))
+        return h.hexdigest()
+
+    def extract_to(self, dirpath):
+        """Hardlink (or copy if not possible) all files into dirpath"""
+        for relPath, blobPath, sha, size in self._files:
+            fullfn = os.path.join(dirpath, relPath)
+            os.makedirs(os.path.dirname(fullfn), exist_ok=True)
+            try:
+                os.link(blobPath, fullfn)
+            except OSError:
+                shutil.copyfile(blobPath, fullfn)
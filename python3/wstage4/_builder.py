@@ -24,24 +24,48 @@
 import os
 import json
 import enum
+import time
+import asyncio
+import hashlib
+import robust_layer.simple_fops
 from ._util import Util, TmpMount
-from ._const import Version
+from ._const import Version, DiskAllocation
 from ._prototype import WindowsInstallIsoFile, ScriptInChroot
-from ._errors import SettingsError, InstallMediaError
+from ._errors import SettingsError, InstallMediaError, VmError
 from ._settings import Settings, TargetSettings
 from ._vm import Vm, VmUtil
+from ._disk_image import DiskImageUtil
 from ._win_addons import AddonRepo
+from ._addon_store import AddonStore
+from ._step_cache import StepCache
+from ._http_proxy import CachingHttpProxy
+from ._guest_agent import GuestAgentBridge
+from ._log import BuildLog
+from ._driver import drive, async_drive, Call, StartBackground, StopBackground
+from ._screen_monitor import ScreenMonitor
+from ._memory_reclaimer import MemoryReclaimer, get_host_memory_savings
 from ._win_unattend import AnswerFileGenerator
+from ._win_slipstream import HotfixSlipstream
 
 
 def Action(*progressStepTuple):
+    # async_action_xxx() is the asyncio counterpart of action_xxx(), they share progress, step cache and journal
     def decorator(func):
-        def wrapper(self, *kargs, **kwargs):
-            progressStepList = list(progressStepTuple)
-            assert sorted(progressStepList) == list(progressStepList)
-            assert self._progress in progressStepList
-            func(self, *kargs, **kwargs)
-            self._progress = BuildStep(progressStepList[-1] + 1)
+        actionName = func.__name__[len("async_"):] if func.__name__.startswith("async_") else func.__name__
+
+        if asyncio.iscoroutinefunction(func):
+            async def wrapper(self, *kargs, **kwargs):
+                with _ActionRunner(self, progressStepTuple, actionName, kargs, kwargs) as runner:
+                    # step cache restore and save copies the whole disk image, not to block the event loop
+                    if await asyncio.to_thread(runner.prepare):
+                        await func(self, *kargs, **kwargs)
+                    await asyncio.to_thread(runner.finish)
+        else:
+            def wrapper(self, *kargs, **kwargs):
+                with _ActionRunner(self, progressStepTuple, actionName, kargs, kwargs) as runner:
+                    if runner.prepare():
+                        func(self, *kargs, **kwargs)
+                    runner.finish()
         return wrapper
     return decorator
 
@@ -70,51 +94,160 @@ class Builder:
         self._s = settings
         if self._s.log_dir is not None:
             os.makedirs(self._s.log_dir, mode=0o750, exist_ok=True)
+            self._log = BuildLog(os.path.join(self._s.log_dir, "%s-%d" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid())))
+        else:
+            self._log = None
 
         self._ts = target_settings
 
-        self._addonRepo = AddonRepo(self._ts.arch, self._ts.version, self._ts.edition, self._ts.lang)
+        addonStore = AddonStore(self._s.addon_store_dir) if self._s.addon_store_dir is not None else None
+        self._addonRepo = AddonRepo(self._ts.arch, self._ts.version, self._ts.edition, self._ts.lang, addonStore)
         for i in self._ts.addons:
             if i not in self._addonRepo.getAddonNames():
                 raise SettingsError("invalid addon %s" % (i))
+            if not self._addonRepo.hasAddon(i):
+                raise SettingsError("addon %s is not in addon store" % (i))
 
         self._workDirObj = work_dir
 
+        # caching http proxy for guests, it is started only when a vm is running
+        if self._s.http_cache_dir is not None:
+            self._httpProxy = CachingHttpProxy(self._s.http_cache_dir, self._s.http_cache_size)
+        else:
+            self._httpProxy = None
+
+        # pagefile and temporary files of guest are put on a scratch disk outside of work directory, it is dropped by action_cleanup()
+        h = hashlib.sha1(os.path.realpath(self._workDirObj.path).encode("utf-8")).hexdigest()
+        if self._s.scratch_dir is not None:
+            self._scratchDisk = os.path.join(self._s.scratch_dir, "wstage4-scratch-%s.img" % (h[:16]))
+        else:
+            self._scratchDisk = None
+
+        # disk image is kept on tmpfs while building if it fits in memory, it is flushed to work directory when each step finishes
+        self._ramImage = None
+        if self._s.ram_build_dir is not None:
+            ramImage = os.path.join(self._s.ram_build_dir, "wstage4-ram-%s.img" % (h[:16]))
+            ok, reason = self._checkRamBudget(ramImage)
+            if ok:
+                self._ramImage = ramImage
+            if not self._getQuiet():
+                print("RAM build: %s (%s)" % ("enabled" if ok else "disabled", reason))
+            self._logLine("ram build: %s (%s)" % ("enabled" if ok else "disabled", reason))
+
+        # output of each step is cached under the hash of its inputs, steps whose inputs are unchanged are restored instead of re-run
+        self._stepCache = StepCache(os.path.join(self._s.cache_dir, "steps"), self._s.cache_size) if self._s.cache_dir is not None else None
+        self._stepKey = None
+
         self._progress = BuildStep.INIT
 
+        # reattach to the progress of a previous builder which used the same work directory
+        journal = self._workDirObj.load_journal()
+        if journal is not None and self._verifyJournal(journal):
+            self._progress = BuildStep[journal["progress"]]
+            self._stepKey = journal["step-cache-key"]
+
     def get_progress(self):
         return self._progress
 
+    def get_http_cache_stats(self):
+        """Returns statistics of the caching http proxy, or None if it is not enabled"""
+        return self._httpProxy.get_stats() if self._httpProxy is not None else None
+
     @Action(BuildStep.INIT)
     def action_prepare_custom_install_media(self, install_iso_file):
-        assert isinstance(install_iso_file, WindowsInstallIsoFile)
+        self._prepareCustomInstallMedia(install_iso_file)
+
+    @Action(BuildStep.INIT)
+    async def async_action_prepare_custom_install_media(self, install_iso_file):
+        await asyncio.to_thread(self._prepareCustomInstallMedia, install_iso_file)
+
+    @Action(BuildStep.CUSTOM_INSTALL_MEDIA_PREPARED)
+    def action_install_windows(self):
+        drive(self._installWindows())
+
+    @Action(BuildStep.CUSTOM_INSTALL_MEDIA_PREPARED)
+    async def async_action_install_windows(self):
+        await async_drive(self._installWindows())
+
+    @Action(BuildStep.MSWIN_INSTALLED)
+    def action_install_core_applications(self):
+        pass
+
+    @Action(BuildStep.MSWIN_INSTALLED)
+    async def async_action_install_core_applications(self):
+        pass
+
+    @Action(BuildStep.MSWIN_INSTALLED, BuildStep.CORE_APPS_INSTALLED)
+    def action_install_extra_applications(self):
+        pass
+
+    @Action(BuildStep.MSWIN_INSTALLED, BuildStep.CORE_APPS_INSTALLED)
+    async def async_action_install_extra_applications(self):
+        pass
+
+    @Action(BuildStep.MSWIN_INSTALLED, BuildStep.CORE_APPS_INSTALLED, BuildStep.EXTRA_APPS_INSTALLED)
+    def action_customize_system(self, custom_script_list=[]):
+        drive(self._customizeSystem(custom_script_list))
+
+    @Action(BuildStep.MSWIN_INSTALLED, BuildStep.CORE_APPS_INSTALLED, BuildStep.EXTRA_APPS_INSTALLED)
+    async def async_action_customize_system(self, custom_script_list=[]):
+        await async_drive(self._customizeSystem(custom_script_list))
+
+    @Action(BuildStep.MSWIN_INSTALLED, BuildStep.CORE_APPS_INSTALLED, BuildStep.EXTRA_APPS_INSTALLED, BuildStep.SYSTEM_CUSTOMIZED)
+    def action_cleanup(self):
+        drive(self._cleanup())
+
+    @Action(BuildStep.MSWIN_INSTALLED, BuildStep.CORE_APPS_INSTALLED, BuildStep.EXTRA_APPS_INSTALLED, BuildStep.SYSTEM_CUSTOMIZED)
+    async def async_action_cleanup(self):
+        await async_drive(self._cleanup())
+
+    def resize_main_disk(self, size):
+        """Change the virtual size of the main disk in bytes, the last partition and its NTFS filesystem are resized to fill it"""
+
+        assert self._progress >= BuildStep.MSWIN_INSTALLED
+        self._loadRamImage()
+        DiskImageUtil.resizeImage(self._getImagePath(), size)
+        self._flushRamImage()
+        self._saveJournal()
+
+    def _prepareCustomInstallMedia(self, installIsoFile):
+        assert isinstance(installIsoFile, WindowsInstallIsoFile)
 
         # check install iso file
-        if self._ts.arch != install_iso_file.get_arch():
+        if self._ts.arch != installIsoFile.get_arch():
             raise InstallMediaError("invalid install ISO file, arch not match")
-        if self._ts.version != install_iso_file.get_version():
+        if self._ts.version != installIsoFile.get_version():
             raise InstallMediaError("invalid install ISO file, version not match")
-        if self._ts.edition not in install_iso_file.get_editions():
+        if self._ts.edition not in installIsoFile.get_editions():
             raise InstallMediaError("invalid install ISO file, edition not match")
-        if self._ts.lang not in install_iso_file.get_languages():
+        if self._ts.lang not in installIsoFile.get_languages():
             raise InstallMediaError("invalid install ISO file, language not match")
 
+        # integrate hotfixes into install media
+        isoFile = installIsoFile.get_path()
+        hotfixPackageList = []
+        if "hotfixes" in self._ts.addons and self._ts.version in [Version.WINDOWS_XP, Version.WINDOWS_7]:
+            if self._s.cache_dir is None:
+                raise SettingsError("cache_dir is needed by addon hotfixes")
+            obj = HotfixSlipstream(self._ts.arch, self._ts.version, self._s.cache_dir)
+            isoFile, hotfixPackageList = obj.get_iso(isoFile, self._addonRepo.getAddon("hotfixes"))
+
         # do work
         if self._ts.version in [Version.WINDOWS_98, Version.WINDOWS_XP, Version.WINDOWS_7]:
             floppyFile = os.path.join(self._workDirObj.path, "floppy.img")
             Util.createFormattedFloppy(floppyFile)
             with TmpMount(floppyFile) as mp:
-                AnswerFileGenerator(self._ts).generateFile(mp.mountpoint)
+                httpProxy = "%s:%d" % (CachingHttpProxy.GUEST_ADDRESS, CachingHttpProxy.GUEST_PORT) if self._httpProxy is not None else None
+                AnswerFileGenerator(self._ts, hotfix_packages=hotfixPackageList, http_proxy=httpProxy).generateFile(mp.mountpoint)
 
             self._workDirObj.save_record("custom-install-media", json.dumps({
-                "install-iso-filepath": install_iso_file.get_path(),
+                "install-iso-filepath": isoFile,
                 "floppy-filename": os.path.basename(floppyFile),
             }))
         else:
             assert False
 
-    @Action(BuildStep.CUSTOM_INSTALL_MEDIA_PREPARED)
-    def action_install_windows(self):
+    def _installWindows(self):
         installIsoFile = None
         floppyFile = None
         if self._ts.version in [Version.WINDOWS_98, Version.WINDOWS_XP, Version.WINDOWS_7]:
@@ -124,31 +257,405 @@ class Builder:
         else:
             assert False
 
-        vm = VmUtil.getBootstrapVm(self._ts.arch, self._ts.version, self._ts.edition, self._ts.lang, self._workDirObj.image_filepath, installIsoFile, floppyFile)
-        vm.start(show=True)
-        self._workDirObj.save_qemu_cmd_record(vm.get_qemu_command())
-        vm.wait_until_stop()
+        with _HttpProxyRunner(self._httpProxy):
+            vm = yield Call(VmUtil.getBootstrapVm, self._ts.arch, self._ts.version, self._ts.edition, self._ts.lang, self._ts.addons,
+                            self._getImagePath(), installIsoFile, floppyFile, self._getDiskAllocation(), self._s.memory_backend,
+                            self._httpProxy, self._log, self._s.memory_merge, self._s.memory_balloon)
+            yield from vm._coStart(True, None)
+            self._workDirObj.save_qemu_cmd_record(vm.get_qemu_command())
+            self._saveVmRecord(vm)
+            monitor = self._getScreenMonitor(vm)
+            monitorHandle = (yield StartBackground(monitor)) if monitor is not None else None
+            try:
+                yield from vm._coWaitUntilStop()
+            finally:
+                if monitorHandle is not None:
+                    yield StopBackground(monitorHandle)
+            self._checkScreenMonitor(monitor)
 
-    @Action(BuildStep.MSWIN_INSTALLED)
-    def action_install_core_applications(self):
-        pass
+    def _customizeSystem(self, customScriptList):
+        assert all([isinstance(s, ScriptInChroot) for s in customScriptList])
 
-    @Action(BuildStep.MSWIN_INSTALLED, BuildStep.CORE_APPS_INSTALLED)
-    def action_install_extra_applications(self):
-        pass
+        if len(customScriptList) > 0:
+            digestList = yield Call(lambda: [s.get_digest() for s in customScriptList])
+            with _HttpProxyRunner(self._httpProxy):
+                m = yield from self._coStartVm()
+                reclaimer = MemoryReclaimer(m) if m.has_memory_balloon() else None
+                reclaimerHandle = None
+                try:
+                    self._saveVmRecord(m)
+                    if reclaimer is not None:
+                        reclaimerHandle = yield StartBackground(reclaimer)
+                    # guest agent is blocking, it runs in worker thread in an event loop, the thread ends with an error when the vm is stopped on cancellation
+                    i = self._getFirstUnappliedScript(digestList, (yield Call(m.load_applied_script_digests)))
+                    for j in range(i, len(customScriptList)):
+                        yield Call(m.script_exec, customScriptList[j], quiet=self._getQuiet())
+                        yield Call(m.save_applied_script_digests, digestList[:j + 1])
+                except BaseException:
+                    if reclaimerHandle is not None:
+                        yield StopBackground(reclaimerHandle)
+                    yield from m._coStop()
+                    raise
+                if reclaimerHandle is not None:
+                    yield StopBackground(reclaimerHandle)
+                    self._logReclaimer(reclaimer)
+                yield from self._coStopVm(m)
 
-    @Action(BuildStep.MSWIN_INSTALLED, BuildStep.CORE_APPS_INSTALLED, BuildStep.EXTRA_APPS_INSTALLED)
-    def action_customize_system(self, custom_script_list=[]):
-        assert all([isinstance(s, ScriptInChroot) for s in custom_script_list])
+    def _cleanup(self):
+        # the guest saved by previous step must be shut down properly, guest settings changed for scratch disk must be restored
+        if os.path.exists(self._getVmStateFile()) or self._workDirObj.load_record("scratch-disk-id") is not None:
+            m = yield from self._coStartVm(enableScratch=False)
+            try:
+                yield Call(m.disable_scratch)
+            except BaseException:
+                yield from m._coStop()
+                raise
+            yield from m._coStop()
+        yield Call(self._dropScratchDisk)
+        yield Call(DiskImageUtil.compactImage, self._getImagePath())
 
-        if len(custom_script_list) > 0:
-            with Vm() as m:
-                for s in custom_script_list:
-                    m.script_exec(s, quiet=self._getQuiet())
+    def _coStartVm(self, enableScratch=True):
+        # restore the guest saved by previous step instead of a cold boot if possible
+        yield Call(self._prepareScratchDisk)
+        m = Vm(self._getImagePath(), memory_backend=self._s.memory_backend, http_proxy=self._httpProxy, build_log=self._log,
+               scratch_disk_filepath=self._scratchDisk, memory_merge=self._s.memory_merge, memory_balloon=self._s.memory_balloon)
+        stateFile = self._getVmStateFile()
+        if os.path.exists(stateFile):
+            try:
+                yield from m._coRestoreState(stateFile, False)
+            except VmError as e:
+                if not self._getQuiet():
+                    print("Failed to restore saved VM state, boot instead: %s" % (e))
+                yield from m._coStart(False, None)
+            finally:
+                # state is stale once the disk is changed
+                robust_layer.simple_fops.rm(stateFile)
+                robust_layer.simple_fops.rm(stateFile + ".json")
+        else:
+            yield from m._coStart(False, None)
 
-    @Action(BuildStep.MSWIN_INSTALLED, BuildStep.CORE_APPS_INSTALLED, BuildStep.EXTRA_APPS_INSTALLED, BuildStep.SYSTEM_CUSTOMIZED)
-    def action_cleanup(self):
-        pass
+        if self._scratchDisk is not None and enableScratch:
+            try:
+                yield Call(m.enable_scratch)
+            except BaseException:
+                yield from m._coStop()
+                raise
+        return m
+
+    def _prepareScratchDisk(self):
+        # saved guest state is only valid with the scratch disk it was saved with, the scratch disk gets a new generation
+        # id every time a VM starts, the id is also saved in work directory so that a step restored from cache is detected
+        if self._scratchDisk is None:
+            return
+        if VmUtil.getScratchDiskId(self._scratchDisk) != self._workDirObj.load_record("scratch-disk-id"):
+            robust_layer.simple_fops.rm(self._getVmStateFile())
+            robust_layer.simple_fops.rm(self._getVmStateFile() + ".json")
+            robust_layer.simple_fops.rm(self._scratchDisk)
+            os.makedirs(self._s.scratch_dir, exist_ok=True)
+            VmUtil.createScratchDisk(self._scratchDisk, self._s.scratch_disk_size)
+        self._workDirObj.save_record("scratch-disk-id", VmUtil.renewScratchDiskId(self._scratchDisk))
+
+    def _dropScratchDisk(self):
+        if self._scratchDisk is not None:
+            robust_layer.simple_fops.rm(self._scratchDisk)
+        self._workDirObj.delete_record("scratch-disk-id")
+
+    def _getImagePath(self):
+        return self._ramImage if self._ramImage is not None else self._workDirObj.image_filepath
+
+    def _getDiskAllocation(self):
+        # preallocation makes no sense on tmpfs, it only takes memory earlier
+        if self._ramImage is not None and self._s.disk_allocation == DiskAllocation.PREALLOCATED:
+            return DiskAllocation.SPARSE
+        return self._s.disk_allocation
+
+    def _checkRamBudget(self, ramImage):
+        # returns (ok, reason), the worst case that every block of the main disk gets written is assumed
+        need = VmUtil.getMainDiskSize(self._ts.arch, self._ts.version, self._ts.edition, self._ts.lang, self._ts.addons) * 1000 * 1000 * 1000
+        if os.path.exists(self._workDirObj.image_filepath):
+            need = max(need, os.path.getsize(self._workDirObj.image_filepath))
+        if os.path.exists(ramImage):
+            need -= os.stat(ramImage).st_blocks * 512
+        if self._scratchDisk is not None and os.path.isdir(self._s.scratch_dir) and os.path.isdir(self._s.ram_build_dir):
+            if os.stat(self._s.scratch_dir).st_dev == os.stat(self._s.ram_build_dir).st_dev:
+                need += self._s.scratch_disk_size
+
+        try:
+            st = os.statvfs(self._s.ram_build_dir)
+        except OSError as e:
+            return (False, "%s is not accessible, %s" % (self._s.ram_build_dir, e.strerror))
+        if st.f_bavail * st.f_frsize < need:
+            return (False, "%s has %d MiB free, %d MiB needed" % (self._s.ram_build_dir, st.f_bavail * st.f_frsize // 1024 // 1024, need // 1024 // 1024))
+
+        memAvail = Util.getMemAvailable()
+        if memAvail is None:
+            return (False, "failed to get available memory")
+        need += VmUtil.getMemorySize(self._ts.arch) * 1024 * 1024 + self._s.ram_build_reserve
+        if memAvail < need:
+            return (False, "%d MiB memory available, %d MiB needed" % (memAvail // 1024 // 1024, need // 1024 // 1024))
+
+        return (True, "%d MiB memory available, %d MiB needed" % (memAvail // 1024 // 1024, need // 1024 // 1024))
+
+    def _loadRamImage(self):
+        # the copy on tmpfs is reused if it is the one last flushed, it is stale if the work directory was restored from step cache,
+        # or there's no disk image in work directory at all
+        if self._ramImage is None:
+            return
+        workImage = self._workDirObj.image_filepath
+        if not os.path.exists(workImage):
+            robust_layer.simple_fops.rm(self._ramImage)
+            return
+        if os.path.exists(self._ramImage):
+            s1 = os.stat(self._ramImage)
+            s2 = os.stat(workImage)
+            if s1.st_size == s2.st_size and s1.st_mtime_ns == s2.st_mtime_ns:
+                return
+        os.makedirs(self._s.ram_build_dir, exist_ok=True)
+        Util.cloneFileAtomic(workImage, self._ramImage)
+
+    def _flushRamImage(self):
+        # only the data extents are copied, flushing is skipped if the disk image is not changed since loaded or last flushed
+        if self._ramImage is None or not os.path.exists(self._ramImage):
+            return
+        workImage = self._workDirObj.image_filepath
+        if os.path.exists(workImage):
+            s1 = os.stat(self._ramImage)
+            s2 = os.stat(workImage)
+            if s1.st_size == s2.st_size and s1.st_mtime_ns == s2.st_mtime_ns:
+                return
+        Util.cloneFileAtomic(self._ramImage, workImage)
+
+    def _dropRamImage(self):
+        if self._ramImage is not None:
+            robust_layer.simple_fops.rm(self._ramImage)
+
+    def _coStopVm(self, vm):
+        # the guest is saved instead of shut down, the next step restores it
+        yield from vm._coSaveState(self._getVmStateFile())
+
+    def _getFirstUnappliedScript(self, digestList, appliedList):
+        # scripts with unchanged digest are skipped, until the first changed one
+        i = 0
+        while i < min(len(digestList), len(appliedList)) and digestList[i] == appliedList[i]:
+            i += 1
+        return i
+
+    def _getScreenMonitor(self, vm):
+        # returns None if screen monitoring is disabled, frames are saved only when there's build log
+        if self._s.screen_check_interval is None:
+            return None
+        return ScreenMonitor(vm,
+                             interval=self._s.screen_check_interval,
+                             stuck_timeout=self._s.screen_stuck_timeout,
+                             reference_dir=self._s.screen_reference_dir,
+                             frame_dir=os.path.join(self._log.path, "screens") if self._log is not None else None)
+
+    def _checkScreenMonitor(self, monitor):
+        if monitor is not None and monitor.get_failure() is not None:
+            self._logLine("screen monitor: %s" % (monitor.get_failure()))
+            raise VmError("windows installation failed, %s" % (monitor.get_failure()))
+
+    def _logReclaimer(self, reclaimer):
+        savings = get_host_memory_savings()
+        self._logLine("memory reclaimed: %d MiB at peak, host merged: %d MiB" % (reclaimer.get_peak_reclaimed() // 1024 // 1024, savings["merged"] // 1024 // 1024))
+
+    def _getVmStateFile(self):
+        return os.path.join(self._workDirObj.path, "vm.state")
+
+    def _saveVmRecord(self, vm):
+        accel, accelReason = vm.get_accelerator()
+        backend, backendReason = vm.get_memory_backend()
+        rtcBase, rtcReason = vm.get_rtc_base()
+        merge, mergeReason = vm.get_memory_merge()
+        if not self._getQuiet():
+            print("Accelerator: %s (%s)" % (accel, accelReason))
+            print("Memory backend: %s (%s)" % (backend.name.lower(), backendReason))
+            print("Memory merge: %s (%s)" % ("on" if merge else "off", mergeReason))
+        self._logLine("accelerator: %s (%s)" % (accel, accelReason))
+        self._logLine("memory backend: %s (%s)" % (backend.name.lower(), backendReason))
+        self._logLine("rtc base: %s (%s)" % (rtcBase, rtcReason))
+        self._logLine("memory merge: %s (%s)" % ("on" if merge else "off", mergeReason))
+        self._logLine("memory balloon: %s" % ("on" if vm.has_memory_balloon() else "off"))
+        self._workDirObj.save_record("vm-config", json.dumps({
+            "accelerator": accel,
+            "accelerator-reason": accelReason,
+            "memory-backend": backend.name,
+            "memory-backend-reason": backendReason,
+            "rtc-base": rtcBase,
+            "rtc-reason": rtcReason,
+            "memory-merge": merge,
+            "memory-merge-reason": mergeReason,
+            "memory-balloon": vm.has_memory_balloon(),
+        }))
+
+    def _saveJournal(self):
+        self._workDirObj.save_journal({
+            "progress": self._progress.name,
+            "step-cache-key": self._stepKey,
+            "artifacts": self._getArtifactFingerprints(),
+        })
+
+    def _verifyJournal(self, journal):
+        # artifacts are changed if the previous builder died in the middle of a step, the journal can't be trusted then
+        try:
+            if journal["progress"] not in BuildStep.__members__:
+                return False
+            return journal["artifacts"] == self._getArtifactFingerprints()
+        except (KeyError, TypeError):
+            return False
+
+    def _getArtifactFingerprints(self):
+        ret = {
+            "work-dir": self._workDirObj.get_file_fingerprints(),
+        }
+        savedRecord = self._workDirObj.load_record("custom-install-media")
+        if savedRecord is not None:
+            isoFile = json.loads(savedRecord)["install-iso-filepath"]
+            if os.path.exists(isoFile):
+                s = os.stat(isoFile)
+                ret["install-iso-file"] = [isoFile, s.st_size, s.st_mtime_ns]
+            else:
+                ret["install-iso-file"] = [isoFile]
+        return ret
+
+    def _getStepInputs(self, actionName, *kargs, **kwargs):
+        # previous step is chained in by the caller, only the inputs introduced by this step are listed here
+        if actionName == "action_prepare_custom_install_media":
+            installIsoFile = kargs[0] if len(kargs) > 0 else kwargs["install_iso_file"]
+            hashCacheDir = os.path.join(self._s.cache_dir, "hashes")
+            os.makedirs(hashCacheDir, exist_ok=True)
+            return {
+                "arch": self._ts.arch.name,
+                "version": self._ts.version.name,
+                "edition": self._ts.edition.name,
+                "lang": self._ts.lang.name,
+                "product_key": self._ts.product_key,
+                "addons": {x: self._addonRepo.getAddon(x).get_digest() for x in sorted(self._ts.addons)},
+                "install_iso_file": Util.getFileHash(hashCacheDir, installIsoFile.get_path()),
+                "http_proxy": self._httpProxy is not None,
+                "answer_file_generator": AnswerFileGenerator.VERSION,
+                "slipstream": HotfixSlipstream.VERSION,
+                "guest_agent": hashlib.sha256(GuestAgentBridge.get_guest_script()).hexdigest(),
+            }
+        elif actionName in ["action_install_windows", "action_install_core_applications", "action_install_extra_applications", "action_cleanup"]:
+            return self._getVmStepInputs()
+        elif actionName == "action_customize_system":
+            scriptList = kargs[0] if len(kargs) > 0 else kwargs.get("custom_script_list", [])
+            ret = self._getVmStepInputs()
+            ret["custom_script_list"] = [x.get_digest() for x in scriptList]
+            return ret
+        else:
+            assert False
+
+    def _getStepKeyList(self, actionName, inputs):
+        # returns keys of the leading parts of the step followed by the key of the whole step,
+        # every custom script is chained like a step of its own, so the output of the leading scripts can be continued from
+        if actionName == "action_customize_system" and len(inputs["custom_script_list"]) > 0:
+            ret = []
+            key = self._stepKey
+            for digest in inputs["custom_script_list"]:
+                scriptInputs = {k: v for k, v in inputs.items() if k != "custom_script_list"}
+                scriptInputs["custom_script"] = digest
+                key = StepCache.get_key(key, actionName, scriptInputs)
+                ret.append(key)
+            return ret
+        return [StepCache.get_key(self._stepKey, actionName, inputs)]
+
+    def _getVmStepInputs(self):
+        # settings which change the image file, or the hardware seen by guest which is recorded in its registry
+        return {
+            "disk_allocation": self._s.disk_allocation.name,
+            "memory_backend": self._s.memory_backend.name if self._s.memory_backend is not None else None,
+            "memory_balloon": self._s.memory_balloon,
+            "scratch_disk_size": self._s.scratch_disk_size if self._scratchDisk is not None else None,
+        }
+
+    def _logLine(self, line):
+        if self._log is not None:
+            self._log.get_channel("builder").write_line(line)
 
     def _getQuiet(self):
         return (self._s.verbose_level == 0)
+
+
+class _HttpProxyRunner:
+
+    def __init__(self, httpProxy):
+        self._httpProxy = httpProxy
+
+    def __enter__(self):
+        if self._httpProxy is not None:
+            self._httpProxy.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self._httpProxy is not None:
+            self._httpProxy.stop()
+
+
+class _ActionRunner:
+
+    def __init__(self, builder, progressStepTuple, actionName, kargs, kwargs):
+        self._builder = builder
+        self._progressStepList = list(progressStepTuple)
+        self._actionName = actionName
+        self._kargs = kargs
+        self._kwargs = kwargs
+        self._key = None
+        self._inputs = None
+        self._bRun = False
+        self._oldLog = None
+
+    def __enter__(self):
+        assert sorted(self._progressStepList) == list(self._progressStepList)
+        assert self._builder._progress in self._progressStepList
+        self._oldLog = BuildLog.get_current()
+        BuildLog.set_current(self._builder._log)
+        self._builder._logLine("%s started" % (self._actionName))
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if value is not None:
+            self._builder._logLine("%s failed: %r" % (self._actionName, value))
+        BuildLog.set_current(self._oldLog)
+
+    def prepare(self):
+        # returns False if the action needs not to be run
+        b = self._builder
+        if b._stepCache is not None:
+            inputs = b._getStepInputs(self._actionName, *self._kargs, **self._kwargs)
+            keyList = b._getStepKeyList(self._actionName, inputs)
+            self._key = keyList[-1]
+            if b._stepCache.has(self._key):
+                if b._workDirObj.load_record("step-cache-key") != self._key:
+                    b._stepCache.restore(self._key, b._workDirObj)
+                b._logLine("%s restored from step cache" % (self._actionName))
+                return False
+            # the action skips the custom scripts which are recorded as applied in the restored guest
+            for key in reversed(keyList[:-1]):
+                if b._stepCache.has(key):
+                    if b._workDirObj.load_record("step-cache-key") != key:
+                        b._stepCache.restore(key, b._workDirObj)
+                    b._logLine("%s continues from step cache" % (self._actionName))
+                    break
+            self._inputs = inputs
+        b._loadRamImage()
+        self._bRun = True
+        return True
+
+    def finish(self):
+        # disk image must be flushed before it is saved into step cache and recorded by journal,
+        # the copy on tmpfs is stale and not flushed if the action is restored from step cache
+        b = self._builder
+        if self._bRun:
+            b._flushRamImage()
+        if self._progressStepList[-1] + 1 == BuildStep.CLEANED_UP:
+            b._dropRamImage()
+        if b._stepCache is not None:
+            if self._inputs is not None:
+                b._stepCache.save(self._key, self._actionName, self._inputs, b._workDirObj)
+            b._workDirObj.save_record("step-cache-key", self._key)
+            b._stepKey = self._key
+        b._progress = BuildStep(self._progressStepList[-1] + 1)
+        b._saveJournal()
+        b._logLine("%s finished" % (self._actionName))
@@ -101,6 +101,18 @@ class Lang(enum.IntEnum):
     zh_TW = enum.auto()
 
 
+class DiskAllocation(enum.IntEnum):
+    SPARSE = enum.auto()            # sparse raw file, smallest footprint, but fragments on rotational disks
+    PREALLOCATED = enum.auto()      # fallocate'd raw file, contiguous extents, falls back to sparse if the filesystem can't do it
+    QCOW2 = enum.auto()             # qcow2 file with preallocated metadata, small footprint and no allocation stall on cluster growth
+
+
+class MemoryBackend(enum.IntEnum):
+    ANONYMOUS = enum.auto()         # plain anonymous memory, always available
+    HUGEPAGES = enum.auto()         # preallocated hugetlbfs file or hugetlb memfd, less TLB pressure, needs free huge pages on host
+    MEMFD = enum.auto()             # shared memfd, needed when guest memory is accessed by another process (vhost-user for example)
+
+
 def get_archs_by_version(version):
     d = {
         Version.WINDOWS_98: [Arch.X86],
@@ -0,0 +1,723 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import time
+import uuid
+import zlib
+import struct
+import ctypes
+import socket
+import tempfile
+import subprocess
+from ._util import Util
+from ._const import DiskAllocation
+from ._errors import DiskImageError
+
+
+class DiskImage:
+    """
+    Raw disk image file, accessed with pread/pwrite, no loop device needed.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._fd = os.open(path, os.O_RDWR)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def size(self):
+        return os.fstat(self._fd).st_size
+
+    def pread(self, length, offset):
+        return os.pread(self._fd, length, offset)
+
+    def pwrite(self, buf, offset):
+        assert offset + len(buf) <= self.size
+        while len(buf) > 0:
+            n = os.pwrite(self._fd, buf, offset)
+            buf = buf[n:]
+            offset += n
+
+    def zero(self, offset, length):
+        # punching a hole zeroes the range and releases its space, zeros are written if the filesystem can't do it
+        assert offset + length <= self.size
+        if not _punchHole(self._fd, offset, length):
+            _zeroByWriting(self, offset, length)
+
+    def flush(self):
+        os.fsync(self._fd)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class NbdDiskImage:
+    """
+    Disk image of any format supported by qemu (qcow2 for example), accessed with a qemu-nbd process
+    serving on a UNIX socket, no root privilege and no nbd kernel device needed.
+    """
+
+    _NBDMAGIC = 0x4e42444d41474943
+    _IHAVEOPT = 0x49484156454f5054
+    _REQUEST_MAGIC = 0x25609513
+    _REPLY_MAGIC = 0x67446698
+
+    _FLAG_FIXED_NEWSTYLE = 1
+    _FLAG_NO_ZEROES = 2
+    _OPT_EXPORT_NAME = 1
+
+    _CMD_READ = 0
+    _CMD_WRITE = 1
+    _CMD_DISC = 2
+    _CMD_FLUSH = 3
+    _CMD_WRITE_ZEROES = 6
+
+    _TFLAG_SEND_WRITE_ZEROES = 0x40
+
+    _MAX_REQUEST_SIZE = 32 * 1024 * 1024
+
+    def __init__(self, path, fmt="qcow2"):
+        self._path = path
+        self._tmpDir = tempfile.mkdtemp(prefix="wstage4-nbd-")
+        self._sockFile = os.path.join(self._tmpDir, "nbd.sock")
+        self._proc = None
+        self._sock = None
+        self._handle = 0
+        try:
+            self._proc = subprocess.Popen(["qemu-nbd", "-f", fmt, "-k", self._sockFile, "--cache=writeback", path])
+            self._connect()
+            self._handshake()
+        except BaseException:
+            self._dispose()
+            raise
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def size(self):
+        return self._size
+
+    def pread(self, length, offset):
+        ret = b''
+        while len(ret) < length:
+            n = min(length - len(ret), self._MAX_REQUEST_SIZE)
+            self._request(self._CMD_READ, offset + len(ret), n)
+            ret += self._recvAll(n)
+        return ret
+
+    def pwrite(self, buf, offset):
+        assert offset + len(buf) <= self.size
+        for i in range(0, len(buf), self._MAX_REQUEST_SIZE):
+            self._request(self._CMD_WRITE, offset + i, len(buf[i:i + self._MAX_REQUEST_SIZE]), buf[i:i + self._MAX_REQUEST_SIZE])
+
+    def zero(self, offset, length):
+        # qemu turns write-zeroes into zero clusters of qcow2 instead of writing data
+        assert offset + length <= self.size
+        if self._transmissionFlags & self._TFLAG_SEND_WRITE_ZEROES:
+            for i in range(0, length, self._MAX_REQUEST_SIZE):
+                self._request(self._CMD_WRITE_ZEROES, offset + i, min(self._MAX_REQUEST_SIZE, length - i))
+        else:
+            _zeroByWriting(self, offset, length)
+
+    def flush(self):
+        self._request(self._CMD_FLUSH, 0, 0)
+
+    def close(self):
+        try:
+            self._handle += 1
+            self._sock.sendall(struct.pack(">IHHQQI", self._REQUEST_MAGIC, 0, self._CMD_DISC, self._handle, 0, 0))
+        finally:
+            self._dispose()
+
+    def _connect(self):
+        deadline = time.monotonic() + 10
+        while True:
+            if self._proc.poll() is not None:
+                raise DiskImageError("qemu-nbd exited unexpectedly for \"%s\"" % (self._path))
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self._sockFile)
+                self._sock = sock
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise DiskImageError("failed to connect to qemu-nbd for \"%s\"" % (self._path))
+                time.sleep(0.1)
+
+    def _handshake(self):
+        magic, optMagic, flags = struct.unpack(">QQH", self._recvAll(18))
+        if magic != self._NBDMAGIC or optMagic != self._IHAVEOPT or not (flags & self._FLAG_FIXED_NEWSTYLE):
+            raise DiskImageError("invalid NBD handshake")
+        clientFlags = self._FLAG_FIXED_NEWSTYLE | (flags & self._FLAG_NO_ZEROES)
+        self._sock.sendall(struct.pack(">I", clientFlags))
+        self._sock.sendall(struct.pack(">QII", self._IHAVEOPT, self._OPT_EXPORT_NAME, 0))
+        self._size, self._transmissionFlags = struct.unpack(">QH", self._recvAll(10))
+        if not (clientFlags & self._FLAG_NO_ZEROES):
+            self._recvAll(124)
+
+    def _request(self, cmd, offset, length, data=b''):
+        self._handle += 1
+        self._sock.sendall(struct.pack(">IHHQQI", self._REQUEST_MAGIC, 0, cmd, self._handle, offset, length) + data)
+        magic, error, handle = struct.unpack(">IIQ", self._recvAll(16))
+        if magic != self._REPLY_MAGIC or handle != self._handle:
+            raise DiskImageError("invalid NBD reply")
+        if error != 0:
+            raise DiskImageError("NBD request failed with error %d" % (error))
+
+    def _recvAll(self, length):
+        buf = bytearray()
+        while len(buf) < length:
+            data = self._sock.recv(length - len(buf))
+            if len(data) == 0:
+                raise DiskImageError("NBD connection closed")
+            buf += data
+        return bytes(buf)
+
+    def _dispose(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if self._proc is not None:
+            # qemu-nbd exits by itself when the only client disconnects
+            try:
+                self._proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self._proc.terminate()
+                self._proc.wait()
+            self._proc = None
+        if os.path.exists(self._sockFile):
+            os.unlink(self._sockFile)
+        os.rmdir(self._tmpDir)
+
+
+class PartitionSpec:
+
+    def __init__(self, size, fs_type, part_type="data", label=""):
+        assert size == "*" or (isinstance(size, int) and size > 0)
+        assert part_type in ["data", "esp", "msr"]
+
+        self.size = size                # in bytes, "*" means all remaining space
+        self.fs_type = fs_type          # None means not formatted
+        self.part_type = part_type
+        self.label = label
+
+
+class PartitionInfo:
+
+    def __init__(self, index, start, size, fs_type, part_type):
+        self.index = index              # starts from 1
+        self.start = start              # in bytes
+        self.size = size                # in bytes
+        self.fs_type = fs_type
+        self.part_type = part_type
+
+
+class DiskPartitioner:
+
+    SECTOR_SIZE = 512
+    ALIGNMENT = 1024 * 1024
+
+    _MBR_TYPE_DICT = {
+        Util.fsTypeFat: 0x0C,           # FAT32 with LBA
+        Util.fsTypeNtfs: 0x07,
+    }
+
+    _GPT_TYPE_DICT = {
+        "data": uuid.UUID("EBD0A0A2-B9E5-4433-87C0-68B6B72699C7"),
+        "esp": uuid.UUID("C12A7328-F81F-11D2-BA4B-00A0C93EC93B"),
+        "msr": uuid.UUID("E3C9E316-0B5C-4DB8-817D-F92DF00215AE"),
+    }
+
+    _GPT_NAME_DICT = {
+        "data": "Basic data partition",
+        "esp": "EFI system partition",
+        "msr": "Microsoft reserved partition",
+    }
+
+    @staticmethod
+    def openDiskImage(path):
+        with open(path, "rb") as f:
+            if f.read(4) == b'QFI\xfb':
+                return NbdDiskImage(path, "qcow2")
+        return DiskImage(path)
+
+    @classmethod
+    def createMbr(cls, disk, specList, bootIndex=1):
+        assert 0 < len(specList) <= 4
+
+        partList = cls._allocate(disk.size, specList, cls.ALIGNMENT, disk.size)
+        buf = bytearray(cls.SECTOR_SIZE)
+        buf[440:444] = os.urandom(4)                                        # disk signature
+        for i, p in enumerate(partList):
+            startLba = p.start // cls.SECTOR_SIZE
+            numSectors = p.size // cls.SECTOR_SIZE
+            buf[446 + i * 16:446 + (i + 1) * 16] = struct.pack("<B3sB3sII",
+                                                               0x80 if p.index == bootIndex else 0x00,
+                                                               cls._chs(startLba),
+                                                               cls._MBR_TYPE_DICT[p.fs_type],
+                                                               cls._chs(startLba + numSectors - 1),
+                                                               startLba,
+                                                               numSectors)
+        buf[510:512] = b'\x55\xaa'
+        disk.pwrite(bytes(buf), 0)
+        disk.flush()
+        return partList
+
+    @classmethod
+    def createGpt(cls, disk, specList):
+        assert 0 < len(specList) <= 128
+
+        totalLba = disk.size // cls.SECTOR_SIZE
+        lastUsable = (totalLba - 34) * cls.SECTOR_SIZE
+        partList = cls._allocate(disk.size, specList, cls.ALIGNMENT, lastUsable)
+
+        # partition entries
+        entries = bytearray(128 * 128)
+        for i, p in enumerate(partList):
+            name = cls._GPT_NAME_DICT[p.part_type].encode("utf-16-le")
+            entries[i * 128:(i + 1) * 128] = struct.pack("<16s16sQQQ72s",
+                                                         cls._GPT_TYPE_DICT[p.part_type].bytes_le,
+                                                         uuid.uuid4().bytes_le,
+                                                         p.start // cls.SECTOR_SIZE,
+                                                         (p.start + p.size) // cls.SECTOR_SIZE - 1,
+                                                         0x8000000000000000 if p.part_type == "msr" else 0,     # MSR is hidden from users
+                                                         name)
+        entries = bytes(entries)
+        entriesCrc = zlib.crc32(entries)
+        diskGuid = uuid.uuid4().bytes_le
+
+        # protective MBR
+        mbr = bytearray(cls.SECTOR_SIZE)
+        mbr[446:462] = struct.pack("<B3sB3sII", 0, b'\x00\x02\x00', 0xEE, b'\xff\xff\xff', 1, min(totalLba - 1, 0xFFFFFFFF))
+        mbr[510:512] = b'\x55\xaa'
+
+        disk.pwrite(bytes(mbr), 0)
+        disk.pwrite(cls._gptHeader(totalLba, 1, diskGuid, 2, entriesCrc), 1 * cls.SECTOR_SIZE)
+        disk.pwrite(entries, 2 * cls.SECTOR_SIZE)
+        disk.pwrite(entries, (totalLba - 33) * cls.SECTOR_SIZE)
+        disk.pwrite(cls._gptHeader(totalLba, totalLba - 1, diskGuid, totalLba - 33, entriesCrc), (totalLba - 1) * cls.SECTOR_SIZE)
+        disk.flush()
+        return partList
+
+    @classmethod
+    def isGpt(cls, disk):
+        mbr = disk.pread(cls.SECTOR_SIZE, 0)
+        return mbr[510:512] == b'\x55\xaa' and mbr[450] == 0xEE
+
+    @classmethod
+    def relocateGptBackup(cls, disk):
+        """Re-create backup GPT at the end of disk, needed after the disk is resized"""
+
+        hdr = disk.pread(92, cls.SECTOR_SIZE)
+        if hdr[:8] != b'EFI PART':
+            raise DiskImageError("invalid GPT header in \"%s\"" % (disk.path))
+        diskGuid = hdr[56:72]
+        entriesLba, numEntries, entrySize = struct.unpack("<QII", hdr[72:88])
+        assert numEntries * entrySize == 128 * 128
+        entries = disk.pread(numEntries * entrySize, entriesLba * cls.SECTOR_SIZE)
+        entriesCrc = zlib.crc32(entries)
+
+        totalLba = disk.size // cls.SECTOR_SIZE
+        mbr = bytearray(disk.pread(cls.SECTOR_SIZE, 0))
+        mbr[458:462] = struct.pack("<I", min(totalLba - 1, 0xFFFFFFFF))
+        disk.pwrite(bytes(mbr), 0)
+        disk.pwrite(cls._gptHeader(totalLba, 1, diskGuid, entriesLba, entriesCrc), 1 * cls.SECTOR_SIZE)
+        disk.pwrite(entries, (totalLba - 33) * cls.SECTOR_SIZE)
+        disk.pwrite(cls._gptHeader(totalLba, totalLba - 1, diskGuid, totalLba - 33, entriesCrc), (totalLba - 1) * cls.SECTOR_SIZE)
+        disk.flush()
+
+    @classmethod
+    def resizePartition(cls, disk, partInfo, size):
+        """Change the end of a partition in partition table, filesystem in it is not touched"""
+
+        assert size > 0 and size % cls.SECTOR_SIZE == 0
+
+        numSectors = size // cls.SECTOR_SIZE
+        if cls.isGpt(disk):
+            hdr = disk.pread(92, cls.SECTOR_SIZE)
+            entriesLba, numEntries, entrySize = struct.unpack("<QII", hdr[72:88])
+            offset = entriesLba * cls.SECTOR_SIZE + (partInfo.index - 1) * entrySize
+            disk.pwrite(struct.pack("<Q", partInfo.start // cls.SECTOR_SIZE + numSectors - 1), offset + 40)
+            cls.relocateGptBackup(disk)                 # rewrites headers with the new CRC of partition entries
+        else:
+            startLba = partInfo.start // cls.SECTOR_SIZE
+            offset = 446 + (partInfo.index - 1) * 16
+            disk.pwrite(cls._chs(startLba + numSectors - 1), offset + 5)
+            disk.pwrite(struct.pack("<I", numSectors), offset + 12)
+            disk.flush()
+
+    @classmethod
+    def isNtfs(cls, disk, partInfo):
+        return disk.pread(11, partInfo.start)[3:11] == b'NTFS    '
+
+    @classmethod
+    def getNtfsFreeRanges(cls, disk, partInfo):
+        """Returns [(offset, length), ...] on disk of the free space in the NTFS filesystem, read from its $Bitmap"""
+
+        boot = disk.pread(cls.SECTOR_SIZE, partInfo.start)
+        if boot[3:11] != b'NTFS    ':
+            raise DiskImageError("no NTFS filesystem in partition %d of \"%s\"" % (partInfo.index, disk.path))
+        bytesPerSector, sectorsPerCluster = struct.unpack("<HB", boot[11:14])
+        if sectorsPerCluster > 0x80:
+            sectorsPerCluster = 1 << (256 - sectorsPerCluster)
+        clusterSize = bytesPerSector * sectorsPerCluster
+        totalSectors, mftLcn = struct.unpack("<QQ", boot[40:56])
+        clustersPerRecord = struct.unpack("<b", boot[64:65])[0]
+        recordSize = clustersPerRecord * clusterSize if clustersPerRecord > 0 else 1 << -clustersPerRecord
+        totalClusters = totalSectors * bytesPerSector // clusterSize
+
+        # $Bitmap is record 6 of $MFT, the first records of $MFT are always in its first extent
+        rec = bytearray(disk.pread(recordSize, partInfo.start + mftLcn * clusterSize + 6 * recordSize))
+        if rec[:4] != b'FILE':
+            raise DiskImageError("invalid MFT record of $Bitmap in partition %d of \"%s\"" % (partInfo.index, disk.path))
+        usaOffset, usaCount = struct.unpack("<HH", rec[4:8])
+        for i in range(1, usaCount):
+            rec[i * bytesPerSector - 2:i * bytesPerSector] = rec[usaOffset + i * 2:usaOffset + i * 2 + 2]
+
+        bitmap = None
+        pos = struct.unpack("<H", rec[20:22])[0]
+        while pos + 8 <= len(rec):
+            attrType, attrLen = struct.unpack("<II", rec[pos:pos + 8])
+            if attrType == 0xFFFFFFFF or attrLen == 0:
+                break
+            if attrType == 0x80 and rec[pos + 9] == 0:                  # unnamed $DATA
+                if rec[pos + 8] == 0:
+                    valueLen, valueOffset = struct.unpack("<IH", rec[pos + 16:pos + 22])
+                    bitmap = bytes(rec[pos + valueOffset:pos + valueOffset + valueLen])
+                else:
+                    runOffset = struct.unpack("<H", rec[pos + 32:pos + 34])[0]
+                    bitmap = b''
+                    for lcn, n in cls._ntfsDecodeRuns(rec[pos + runOffset:pos + attrLen]):
+                        bitmap += disk.pread(n * clusterSize, partInfo.start + lcn * clusterSize)
+                break
+            pos += attrLen
+        if bitmap is None or len(bitmap) * 8 < totalClusters:
+            raise DiskImageError("invalid $Bitmap in partition %d of \"%s\"" % (partInfo.index, disk.path))
+
+        # whole chunks of free clusters only, small holes are not worth it
+        chunkClusters = max(8, cls.ALIGNMENT // clusterSize // 8 * 8)
+        chunkBytes = chunkClusters // 8
+        zeroChunk = bytes(chunkBytes)
+        ret = []
+        for i in range(0, totalClusters // chunkClusters):
+            if bitmap[i * chunkBytes:(i + 1) * chunkBytes] != zeroChunk:
+                continue
+            offset = partInfo.start + i * chunkClusters * clusterSize
+            if len(ret) > 0 and ret[-1][0] + ret[-1][1] == offset:
+                ret[-1] = (ret[-1][0], ret[-1][1] + chunkClusters * clusterSize)
+            else:
+                ret.append((offset, chunkClusters * clusterSize))
+        return ret
+
+    @classmethod
+    def resizeNtfs(cls, disk, partInfo, size):
+        """
+        Resize NTFS filesystem in the partition with ntfsresize to fill size bytes, the partition table is not touched,
+        the partition must already have the new size when growing, and must be shrinked afterwards when shrinking.
+        ntfsresize works on the partition copied out into a sparse file, only the clusters in use are copied.
+        """
+
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(disk.path))) as tmpDir:
+            tmpFile = os.path.join(tmpDir, "part.img")
+            fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            try:
+                os.ftruncate(fd, max(partInfo.size, size))
+                pos = 0
+                for offset, length in cls.getNtfsFreeRanges(disk, partInfo) + [(partInfo.start + partInfo.size, 0)]:
+                    offset -= partInfo.start
+                    while pos < offset:
+                        buf = disk.pread(min(4 * 1024 * 1024, offset - pos), partInfo.start + pos)
+                        if buf.count(0) != len(buf):
+                            os.pwrite(fd, buf, pos)
+                        pos += len(buf)
+                    pos = offset + length
+            finally:
+                os.close(fd)
+
+            ret = subprocess.run(["ntfsresize", "--force", "--no-progress-bar", "--size", str(size), tmpFile],
+                                 input="y\n", stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+            if ret.returncode != 0:
+                raise DiskImageError("failed to resize NTFS filesystem in \"%s\", %s" % (disk.path, ret.stdout.strip()))
+
+            # ntfsresize writes every cluster it changes, so the data extents of the file are all the changes
+            Util.copySparseFile(tmpFile, lambda buf, offset: disk.pwrite(buf, partInfo.start + offset) if offset < size else None)
+        disk.flush()
+
+    @classmethod
+    def readPartitions(cls, disk):
+        mbr = disk.pread(cls.SECTOR_SIZE, 0)
+        if mbr[510:512] != b'\x55\xaa':
+            raise DiskImageError("no partition table found in \"%s\"" % (disk.path))
+
+        ret = []
+        if mbr[450] == 0xEE:
+            hdr = disk.pread(92, cls.SECTOR_SIZE)
+            if hdr[:8] != b'EFI PART':
+                raise DiskImageError("invalid GPT header in \"%s\"" % (disk.path))
+            entriesLba, numEntries, entrySize = struct.unpack("<QII", hdr[72:88])
+            entries = disk.pread(numEntries * entrySize, entriesLba * cls.SECTOR_SIZE)
+            typeDict = {v.bytes_le: k for k, v in cls._GPT_TYPE_DICT.items()}
+            for i in range(0, numEntries):
+                typeGuid, _, firstLba, lastLba = struct.unpack("<16s16sQQ", entries[i * entrySize:i * entrySize + 48])
+                if typeGuid == b'\0' * 16:
+                    continue
+                ret.append(PartitionInfo(i + 1, firstLba * cls.SECTOR_SIZE, (lastLba - firstLba + 1) * cls.SECTOR_SIZE, None, typeDict.get(typeGuid)))
+        else:
+            fsDict = {v: k for k, v in cls._MBR_TYPE_DICT.items()}
+            for i in range(0, 4):
+                _, _, ptype, _, startLba, numSectors = struct.unpack("<B3sB3sII", mbr[446 + i * 16:446 + (i + 1) * 16])
+                if ptype == 0:
+                    continue
+                ret.append(PartitionInfo(i + 1, startLba * cls.SECTOR_SIZE, numSectors * cls.SECTOR_SIZE, fsDict.get(ptype), "data"))
+        return ret
+
+    @classmethod
+    def formatPartition(cls, disk, partInfo, label=""):
+        """Create filesystem in a sparse temporary file, then copy its data extents into the partition"""
+
+        assert partInfo.fs_type is not None
+
+        hiddenSectors = str(partInfo.start // cls.SECTOR_SIZE)
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(disk.path))) as tmpDir:
+            tmpFile = os.path.join(tmpDir, "part.img")
+            with open(tmpFile, "wb") as f:
+                f.truncate(partInfo.size)
+
+            if partInfo.fs_type == Util.fsTypeFat:
+                cmd = ["mkfs.fat", "-F", "32", "-h", hiddenSectors]
+                if label != "":
+                    cmd += ["-n", label]
+                Util.cmdCall(*(cmd + [tmpFile]))
+            elif partInfo.fs_type == Util.fsTypeNtfs:
+                cmd = ["mkntfs", "-Q", "-F", "-s", str(cls.SECTOR_SIZE), "-p", hiddenSectors, "-H", "255", "-S", "63"]
+                if label != "":
+                    cmd += ["-L", label]
+                Util.cmdCall(*(cmd + [tmpFile]))
+            else:
+                assert False
+
+            Util.copySparseFile(tmpFile, lambda buf, offset: disk.pwrite(buf, partInfo.start + offset))
+        disk.flush()
+
+    @classmethod
+    def _allocate(cls, diskSize, specList, alignment, endLimit):
+        assert [x.size for x in specList].count("*") <= 1
+        assert specList[-1].size == "*" or "*" not in [x.size for x in specList]
+
+        ret = []
+        pos = alignment
+        endLimit = endLimit // alignment * alignment
+        for i, spec in enumerate(specList):
+            if spec.size == "*":
+                size = endLimit - pos
+            else:
+                size = (spec.size + alignment - 1) // alignment * alignment
+            if size <= 0 or pos + size > endLimit:
+                raise DiskImageError("disk is too small for the partition layout")
+            ret.append(PartitionInfo(i + 1, pos, size, spec.fs_type, spec.part_type))
+            pos += size
+        return ret
+
+    @staticmethod
+    def _ntfsDecodeRuns(buf):
+        # returns [(lcn, cluster-count), ...], the offset of each run is relative to the previous one
+        ret = []
+        pos = 0
+        lcn = 0
+        while pos < len(buf) and buf[pos] != 0:
+            lenSize = buf[pos] & 0x0F
+            offSize = buf[pos] >> 4
+            n = int.from_bytes(buf[pos + 1:pos + 1 + lenSize], "little")
+            if offSize == 0:
+                raise DiskImageError("sparse run in $Bitmap is not supported")
+            lcn += int.from_bytes(buf[pos + 1 + lenSize:pos + 1 + lenSize + offSize], "little", signed=True)
+            ret.append((lcn, n))
+            pos += 1 + lenSize + offSize
+        return ret
+
+    @classmethod
+    def _gptHeader(cls, totalLba, curLba, diskGuid, entriesLba, entriesCrc):
+        backupLba = totalLba - 1 if curLba == 1 else 1
+        hdr = struct.pack("<8sIIIIQQQQ16sQIII",
+                          b'EFI PART', 0x00010000, 92, 0, 0,
+                          curLba, backupLba, 34, totalLba - 34,
+                          diskGuid, entriesLba, 128, 128, entriesCrc)
+        hdr = hdr[:16] + struct.pack("<I", zlib.crc32(hdr)) + hdr[20:]
+        return hdr + b'\0' * (cls.SECTOR_SIZE - len(hdr))
+
+    @staticmethod
+    def _chs(lba):
+        heads, sectors = 255, 63
+        c = lba // (heads * sectors)
+        if c >= 1024:
+            return b'\xfe\xff\xff'
+        h = (lba // sectors) % heads
+        s = lba % sectors + 1
+        return bytes([h, s | ((c >> 2) & 0xC0), c & 0xFF])
+
+
+class DiskImageUtil:
+
+    @staticmethod
+    def getFormat(path):
+        with open(path, "rb") as f:
+            if f.read(4) == b'QFI\xfb':
+                return "qcow2"
+        return "raw"
+
+    @staticmethod
+    def createImage(path, size, allocation):
+        if allocation == DiskAllocation.SPARSE:
+            with open(path, "wb") as f:
+                f.truncate(size)
+        elif allocation == DiskAllocation.PREALLOCATED:
+            # fallocate(1) fails instead of writing zeros when the filesystem does not support preallocation
+            with open(path, "wb") as f:
+                pass
+            ret = subprocess.run(["fallocate", "-l", str(size), path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if ret.returncode != 0:
+                with open(path, "wb") as f:
+                    f.truncate(size)
+        elif allocation == DiskAllocation.QCOW2:
+            Util.cmdCall("qemu-img", "create", "-q", "-f", "qcow2", "-o", "preallocation=metadata", path, str(size))
+        else:
+            assert False
+
+    @staticmethod
+    def resizeImage(path, size):
+        """
+        Grow or shrink the virtual size of disk image. If the last partition has an NTFS filesystem, the partition and
+        the filesystem are resized to fill the disk, otherwise partitions are not touched so shrinking can only cut
+        unpartitioned space.
+        """
+
+        disk = DiskPartitioner.openDiskImage(path)
+        try:
+            try:
+                partList = DiskPartitioner.readPartitions(disk)
+                bGpt = DiskPartitioner.isGpt(disk)
+            except DiskImageError:
+                partList = []
+                bGpt = False
+
+            lastPart = max(partList, key=lambda x: x.start) if len(partList) > 0 else None
+            if lastPart is not None and DiskPartitioner.isNtfs(disk, lastPart):
+                partEnd = (size - (33 * DiskPartitioner.SECTOR_SIZE if bGpt else 0)) // DiskPartitioner.ALIGNMENT * DiskPartitioner.ALIGNMENT
+                partSize = partEnd - lastPart.start
+                if partSize <= 0:
+                    raise DiskImageError("can not shrink \"%s\" to %d bytes, the last partition starts at %d" % (path, size, lastPart.start))
+            else:
+                partSize = None
+
+            # filesystem and partition are shrinked before the disk
+            if partSize is not None and partSize < lastPart.size:
+                DiskPartitioner.resizeNtfs(disk, lastPart, partSize)
+                DiskPartitioner.resizePartition(disk, lastPart, partSize)
+                lastPart.size = partSize
+        finally:
+            disk.close()
+
+        minSize = max([p.start + p.size for p in partList] + [DiskPartitioner.ALIGNMENT])
+        if bGpt:
+            minSize += 33 * DiskPartitioner.SECTOR_SIZE
+        if size < minSize:
+            raise DiskImageError("can not shrink \"%s\" to %d bytes, partitions end at %d" % (path, size, minSize))
+
+        if DiskImageUtil.getFormat(path) == "raw":
+            os.truncate(path, size)
+        else:
+            Util.cmdCall("qemu-img", "resize", "-q", "--shrink", path, str(size))
+
+        # partition and filesystem are grown after the disk
+        disk = DiskPartitioner.openDiskImage(path)
+        try:
+            if bGpt:
+                DiskPartitioner.relocateGptBackup(disk)
+            if partSize is not None and partSize > lastPart.size:
+                DiskPartitioner.resizePartition(disk, lastPart, partSize)
+                DiskPartitioner.resizeNtfs(disk, lastPart, partSize)
+        finally:
+            disk.close()
+
+    @staticmethod
+    def compactImage(path):
+        """Zero the free space of NTFS filesystems, then release zeroed space of disk image to reduce its footprint, virtual size is not changed"""
+
+        # deleted files leave their data in free clusters, which are not zero
+        disk = DiskPartitioner.openDiskImage(path)
+        try:
+            try:
+                partList = DiskPartitioner.readPartitions(disk)
+            except DiskImageError:
+                partList = []
+            for p in partList:
+                if DiskPartitioner.isNtfs(disk, p):
+                    for offset, length in DiskPartitioner.getNtfsFreeRanges(disk, p):
+                        disk.zero(offset, length)
+            disk.flush()
+        finally:
+            disk.close()
+
+        if DiskImageUtil.getFormat(path) == "raw":
+            Util.cmdCall("fallocate", "--dig-holes", path)
+        else:
+            tmpPath = path + ".tmp"
+            try:
+                Util.cmdCall("qemu-img", "convert", "-q", "-O", "qcow2", path, tmpPath)
+                os.rename(tmpPath, path)
+            finally:
+                if os.path.exists(tmpPath):
+                    os.unlink(tmpPath)
+
+
+def _zeroByWriting(disk, offset, length):
+    buf = bytes(min(length, 4 * 1024 * 1024))
+    end = offset + length
+    while offset < end:
+        n = min(len(buf), end - offset)
+        disk.pwrite(buf[:n], offset)
+        offset += n
+
+
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+
+_libc = None
+
+
+def _punchHole(fd, offset, length):
+    # calls fallocate(2) in process, it is called for every free range of a filesystem
+    # returns False if the filesystem does not support punching holes
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None)
+        _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+        _libc.fallocate.restype = ctypes.c_int
+    return _libc.fallocate(fd, _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE, offset, length) == 0
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import time
+import asyncio
+import subprocess
+
+
+# An operation which waits for qemu, QMP or the guest is written once as a generator, it yields the waiting steps
+# below and gets their results back. drive() runs it with blocking calls, async_drive() runs it in an asyncio event
+# loop, so the blocking methods and the async_* methods share one implementation.
+# An exception raised by a step, asyncio.CancelledError included, is thrown into the generator at the yield.
+
+
+def drive(gen):
+    return _Driver(gen).run()
+
+
+async def async_drive(gen):
+    return await _Driver(gen).async_run()
+
+
+class Call:
+    """Calls a blocking function, it runs in a worker thread in an event loop"""
+
+    def __init__(self, func, *kargs, **kwargs):
+        self._func = func
+        self._kargs = kargs
+        self._kwargs = kwargs
+
+    def run(self):
+        return self._func(*self._kargs, **self._kwargs)
+
+    async def async_run(self):
+        return await asyncio.to_thread(self._func, *self._kargs, **self._kwargs)
+
+
+class Sleep:
+
+    def __init__(self, seconds):
+        self._seconds = seconds
+
+    def run(self):
+        time.sleep(self._seconds)
+
+    async def async_run(self):
+        await asyncio.sleep(self._seconds)
+
+
+class SpawnProcess:
+    """Returns subprocess.Popen, or asyncio.subprocess.Process in an event loop"""
+
+    def __init__(self, argv, capture_output):
+        self._argv = argv
+        self._kwargs = {"stdout": subprocess.PIPE, "stderr": subprocess.STDOUT} if capture_output else {}
+
+    def run(self):
+        return subprocess.Popen(self._argv, **self._kwargs)
+
+    async def async_run(self):
+        return await asyncio.create_subprocess_exec(*self._argv, **self._kwargs)
+
+
+class WaitProcess:
+    """Waits for a process spawned by SpawnProcess, subprocess.TimeoutExpired is raised in both cases"""
+
+    def __init__(self, proc, timeout=None):
+        self._proc = proc
+        self._timeout = timeout
+
+    def run(self):
+        return self._proc.wait(self._timeout)
+
+    async def async_run(self):
+        try:
+            return await asyncio.wait_for(self._proc.wait(), self._timeout)
+        except asyncio.TimeoutError:
+            raise subprocess.TimeoutExpired(self._proc.pid, self._timeout)
+
+
+class StartBackground:
+    """
+    Runs obj in background, obj has start() and stop() which run it in a thread, and async_run() which runs it until
+    cancelled. Returns the handle for StopBackground.
+    """
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def run(self):
+        self._obj.start()
+        return self._obj
+
+    async def async_run(self):
+        return asyncio.ensure_future(self._obj.async_run())
+
+
+class StopBackground:
+
+    def __init__(self, handle):
+        self._handle = handle
+
+    def run(self):
+        self._handle.stop()
+
+    async def async_run(self):
+        self._handle.cancel()
+        await asyncio.gather(self._handle, return_exceptions=True)
+
+
+class _Driver:
+
+    def __init__(self, gen):
+        self._gen = gen
+
+    def run(self):
+        value, exc = None, None
+        while True:
+            try:
+                step = self._gen.throw(exc) if exc is not None else self._gen.send(value)
+            except StopIteration as e:
+                return e.value
+            try:
+                value, exc = step.run(), None
+            except BaseException as e:
+                value, exc = None, e
+
+    async def async_run(self):
+        value, exc = None, None
+        while True:
+            try:
+                step = self._gen.throw(exc) if exc is not None else self._gen.send(value)
+            except StopIteration as e:
+                return e.value
+            try:
+                value, exc = await step.async_run(), None
+            except BaseException as e:
+                value, exc = None, e
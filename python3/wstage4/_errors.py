@@ -31,3 +31,27 @@ class InstallMediaError(Exception):
 
 class WorkDirError(Exception):
     pass
+
+
+class GuestAgentError(Exception):
+    pass
+
+
+class GuestAgentFileNotFoundError(GuestAgentError):
+    pass
+
+
+class AddonStoreError(Exception):
+    pass
+
+
+class DiskImageError(Exception):
+    pass
+
+
+class StorageLayoutError(Exception):
+    pass
+
+
+class VmError(Exception):
+    pass
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import time
+import base64
+import shutil
+import socket
+import pathlib
+import tempfile
+import socketserver
+import threading
+import http.server
+import urllib.parse
+from ._errors import GuestAgentError
+from ._errors import GuestAgentFileNotFoundError
+from ._guest_agent_server import CHUNK_SIZE
+from ._guest_agent_script import SCRIPT
+
+
+class GuestAgent:
+    """
+    Host side client of the guest agent, see _guest_agent_server.py for the protocol.
+    The socket can be the one returned by GuestAgentBridge.connect(), or one end of a socketpair with a fake agent on the other end.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._buf = bytearray()
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._sock.close()
+
+    def ping(self, timeout=5):
+        """Returns round-trip time in seconds, raises GuestAgentError if the agent does not answer in time"""
+
+        with self._lock:
+            seq = self._newSeq()
+            t = time.monotonic()
+            self._send("PING", seq)
+            self._recv(seq, ["PONG"], timeout)
+            return time.monotonic() - t
+
+    def wait_ready(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.ping(timeout=1)
+                return
+            except GuestAgentError:
+                if time.monotonic() >= deadline:
+                    raise
+
+    def exec(self, cmdline, stdout_callback=None, stderr_callback=None, timeout=None):
+        """Execute cmdline in guest, output is streamed to the callbacks as bytes, returns exit code"""
+
+        with self._lock:
+            seq = self._newSeq()
+            self._send("EXEC", seq, _encode(cmdline.encode("utf-8")))
+            while True:
+                fields = self._recv(seq, ["OUT", "ERR", "EXIT"], timeout)
+                if fields[0] == "OUT":
+                    if stdout_callback is not None:
+                        stdout_callback(_decode(fields[2]))
+                elif fields[0] == "ERR":
+                    if stderr_callback is not None:
+                        stderr_callback(_decode(fields[2]))
+                elif fields[0] == "EXIT":
+                    return int(fields[2])
+                else:
+                    assert False
+
+    def push_file(self, hostpath, guestpath):
+        with self._lock:
+            seq = self._newSeq()
+            self._send("PUSH", seq, _encode(guestpath.encode("utf-8")))
+            with open(hostpath, "rb") as f:
+                while True:
+                    buf = f.read(CHUNK_SIZE)
+                    if len(buf) == 0:
+                        break
+                    self._send("DATA", seq, _encode(buf))
+            self._send("END", seq)
+            self._recv(seq, ["OK"], None)
+
+    def push_buffer(self, buf, guestpath):
+        with self._lock:
+            seq = self._newSeq()
+            self._send("PUSH", seq, _encode(guestpath.encode("utf-8")))
+            for i in range(0, len(buf), CHUNK_SIZE):
+                self._send("DATA", seq, _encode(buf[i:i + CHUNK_SIZE]))
+            self._send("END", seq)
+            self._recv(seq, ["OK"], None)
+
+    def pull_file(self, guestpath, hostpath):
+        with self._lock:
+            seq = self._newSeq()
+            self._send("PULL", seq, _encode(guestpath.encode("utf-8")))
+            tmpPath = hostpath + ".tmp"
+            try:
+                with open(tmpPath, "wb") as f:
+                    while True:
+                        fields = self._recv(seq, ["DATA", "END", "NOENT"], None)
+                        if fields[0] == "NOENT":
+                            raise GuestAgentFileNotFoundError("file \"%s\" does not exist in guest" % (guestpath))
+                        if fields[0] == "END":
+                            break
+                        f.write(_decode(fields[2]))
+                os.rename(tmpPath, hostpath)
+            finally:
+                if os.path.exists(tmpPath):
+                    os.unlink(tmpPath)
+
+    def push_dir(self, hostpath, guestpath):
+        for fullfn in sorted(pathlib.Path(hostpath).rglob("*")):
+            if fullfn.is_file():
+                relPath = str(fullfn.relative_to(hostpath))
+                self.push_file(str(fullfn), guestpath + "\\" + relPath.replace("/", "\\"))
+
+    def _newSeq(self):
+        self._seq += 1
+        return str(self._seq)
+
+    def _send(self, *fields):
+        try:
+            self._sock.sendall((" ".join(fields) + "\n").encode("ascii"))
+        except OSError as e:
+            raise GuestAgentError("failed to send to guest agent, %s" % (e))
+
+    def _recv(self, seq, typeList, timeout):
+        # messages of an earlier, abandoned request (for example a timed-out PING) are discarded
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            fields = self._readLine(deadline).split(" ")
+            if len(fields) < 2 or fields[1] != seq:
+                continue
+            if fields[0] == "FAIL":
+                raise GuestAgentError("guest agent request failed, %s" % (_decode(fields[2]).decode("utf-8", "replace")))
+            if fields[0] not in typeList:
+                raise GuestAgentError("unexpected message \"%s\" from guest agent" % (fields[0]))
+            return fields
+
+    def _readLine(self, deadline):
+        while True:
+            i = self._buf.find(b'\n')
+            if i >= 0:
+                line = bytes(self._buf[:i])
+                del self._buf[:i + 1]
+                return line.decode("ascii").rstrip("\r")
+
+            if deadline is not None:
+                remain = deadline - time.monotonic()
+                if remain <= 0:
+                    raise GuestAgentError("guest agent timed out")
+                self._sock.settimeout(remain)
+            else:
+                self._sock.settimeout(None)
+
+            try:
+                data = self._sock.recv(65536)
+            except socket.timeout:
+                raise GuestAgentError("guest agent timed out")
+            except OSError as e:
+                raise GuestAgentError("failed to receive from guest agent, %s" % (e))
+            if len(data) == 0:
+                raise GuestAgentError("guest agent closed the connection")
+            self._buf += data
+
+
+class GuestAgentBridge:
+    """
+    Carries the agent protocol over HTTP for the guest agent script (see _guest_agent_script.py), it is run by the host
+    process and is reachable from the guest through slirp guestfwd. It listens on a UNIX socket in a private directory,
+    so that other local users can't read the lines for guest or forge the lines from guest.
+
+    The guest POSTs to /agent, the request body is the lines from guest, the response body is the lines for guest.
+    A request with "wait=1" is held until there are lines for guest or POLL_TIMEOUT passes. A request retried with the
+    same id gets the same response, so no line is lost or duplicated when a request fails half way.
+    """
+
+    GUEST_ADDRESS = "10.0.2.101"
+    GUEST_PORT = 80
+
+    POLL_TIMEOUT = 15
+
+    _MAX_PENDING = 4 * 1024 * 1024
+    _MAX_REPLY = 1024 * 1024
+
+    def __init__(self):
+        self._sock, self._peerSock = socket.socketpair()
+        self._cond = threading.Condition()
+        self._pending = bytearray()             # lines for guest
+        self._lastId = None
+        self._lastReply = None
+        self._closed = False
+
+        self._tmpDir = tempfile.mkdtemp(prefix="wstage4-agent-")          # created with mode 0700
+        self._server = _BridgeServer(os.path.join(self._tmpDir, "agent.sock"), _BridgeHandler)
+        self._server.bridge = self
+        self._serverThread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._serverThread.start()
+        self._recvThread = threading.Thread(target=self._recvLoop, daemon=True)
+        self._recvThread.start()
+
+    @property
+    def path(self):
+        return self._server.server_address
+
+    @classmethod
+    def get_guest_script(cls):
+        url = "http://%s:%d/agent" % (cls.GUEST_ADDRESS, cls.GUEST_PORT)
+        buf = SCRIPT.replace("@@url@@", url).replace("@@chunk_size@@", str(CHUNK_SIZE))
+        return buf.replace("\n", "\r\n").encode("ascii")
+
+    def connect(self):
+        """Returns the socket for GuestAgent, it can be called only once"""
+
+        assert self._peerSock is not None
+        ret = self._peerSock
+        self._peerSock = None
+        return ret
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._serverThread.join()
+        shutil.rmtree(self._tmpDir)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)       # wakes up the recv thread
+        except OSError:
+            pass
+        self._recvThread.join()
+        self._sock.close()
+        if self._peerSock is not None:
+            self._peerSock.close()
+
+    def _recvLoop(self):
+        while True:
+            with self._cond:
+                # stop reading when guest is slow, so that GuestAgent blocks instead of memory usage growing
+                self._cond.wait_for(lambda: len(self._pending) < self._MAX_PENDING or self._closed)
+                if self._closed:
+                    break
+            try:
+                buf = self._sock.recv(65536)
+            except OSError:
+                break
+            if len(buf) == 0:
+                break
+            with self._cond:
+                self._pending += buf
+                self._cond.notify_all()
+
+    def _exchange(self, reqId, body, wait):
+        with self._cond:
+            if reqId is not None and reqId == self._lastId:
+                return self._lastReply
+
+        if len(body) > 0:
+            try:
+                self._sock.sendall(body)
+            except OSError:
+                pass                            # GuestAgent is closed, lines from guest are dropped
+
+        with self._cond:
+            if wait:
+                self._cond.wait_for(lambda: b'\n' in self._pending or self._closed, self.POLL_TIMEOUT)
+            i = self._pending.rfind(b'\n', 0, self._MAX_REPLY) + 1
+            if i == 0:
+                i = self._pending.find(b'\n') + 1
+            ret = bytes(self._pending[:i])
+            del self._pending[:i]
+            self._lastId = reqId
+            self._lastReply = ret
+            self._cond.notify_all()
+            return ret
+
+
+class _BridgeServer(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+
+class _BridgeHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        u = urllib.parse.urlsplit(self.path)
+        if u.path != "/agent":
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(u.query)
+        body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+
+        buf = self.server.bridge._exchange(query.get("id", [None])[0], body, query.get("wait", ["0"])[0] == "1")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(buf)))
+        self.end_headers()
+        self.wfile.write(buf)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _encode(buf):
+    return base64.b64encode(buf).decode("ascii")
+
+
+def _decode(s):
+    return base64.b64decode(s.encode("ascii"))
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+wstage4 guest agent for Windows XP and later, it is a JScript file run by Windows Script Host which is part of every
+installation, so nothing needs to be installed into the guest before the agent can run.
+
+Windows Script Host can't open serial ports, so the agent talks to GuestAgentBridge in host through slirp guestfwd
+with HTTP requests. The lines of the protocol described in _guest_agent_server.py are carried in the bodies.
+
+"AGENT.JS /install" copies the script into the guest and registers a scheduled task which starts it on every boot
+as SYSTEM, it is run by the answer file at first logon.
+"""
+
+
+FLOPPY_FILENAME = "AGENT.JS"
+
+INSTALL_COMMAND = "cscript //B //Nologo A:\\%s /install" % (FLOPPY_FILENAME)
+
+SCRIPT = r"""// wstage4 guest agent, generated by wstage4, do not edit
+
+var AGENT_URL = "@@url@@";
+var CHUNK_SIZE = @@chunk_size@@;
+var INSTALL_DIR = "C:\\wstage4";
+var TASK_NAME = "wstage4-agent";
+
+var shell = new ActiveXObject("WScript.Shell");
+var fso = new ActiveXObject("Scripting.FileSystemObject");
+var xmlDoc = new ActiveXObject("MSXML2.DOMDocument");
+
+var sessionId = String(new Date().getTime()) + String(Math.floor(Math.random() * 1000000));
+var requestCount = 0;
+var inbox = [];             // lines received from host, not processed yet
+var outbox = [];            // lines to be sent to host
+var sentLines = null;       // lines of the current request, kept until the request succeeds
+
+function main() {
+    if (WScript.Arguments.length > 0 && WScript.Arguments(0) == "/install") {
+        install();
+    } else {
+        serve();
+    }
+}
+
+function install() {
+    var dst = INSTALL_DIR + "\\agent.js";
+    if (!fso.FolderExists(INSTALL_DIR)) {
+        fso.CreateFolder(INSTALL_DIR);
+    }
+    fso.CopyFile(WScript.ScriptFullName, dst, true);
+
+    // "schtasks /create /f" is not supported by windows XP
+    shell.Run("schtasks /delete /tn " + TASK_NAME + " /f", 0, true);
+    shell.Run("schtasks /create /tn " + TASK_NAME + " /sc onstart /ru System /tr \"wscript.exe //B //Nologo " + dst + "\"", 0, true);
+    shell.Run("schtasks /run /tn " + TASK_NAME, 0, true);
+}
+
+function serve() {
+    while (true) {
+        if (inbox.length > 0) {
+            handle(inbox.shift());
+        } else if (!exchange(true)) {
+            WScript.Sleep(1000);
+        }
+    }
+}
+
+function exchange(wait) {
+    // sends the outbox and receives lines into inbox, returns false if host is not reachable
+    // a failed request is retried with the same id and body, so that host sees every line exactly once
+    if (sentLines == null) {
+        sentLines = outbox;
+        outbox = [];
+    }
+    var body = "";
+    for (var i = 0; i < sentLines.length; i++) {
+        body += sentLines[i] + "\n";
+    }
+    var url = AGENT_URL + "?id=" + sessionId + "-" + requestCount + "&wait=" + ((wait && body == "") ? "1" : "0");
+
+    var lines;
+    try {
+        var xhr = new ActiveXObject("MSXML2.ServerXMLHTTP");
+        try {
+            xhr.setProxy(1);                        // SXH_PROXY_SET_DIRECT
+        } catch (e) {
+        }
+        xhr.setTimeouts(10000, 10000, 60000, 60000);
+        xhr.open("POST", url, false);
+        xhr.setRequestHeader("Content-Type", "text/plain");
+        xhr.send(body);
+        if (xhr.status != 200) {
+            return false;
+        }
+        lines = xhr.responseText.split("\n");
+    } catch (e) {
+        return false;
+    }
+
+    requestCount++;
+    sentLines = null;
+    for (var i = 0; i < lines.length; i++) {
+        var line = lines[i].replace(/\r$/, "");
+        if (line != "") {
+            inbox.push(line);
+        }
+    }
+    return true;
+}
+
+function nextLine() {
+    while (inbox.length == 0) {
+        if (!exchange(true)) {
+            WScript.Sleep(1000);
+        }
+    }
+    return inbox.shift();
+}
+
+function send(line) {
+    outbox.push(line);
+}
+
+function handle(line) {
+    var fields = line.split(" ");
+    if (fields.length < 2) {
+        return;
+    }
+    try {
+        if (fields[0] == "PING") {
+            send("PONG " + fields[1]);
+        } else if (fields[0] == "EXEC") {
+            doExec(fields[1], bytesToText(base64ToBytes(fields[2])));
+        } else if (fields[0] == "PUSH") {
+            doPush(fields[1], bytesToText(base64ToBytes(fields[2])));
+        } else if (fields[0] == "PULL") {
+            doPull(fields[1], bytesToText(base64ToBytes(fields[2])));
+        } else {
+            sendFail(fields[1], "unknown request " + fields[0]);
+        }
+    } catch (e) {
+        sendFail(fields[1], e.message ? e.message : String(e));
+    }
+}
+
+function sendFail(seq, message) {
+    try {
+        send("FAIL " + seq + " " + bytesToBase64(textToBytes(message)));
+    } catch (e) {
+        send("FAIL " + seq + " ");
+    }
+}
+
+function doExec(seq, cmdline) {
+    // the command runs in an inner cmd.exe whose output is redirected by an outer one to temporary files,
+    // which are read while the command is running, WshScriptExec's own pipes would block a chatty command
+    var comspec = shell.ExpandEnvironmentStrings("%COMSPEC%");
+    var base = shell.ExpandEnvironmentStrings("%TEMP%") + "\\wstage4-agent-" + sessionId + "-" + seq;
+    var outFile = base + ".out";
+    var errFile = base + ".err";
+    var escaped = cmdline.replace(/([\^&|<>()"])/g, "^$1");
+
+    var proc = shell.Exec(comspec + " /d /s /c \"" + comspec + " /d /c ^\"" + escaped + "^\" 1>\"" + outFile + "\" 2>\"" + errFile + "\"\"");
+    var outPos = 0;
+    var errPos = 0;
+    try {
+        while (true) {
+            var done = (proc.Status != 0);
+            outPos = sendFileTail(seq, "OUT", outFile, outPos);
+            errPos = sendFileTail(seq, "ERR", errFile, errPos);
+            if (done) {
+                break;
+            }
+            if (outbox.length > 0 || sentLines != null) {
+                exchange(false);
+            }
+            WScript.Sleep(200);
+        }
+    } finally {
+        deleteFile(outFile);
+        deleteFile(errFile);
+    }
+    send("EXIT " + seq + " " + proc.ExitCode);
+}
+
+function doPush(seq, path) {
+    // always consume the whole DATA stream even if the file can't be written
+    var err = null;
+    var stream = null;
+    try {
+        makeParentDirs(path);
+        stream = new ActiveXObject("ADODB.Stream");
+        stream.Type = 1;                            // adTypeBinary
+        stream.Open();
+    } catch (e) {
+        err = e;
+    }
+    while (true) {
+        var fields = nextLine().split(" ");
+        if (fields[0] == "END") {
+            break;
+        }
+        if (err == null && fields.length > 2 && fields[2] != "") {
+            try {
+                stream.Write(base64ToBytes(fields[2]));
+            } catch (e) {
+                err = e;
+            }
+        }
+    }
+    if (err == null) {
+        try {
+            stream.SaveToFile(path, 2);             // adSaveCreateOverWrite
+        } catch (e) {
+            err = e;
+        }
+    }
+    if (stream != null && stream.State != 0) {
+        stream.Close();
+    }
+
+    if (err != null) {
+        throw err;
+    }
+    send("OK " + seq);
+}
+
+function doPull(seq, path) {
+    if (!fso.FileExists(path)) {
+        send("NOENT " + seq);
+        return;
+    }
+    var stream = new ActiveXObject("ADODB.Stream");
+    stream.Type = 1;                                // adTypeBinary
+    stream.Open();
+    try {
+        stream.LoadFromFile(path);
+        while (!stream.EOS) {
+            send("DATA " + seq + " " + bytesToBase64(stream.Read(CHUNK_SIZE)));
+            if (outbox.length >= 16) {
+                exchange(false);
+            }
+        }
+    } finally {
+        stream.Close();
+    }
+    send("END " + seq);
+}
+
+function sendFileTail(seq, msgType, path, pos) {
+    // returns the new position, the file may not exist yet or be locked by the writer
+    try {
+        if (!fso.FileExists(path)) {
+            return pos;
+        }
+        var stream = new ActiveXObject("ADODB.Stream");
+        stream.Type = 1;                            // adTypeBinary
+        stream.Open();
+        try {
+            stream.LoadFromFile(path);
+            stream.Position = pos;
+            while (!stream.EOS) {
+                var bytes = stream.Read(CHUNK_SIZE);
+                send(msgType + " " + seq + " " + bytesToBase64(bytes));
+                pos = stream.Position;
+            }
+        } finally {
+            stream.Close();
+        }
+    } catch (e) {
+    }
+    return pos;
+}
+
+function makeParentDirs(path) {
+    var dirpath = fso.GetParentFolderName(path);
+    if (dirpath != "" && !fso.FolderExists(dirpath)) {
+        makeParentDirs(dirpath);
+        fso.CreateFolder(dirpath);
+    }
+}
+
+function deleteFile(path) {
+    try {
+        if (fso.FileExists(path)) {
+            fso.DeleteFile(path, true);
+        }
+    } catch (e) {
+    }
+}
+
+function base64ToBytes(s) {
+    var el = xmlDoc.createElement("b64");
+    el.dataType = "bin.base64";
+    el.text = s;
+    return el.nodeTypedValue;
+}
+
+function bytesToBase64(bytes) {
+    var el = xmlDoc.createElement("b64");
+    el.dataType = "bin.base64";
+    el.nodeTypedValue = bytes;
+    return el.text.replace(/[\r\n]/g, "");
+}
+
+function bytesToText(bytes) {
+    var stream = new ActiveXObject("ADODB.Stream");
+    stream.Type = 1;                                // adTypeBinary
+    stream.Open();
+    stream.Write(bytes);
+    stream.Position = 0;
+    stream.Type = 2;                                // adTypeText
+    stream.Charset = "utf-8";
+    var ret = stream.ReadText();
+    stream.Close();
+    return ret;
+}
+
+function textToBytes(s) {
+    var stream = new ActiveXObject("ADODB.Stream");
+    stream.Type = 2;                                // adTypeText
+    stream.Charset = "utf-8";
+    stream.Open();
+    stream.WriteText(s);
+    stream.Position = 0;
+    stream.Type = 1;                                // adTypeBinary
+    stream.Position = 3;                            // skip the BOM written by ADODB.Stream
+    var ret = stream.Read();
+    stream.Close();
+    return ret;
+}
+
+main();
+"""
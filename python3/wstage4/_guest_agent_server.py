@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Reference implementation of the wstage4 guest agent in Python, it talks to the host through any byte stream.
+The agent installed into Windows guests is the JScript one in _guest_agent_script.py, this one is the fake agent
+in tests, and can be run through a serial port in a guest which has Python.
+
+This file may be copied into a guest as is, so it must not import anything from wstage4,
+and it must stay compatible with Python 3.4, the last python release which runs on Windows XP.
+
+Protocol (every message is one line of ASCII text, payload fields are base64 encoded):
+    host -> guest:
+        PING <seq>
+        EXEC <seq> <cmdline>
+        PUSH <seq> <guest-path>, followed by "DATA <seq> <chunk>"... and "END <seq>"
+        PULL <seq> <guest-path>
+    guest -> host:
+        PONG <seq>
+        OUT <seq> <chunk>, ERR <seq> <chunk>, EXIT <seq> <returncode>     (reply for EXEC)
+        OK <seq>                                                          (reply for PUSH)
+        DATA <seq> <chunk>..., END <seq>                                  (reply for PULL)
+        NOENT <seq>                                                       (reply for PULL of a file that does not exist)
+        FAIL <seq> <message>                                              (reply for any failed request)
+
+Usage: python wstage4-agent.py [COM1]
+"""
+
+
+import os
+import sys
+import base64
+import threading
+import subprocess
+
+
+CHUNK_SIZE = 48 * 1024
+
+
+class GuestAgentServer:
+
+    def __init__(self, rfile, wfile):
+        self._rfile = rfile
+        self._wfile = wfile
+        self._wlock = threading.Lock()
+
+    def serve_forever(self):
+        while True:
+            line = self._readLine()
+            if line is None:
+                break
+            fields = line.split(" ")
+            if len(fields) < 2:
+                continue
+            try:
+                if fields[0] == "PING":
+                    self._send("PONG", fields[1])
+                elif fields[0] == "EXEC":
+                    self._doExec(fields[1], _decode(fields[2]).decode("utf-8"))
+                elif fields[0] == "PUSH":
+                    self._doPush(fields[1], _decode(fields[2]).decode("utf-8"))
+                elif fields[0] == "PULL":
+                    self._doPull(fields[1], _decode(fields[2]).decode("utf-8"))
+                else:
+                    self._send("FAIL", fields[1], _encode(("unknown request %s" % (fields[0])).encode("utf-8")))
+            except Exception as e:
+                self._send("FAIL", fields[1], _encode(str(e).encode("utf-8")))
+
+    def _doExec(self, seq, cmdline):
+        def __pump(f, msgType):
+            while True:
+                buf = os.read(f.fileno(), CHUNK_SIZE)
+                if len(buf) == 0:
+                    break
+                self._send(msgType, seq, _encode(buf))
+
+        proc = subprocess.Popen(cmdline, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        tList = [
+            threading.Thread(target=__pump, args=(proc.stdout, "OUT")),
+            threading.Thread(target=__pump, args=(proc.stderr, "ERR")),
+        ]
+        for t in tList:
+            t.start()
+        for t in tList:
+            t.join()
+        proc.stdout.close()
+        proc.stderr.close()
+        self._send("EXIT", seq, str(proc.wait()))
+
+    def _doPush(self, seq, path):
+        # always consume the whole DATA stream even if the file can't be written
+        err = None
+        f = None
+        try:
+            dirpath = os.path.dirname(path)
+            if dirpath != "" and not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+            f = open(path, "wb")
+        except Exception as e:
+            err = e
+        try:
+            while True:
+                line = self._readLine()
+                if line is None:
+                    return
+                fields = line.split(" ")
+                if fields[0] == "END":
+                    break
+                assert fields[0] == "DATA" and fields[1] == seq
+                if err is None:
+                    try:
+                        f.write(_decode(fields[2]))
+                    except Exception as e:
+                        err = e
+        finally:
+            if f is not None:
+                f.close()
+
+        if err is not None:
+            raise err
+        self._send("OK", seq)
+
+    def _doPull(self, seq, path):
+        if not os.path.exists(path):
+            self._send("NOENT", seq)
+            return
+        with open(path, "rb") as f:
+            while True:
+                buf = f.read(CHUNK_SIZE)
+                if len(buf) == 0:
+                    break
+                self._send("DATA", seq, _encode(buf))
+        self._send("END", seq)
+
+    def _readLine(self):
+        buf = bytearray()
+        while True:
+            c = self._rfile.read(1)
+            if c is None:
+                continue
+            if len(c) == 0:
+                return None
+            if c == b'\n':
+                return bytes(buf).decode("ascii").rstrip("\r")
+            buf += c
+
+    def _send(self, *fields):
+        with self._wlock:
+            self._wfile.write((" ".join(fields) + "\n").encode("ascii"))
+            self._wfile.flush()
+
+
+def _encode(buf):
+    return base64.b64encode(buf).decode("ascii")
+
+
+def _decode(s):
+    return base64.b64decode(s.encode("ascii"))
+
+
+if __name__ == "__main__":
+    port = sys.argv[1] if len(sys.argv) > 1 else "COM1"
+    with open("\\\\.\\" + port, "r+b", buffering=0) as f:
+        GuestAgentServer(f, f).serve_forever()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import json
+import select
+import socket
+import hashlib
+import tempfile
+import threading
+import http.client
+import http.server
+import urllib.parse
+
+
+class CachingHttpProxy:
+    """
+    Forward HTTP proxy with a disk cache, it is run by the host process and is reachable from guests through slirp guestfwd.
+
+    Successful GET responses are cached forever by URL, since what the guests download are installers and updates whose
+    content never changes for a given URL. Least recently used entries are evicted when the cache exceeds max_size.
+    CONNECT requests are tunneled without caching.
+
+    Layout of the cache directory:
+        <sha256-of-url>.body          response body
+        <sha256-of-url>.json          url, status and headers, written after the body so it marks a complete entry
+    """
+
+    GUEST_ADDRESS = "10.0.2.100"
+    GUEST_PORT = 3128
+
+    def __init__(self, cache_dir, max_size=10 * 1024 * 1024 * 1024, timeout=60):
+        self._cacheDir = cache_dir
+        self._maxSize = max_size
+        self._timeout = timeout
+        self._server = None
+        self._thread = None
+
+        self._statLock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._uncacheable = 0
+        self._hitBytes = 0
+        self._missBytes = 0
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def guest_url(self):
+        return "http://%s:%d" % (self.GUEST_ADDRESS, self.GUEST_PORT)
+
+    def is_running(self):
+        return self._server is not None
+
+    def start(self):
+        assert self._server is None
+
+        os.makedirs(self._cacheDir, exist_ok=True)
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        self._server.proxy = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+            self._thread = None
+
+    def get_stats(self):
+        with self._statLock:
+            total = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "uncacheable": self._uncacheable,
+                "hit_bytes": self._hitBytes,
+                "miss_bytes": self._missBytes,
+                "hit_rate": (self._hits / total) if total > 0 else 0.0,
+                "cache_size": self._getCacheSize(),
+            }
+
+    def clear(self):
+        for fn in os.listdir(self._cacheDir):
+            os.unlink(os.path.join(self._cacheDir, fn))
+
+    def _lookup(self, url):
+        # returns (meta, body-filepath) or None
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        metaFile = os.path.join(self._cacheDir, key + ".json")
+        bodyFile = os.path.join(self._cacheDir, key + ".body")
+        try:
+            with open(metaFile, "r") as f:
+                meta = json.load(f)
+            os.utime(bodyFile)                          # mtime is the LRU stamp
+            return (meta, bodyFile)
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, url, status, headers, tmpBodyFile):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        metaFile = os.path.join(self._cacheDir, key + ".json")
+        os.rename(tmpBodyFile, os.path.join(self._cacheDir, key + ".body"))
+        with open(metaFile + ".tmp", "w") as f:
+            json.dump({"url": url, "status": status, "headers": headers}, f)
+        os.rename(metaFile + ".tmp", metaFile)
+        self._evict()
+
+    def _evict(self):
+        entryList = []
+        total = 0
+        for fn in os.listdir(self._cacheDir):
+            if fn.endswith(".body"):
+                try:
+                    s = os.stat(os.path.join(self._cacheDir, fn))
+                except FileNotFoundError:
+                    continue
+                entryList.append((s.st_mtime, s.st_size, fn[:-len(".body")]))
+                total += s.st_size
+        for mtime, size, key in sorted(entryList):
+            if total <= self._maxSize:
+                break
+            for ext in [".json", ".body"]:
+                try:
+                    os.unlink(os.path.join(self._cacheDir, key + ext))
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+    def _getCacheSize(self):
+        ret = 0
+        for fn in os.listdir(self._cacheDir):
+            if fn.endswith(".body"):
+                try:
+                    ret += os.path.getsize(os.path.join(self._cacheDir, fn))
+                except FileNotFoundError:
+                    pass
+        return ret
+
+    def _count(self, name, nbytes=0):
+        with self._statLock:
+            if name == "hit":
+                self._hits += 1
+                self._hitBytes += nbytes
+            elif name == "miss":
+                self._misses += 1
+                self._missBytes += nbytes
+            elif name == "uncacheable":
+                self._uncacheable += 1
+            else:
+                assert False
+
+
+class _Server(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    _HOP_BY_HOP_HEADERS = ["connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "proxy-connection",
+                           "te", "trailers", "transfer-encoding", "upgrade"]
+
+    def do_GET(self):
+        proxy = self.server.proxy
+        if not self._checkUrl():
+            return
+
+        if self._isCacheableRequest():
+            ret = proxy._lookup(self.path)
+            if ret is not None:
+                meta, bodyFile = ret
+                with open(bodyFile, "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    self._sendHead(meta["status"], meta["headers"], size)
+                    self._copyStream(f, self.wfile, size)
+                proxy._count("hit", size)
+                return
+
+        self._forward(cache=self._isCacheableRequest())
+
+    def do_HEAD(self):
+        if self._checkUrl():
+            self._forward(cache=False)
+
+    def do_POST(self):
+        if self._checkUrl():
+            self._forward(cache=False)
+
+    def do_PUT(self):
+        if self._checkUrl():
+            self._forward(cache=False)
+
+    def do_DELETE(self):
+        if self._checkUrl():
+            self._forward(cache=False)
+
+    def do_CONNECT(self):
+        host, _, port = self.path.rpartition(":")
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=self.server.proxy._timeout)
+        except (OSError, ValueError) as e:
+            self.send_error(502, "failed to connect to %s: %s" % (self.path, e))
+            return
+
+        self.send_response(200, "Connection Established")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            upstream.settimeout(None)
+            sockList = [self.connection, upstream]
+            while True:
+                rList, _, xList = select.select(sockList, [], sockList, self.server.proxy._timeout)
+                if len(xList) > 0 or len(rList) == 0:
+                    break
+                for s in rList:
+                    buf = s.recv(65536)
+                    if len(buf) == 0:
+                        return
+                    (upstream if s is self.connection else self.connection).sendall(buf)
+        finally:
+            upstream.close()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _checkUrl(self):
+        u = urllib.parse.urlsplit(self.path)
+        if u.scheme != "http" or u.hostname is None:
+            self.send_error(400, "only absolute http URLs are supported by a forward proxy")
+            return False
+        return True
+
+    def _isCacheableRequest(self):
+        return self.command == "GET" and "Authorization" not in self.headers and "Range" not in self.headers
+
+    def _forward(self, cache):
+        proxy = self.server.proxy
+        u = urllib.parse.urlsplit(self.path)
+        path = u.path if u.path != "" else "/"
+        if u.query != "":
+            path += "?" + u.query
+
+        # request body
+        body = None
+        if "Content-Length" in self.headers:
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+
+        headers = {k: v for k, v in self.headers.items() if k.lower() not in self._HOP_BY_HOP_HEADERS}
+        headers["Connection"] = "close"
+
+        conn = http.client.HTTPConnection(u.hostname, u.port if u.port is not None else 80, timeout=proxy._timeout)
+        try:
+            try:
+                conn.request(self.command, path, body=body, headers=headers)
+                resp = conn.getresponse()
+            except OSError as e:
+                self.send_error(502, "failed to fetch %s: %s" % (self.path, e))
+                return
+
+            respHeaders = [(k, v) for k, v in resp.getheaders() if k.lower() not in self._HOP_BY_HOP_HEADERS and k.lower() != "content-length"]
+            length = resp.getheader("Content-Length")
+            length = int(length) if length is not None else None
+            if self.command == "HEAD" or resp.status in [204, 304] or 100 <= resp.status < 200:
+                self._sendHead(resp.status, respHeaders, length if length is not None else 0, bodyless=True)
+                proxy._count("uncacheable")
+                return
+
+            # a close-delimited body can't be told from a truncated one, a chunked body has its own end mark
+            cache = cache and resp.status == 200 and self._isCacheableResponse(resp) and (length is not None or resp.chunked)
+            if not cache:
+                proxy._count("uncacheable")
+                self._sendHead(resp.status, respHeaders, length)
+                self._copyStream(resp, self.wfile, length)
+                return
+
+            # save to a temp file while sending to client, the file enters cache only if the whole body is received
+            fd, tmpFile = tempfile.mkstemp(dir=proxy._cacheDir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    self._sendHead(resp.status, respHeaders, length)
+                    n = self._copyStream(resp, self.wfile, length, teeFile=f)
+                if length is None or n == length:            # http.client raises IncompleteRead for a truncated chunked body
+                    proxy._store(self.path, resp.status, respHeaders, tmpFile)
+                proxy._count("miss", n)
+            finally:
+                if os.path.exists(tmpFile):
+                    os.unlink(tmpFile)
+        finally:
+            conn.close()
+
+    def _isCacheableResponse(self, resp):
+        cc = (resp.getheader("Cache-Control") or "").lower()
+        if "no-store" in cc or "private" in cc:
+            return False
+        if resp.getheader("Set-Cookie") is not None:
+            return False
+        return True
+
+    def _sendHead(self, status, headers, length, bodyless=False):
+        self.send_response(status)
+        for k, v in headers:
+            self.send_header(k, v)
+        if length is not None:
+            self.send_header("Content-Length", str(length))
+        elif not bodyless:
+            self.close_connection = True            # body is delimited by connection close
+        self.send_header("Connection", "close" if self.close_connection else "keep-alive")
+        self.end_headers()
+
+    def _copyStream(self, src, dst, length, teeFile=None):
+        n = 0
+        while length is None or n < length:
+            buf = src.read(min(65536, length - n) if length is not None else 65536)
+            if len(buf) == 0:
+                break
+            dst.write(buf)
+            if teeFile is not None:
+                teeFile.write(buf)
+            n += len(buf)
+        return n
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import json
+import zlib
+import struct
+import hashlib
+import threading
+import contextlib
+import concurrent.futures
+from ._util import Util
+from ._errors import DiskImageError
+from ._disk_image import DiskImageUtil, DiskPartitioner, NbdDiskImage
+
+
+class ImageDelta:
+    """
+    Block level delta between two disk images of the same target, so that a rebuilt image is distributed as its changed
+    clusters only. Images can be raw or qcow2, they are compared by their virtual content.
+
+    Clusters in holes of an image are not read, they are regarded as zero, other clusters are hashed in parallel.
+    The delta is either a delta file which is applied by apply(), or a qcow2 overlay with the old image as backing file,
+    which qemu can use directly.
+
+    The digest of an image is sha256 over its size and the sha256 of every cluster. A delta file records the digests of
+    both images, so that apply() refuses a wrong old image and checks the image it produces.
+
+    Layout of delta file (integers are little endian):
+        header      magic(8) version(u32) cluster-size(u32) old-size(u64) new-size(u64) old-digest(32) new-digest(32)
+        record      first-cluster(u64) cluster-count(u32) type(u8) payload-length(u32) payload
+                    type RECORD_DATA: zlib compressed content of the clusters, type RECORD_ZERO: no payload
+        end mark    first-cluster is END_MARK
+    """
+
+    MAGIC = b'WS4DELTA'
+
+    VERSION = 1
+
+    CLUSTER_SIZE = 64 * 1024
+
+    RUN_CLUSTERS = 64               # number of clusters read, hashed or stored as a unit
+
+    RECORD_DATA = 0
+
+    RECORD_ZERO = 1
+
+    END_MARK = 0xFFFFFFFFFFFFFFFF
+
+    _HEADER_FMT = "<8sIIQQ32s32s"
+
+    _RECORD_FMT = "<QIBI"
+
+    _ZERO_HASH = hashlib.sha256(bytes(CLUSTER_SIZE)).digest()
+
+    def __init__(self, max_workers=None):
+        self._maxWorkers = max_workers
+
+    def get_digest(self, image_filepath):
+        """Returns the digest of the virtual content of an image, in hex"""
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._maxWorkers) as executor:
+            [(size, hashList)] = self._hashImages(executor, [image_filepath])
+        return self._getDigest(size, hashList).hex()
+
+    def generate(self, old_filepath, new_filepath, delta_filepath):
+        """Write the delta which turns old image into new image into delta_filepath, returns {"changed-clusters": n, "delta-size": bytes}"""
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._maxWorkers) as executor:
+            [(oldSize, oldHashList), (newSize, newHashList)] = self._hashImages(executor, [old_filepath, new_filepath])
+            runList = self._getChangedRuns(oldHashList, newHashList)
+
+            tmpPath = delta_filepath + ".tmp"
+            try:
+                with _ImageReader(new_filepath) as reader:
+                    with open(tmpPath, "wb") as f:
+                        f.write(struct.pack(self._HEADER_FMT, self.MAGIC, self.VERSION, self.CLUSTER_SIZE, oldSize, newSize,
+                                            self._getDigest(oldSize, oldHashList), self._getDigest(newSize, newHashList)))
+
+                        # compress in parallel, a batch at a time to limit memory usage
+                        batchSize = (self._maxWorkers if self._maxWorkers is not None else os.cpu_count()) * 4
+                        for i in range(0, len(runList), batchSize):
+                            batch = runList[i:i + batchSize]
+                            for (first, count, recordType), payload in zip(batch, executor.map(lambda x: self._getPayload(reader, newSize, *x), batch)):
+                                f.write(struct.pack(self._RECORD_FMT, first, count, recordType, len(payload)))
+                                f.write(payload)
+
+                        f.write(struct.pack(self._RECORD_FMT, self.END_MARK, 0, 0, 0))
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.rename(tmpPath, delta_filepath)
+            finally:
+                if os.path.exists(tmpPath):
+                    os.unlink(tmpPath)
+
+        return {
+            "changed-clusters": sum([x[1] for x in runList]),
+            "delta-size": os.path.getsize(delta_filepath),
+        }
+
+    def generate_overlay(self, old_filepath, new_filepath, overlay_filepath):
+        """Write a qcow2 overlay of old image whose content is the same as new image, returns {"changed-clusters": n}"""
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._maxWorkers) as executor:
+            [(oldSize, oldHashList), (newSize, newHashList)] = self._hashImages(executor, [old_filepath, new_filepath])
+        runList = self._getChangedRuns(oldHashList, newHashList)
+
+        tmpPath = overlay_filepath + ".tmp"
+        try:
+            Util.cmdCall("qemu-img", "create", "-q", "-f", "qcow2", "-o", "cluster_size=%d" % (self.CLUSTER_SIZE),
+                         "-b", os.path.abspath(old_filepath), "-F", DiskImageUtil.getFormat(old_filepath), tmpPath, str(newSize))
+            with _ImageReader(new_filepath) as reader:
+                disk = NbdDiskImage(tmpPath, "qcow2")
+                try:
+                    # zero clusters must be written too, otherwise content of the backing file shows through
+                    for first, count, recordType in runList:
+                        offset, length = self._getRunRange(newSize, first, count)
+                        disk.pwrite(reader.pread(length, offset) if recordType == self.RECORD_DATA else bytes(length), offset)
+                    disk.flush()
+                finally:
+                    disk.close()
+            os.rename(tmpPath, overlay_filepath)
+        finally:
+            if os.path.exists(tmpPath):
+                os.unlink(tmpPath)
+
+        return {
+            "changed-clusters": sum([x[1] for x in runList]),
+        }
+
+    def apply(self, old_filepath, delta_filepath, new_filepath):
+        """Create new image from old image and delta file, DiskImageError is raised if old image does not match or the result is wrong"""
+
+        with open(delta_filepath, "rb") as f:
+            oldSize, newSize, oldDigest, newDigest = self._readHeader(f, delta_filepath)
+            if self.get_digest(old_filepath) != oldDigest.hex():
+                raise DiskImageError("\"%s\" is not the old image of delta \"%s\"" % (old_filepath, delta_filepath))
+
+            tmpPath = new_filepath + ".tmp"
+            try:
+                Util.cloneFile(old_filepath, tmpPath)
+                if newSize != oldSize:
+                    if DiskImageUtil.getFormat(tmpPath) == "raw":
+                        os.truncate(tmpPath, newSize)
+                    else:
+                        Util.cmdCall("qemu-img", "resize", "-q", "--shrink", tmpPath, str(newSize))
+
+                disk = DiskPartitioner.openDiskImage(tmpPath)
+                try:
+                    while True:
+                        first, count, recordType, payloadLen = self._readStruct(f, self._RECORD_FMT, delta_filepath)
+                        if first == self.END_MARK:
+                            break
+                        offset, length = self._getRunRange(newSize, first, count)
+                        if recordType == self.RECORD_DATA:
+                            buf = zlib.decompress(self._readAll(f, payloadLen, delta_filepath))
+                            if len(buf) != length:
+                                raise DiskImageError("invalid record in delta \"%s\"" % (delta_filepath))
+                        elif recordType == self.RECORD_ZERO:
+                            buf = bytes(length)
+                        else:
+                            raise DiskImageError("invalid record in delta \"%s\"" % (delta_filepath))
+                        disk.pwrite(buf, offset)
+                    disk.flush()
+                finally:
+                    disk.close()
+
+                if self.get_digest(tmpPath) != newDigest.hex():
+                    raise DiskImageError("image created from delta \"%s\" does not match the new image" % (delta_filepath))
+                os.rename(tmpPath, new_filepath)
+            finally:
+                if os.path.exists(tmpPath):
+                    os.unlink(tmpPath)
+
+    def verify(self, image_filepath, delta_filepath):
+        """Returns True if the image is the new image of delta file"""
+
+        with open(delta_filepath, "rb") as f:
+            oldSize, newSize, oldDigest, newDigest = self._readHeader(f, delta_filepath)
+        return self.get_digest(image_filepath) == newDigest.hex()
+
+    def _hashImages(self, executor, pathList):
+        # returns [(size, [sha256-of-cluster])], clusters of all the images are hashed by the pool at the same time
+        with contextlib.ExitStack() as stack:
+            jobList = []
+            for path in pathList:
+                reader = stack.enter_context(_ImageReader(path))
+                clusterCount = (reader.size + self.CLUSTER_SIZE - 1) // self.CLUSTER_SIZE
+                futureList = []
+                for first, count in self._getDataRuns(reader.get_data_extents(), clusterCount):
+                    futureList.append((first, executor.submit(self._hashRun, reader, first, count)))
+                jobList.append((reader.size, clusterCount, futureList))
+
+            ret = []
+            for size, clusterCount, futureList in jobList:
+                hashList = [self._ZERO_HASH] * clusterCount
+                for first, future in futureList:
+                    x = future.result()
+                    hashList[first:first + len(x)] = x
+                ret.append((size, hashList))
+            return ret
+
+    def _hashRun(self, reader, first, count):
+        offset, length = self._getRunRange(reader.size, first, count)
+        buf = reader.pread(length, offset)
+        if len(buf) != length:
+            raise DiskImageError("failed to read \"%s\" at offset %d" % (reader.path, offset))
+        ret = []
+        for i in range(0, count):
+            data = buf[i * self.CLUSTER_SIZE:(i + 1) * self.CLUSTER_SIZE]
+            if len(data) < self.CLUSTER_SIZE:
+                data += bytes(self.CLUSTER_SIZE - len(data))            # the last cluster is padded with zero
+            ret.append(hashlib.sha256(data).digest())
+        return ret
+
+    def _getDataRuns(self, extentList, clusterCount):
+        # returns [(first-cluster, cluster-count)] covering all the clusters which have data, no run is longer than RUN_CLUSTERS
+        clusterSet = set()
+        for start, end in extentList:
+            clusterSet.update(range(start // self.CLUSTER_SIZE, min((end + self.CLUSTER_SIZE - 1) // self.CLUSTER_SIZE, clusterCount)))
+        return self._getRuns(sorted(clusterSet))
+
+    def _getChangedRuns(self, oldHashList, newHashList):
+        # returns [(first-cluster, cluster-count, record-type)], a run consists of clusters of the same record type
+        zeroList = []
+        dataList = []
+        for i in range(0, len(newHashList)):
+            oldHash = oldHashList[i] if i < len(oldHashList) else self._ZERO_HASH
+            if newHashList[i] != oldHash:
+                if newHashList[i] == self._ZERO_HASH:
+                    zeroList.append(i)
+                else:
+                    dataList.append(i)
+        ret = [(first, count, self.RECORD_DATA) for first, count in self._getRuns(dataList)]
+        ret += [(first, count, self.RECORD_ZERO) for first, count in self._getRuns(zeroList)]
+        return sorted(ret)
+
+    def _getRuns(self, clusterList):
+        ret = []
+        for i in clusterList:
+            if len(ret) > 0 and ret[-1][0] + ret[-1][1] == i and ret[-1][1] < self.RUN_CLUSTERS:
+                ret[-1][1] += 1
+            else:
+                ret.append([i, 1])
+        return [tuple(x) for x in ret]
+
+    def _getRunRange(self, size, first, count):
+        # returns (offset, length) of a run, the last cluster of the image may be partial
+        offset = first * self.CLUSTER_SIZE
+        return (offset, min(count * self.CLUSTER_SIZE, size - offset))
+
+    def _getPayload(self, reader, size, first, count, recordType):
+        if recordType == self.RECORD_ZERO:
+            return b''
+        offset, length = self._getRunRange(size, first, count)
+        return zlib.compress(reader.pread(length, offset))
+
+    def _getDigest(self, size, hashList):
+        h = hashlib.sha256()
+        h.update(struct.pack("<QI", size, self.CLUSTER_SIZE))
+        for x in hashList:
+            h.update(x)
+        return h.digest()
+
+    def _readHeader(self, f, path):
+        # returns (old-size, new-size, old-digest, new-digest)
+        magic, version, clusterSize, oldSize, newSize, oldDigest, newDigest = self._readStruct(f, self._HEADER_FMT, path)
+        if magic != self.MAGIC:
+            raise DiskImageError("\"%s\" is not a delta file" % (path))
+        if version != self.VERSION or clusterSize != self.CLUSTER_SIZE:
+            raise DiskImageError("unsupported delta \"%s\", version %d, cluster size %d" % (path, version, clusterSize))
+        return (oldSize, newSize, oldDigest, newDigest)
+
+    def _readStruct(self, f, fmt, path):
+        return struct.unpack(fmt, self._readAll(f, struct.calcsize(fmt), path))
+
+    def _readAll(self, f, length, path):
+        buf = f.read(length)
+        if len(buf) != length:
+            raise DiskImageError("delta \"%s\" is truncated" % (path))
+        return buf
+
+
+class _ImageReader:
+    """
+    Thread-safe reader of the virtual content of a disk image.
+    Raw images are read by pread concurrently, qcow2 images are read through one qemu-nbd connection in turn.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._format = DiskImageUtil.getFormat(path)
+        if self._format == "raw":
+            self._fd = os.open(path, os.O_RDONLY)
+            self._size = os.fstat(self._fd).st_size
+            self._nbd = None
+        else:
+            # allocation map must be got before qemu-nbd locks the image
+            self._extentList = self._getQemuDataExtents()
+            self._fd = None
+            self._nbd = NbdDiskImage(path, self._format)
+            self._size = self._nbd.size
+            self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def size(self):
+        return self._size
+
+    def get_data_extents(self):
+        """Returns [(start, end)], content out of these extents is zero"""
+
+        if self._nbd is not None:
+            return self._extentList
+
+        ret = []
+        pos = 0
+        while pos < self._size:
+            try:
+                start = os.lseek(self._fd, pos, os.SEEK_DATA)
+            except OSError:
+                break                                   # no more data
+            end = os.lseek(self._fd, start, os.SEEK_HOLE)
+            ret.append((start, end))
+            pos = end
+        return ret
+
+    def pread(self, length, offset):
+        if self._nbd is None:
+            ret = b''
+            while len(ret) < length:
+                buf = os.pread(self._fd, length - len(ret), offset + len(ret))
+                if len(buf) == 0:
+                    break
+                ret += buf
+            return ret
+        with self._lock:
+            return self._nbd.pread(length, offset)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._nbd is not None:
+            self._nbd.close()
+            self._nbd = None
+
+    def _getQemuDataExtents(self):
+        ret = []
+        for item in json.loads(Util.cmdCall("qemu-img", "map", "--output=json", "-f", self._format, self._path)):
+            if item["data"] and not item.get("zero", False):
+                ret.append((item["start"], item["start"] + item["length"]))
+        return ret
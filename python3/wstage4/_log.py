@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import gzip
+import time
+import queue
+import atexit
+import shutil
+import threading
+import contextvars
+
+
+class BuildLog:
+    """
+    Log files of one build, written by a background thread so that writers never block.
+
+    Every channel is a file in log directory, it is rotated when exceeding max_size and the rotated ones are gzip compressed:
+        <name>.log, <name>.log.1.gz, ... <name>.log.<backup_count>.gz
+    Data is dropped (with a mark in the log) if the writer thread falls behind by more than max_pending bytes.
+    """
+
+    # a context variable instead of a thread local, so that concurrent builds in one asyncio event loop are kept apart
+    _current = contextvars.ContextVar("wstage4_build_log", default=None)
+
+    def __init__(self, dirpath, max_size=64 * 1024 * 1024, backup_count=5, max_pending=16 * 1024 * 1024):
+        self._dirpath = dirpath
+        self._maxSize = max_size
+        self._backupCount = backup_count
+        self._maxPending = max_pending
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._dropped = dict()                  # channel-name -> bytes dropped
+        self._files = dict()                    # channel-name -> file object, accessed by writer thread only
+        self._queue = queue.Queue()
+
+        os.makedirs(self._dirpath, exist_ok=True)
+        self._thread = threading.Thread(target=self._writerThread, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @property
+    def path(self):
+        return self._dirpath
+
+    @classmethod
+    def get_current(cls):
+        """Returns the BuildLog of the build running in current thread or asyncio task, can be None"""
+        return cls._current.get()
+
+    @classmethod
+    def set_current(cls, build_log):
+        cls._current.set(build_log)
+
+    def write(self, name, buf):
+        """Queue buf for channel name, never blocks"""
+
+        if isinstance(buf, str):
+            buf = buf.encode("utf-8", "replace")
+        if len(buf) == 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                return
+            if self._pending + len(buf) > self._maxPending:
+                self._dropped[name] = self._dropped.get(name, 0) + len(buf)
+                return
+            self._pending += len(buf)
+        self._queue.put((name, buf))
+
+    def get_channel(self, name):
+        return _Channel(self, name)
+
+    def close(self):
+        with self._lock:
+            t = self._thread
+            self._thread = None
+        if t is not None:
+            self._queue.put(None)
+            t.join()
+            atexit.unregister(self.close)
+
+    def _writerThread(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            name, buf = item
+            with self._lock:
+                self._pending -= len(buf)
+                dropped = self._dropped.pop(name, 0)
+            if dropped > 0:
+                self._writeFile(name, ("\n[wstage4: %d bytes dropped, log writer fell behind]\n" % (dropped)).encode("utf-8"))
+            self._writeFile(name, buf)
+
+            # flush when idle, so that logs are readable while the build runs
+            if self._queue.empty():
+                for f in self._files.values():
+                    f.flush()
+
+        for f in self._files.values():
+            f.close()
+        self._files = dict()
+
+    def _writeFile(self, name, buf):
+        fullfn = os.path.join(self._dirpath, name + ".log")
+        if name not in self._files:
+            self._files[name] = open(fullfn, "ab")
+        f = self._files[name]
+        f.write(buf)
+        if f.tell() >= self._maxSize:
+            f.close()
+            del self._files[name]
+            self._rotate(fullfn)
+
+    def _rotate(self, fullfn):
+        # compressing is done in writer thread too, writers only see a longer queue
+        for i in range(self._backupCount - 1, 0, -1):
+            if os.path.exists("%s.%d.gz" % (fullfn, i)):
+                os.rename("%s.%d.gz" % (fullfn, i), "%s.%d.gz" % (fullfn, i + 1))
+        if self._backupCount > 0:
+            with open(fullfn, "rb") as src:
+                with gzip.open("%s.1.gz.tmp" % (fullfn), "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            os.rename("%s.1.gz.tmp" % (fullfn), "%s.1.gz" % (fullfn))
+        os.unlink(fullfn)
+
+
+class StreamPump:
+    """
+    Copy data from a file object (pipe or socket) into a log channel in a background thread, optionally also to another stream.
+    """
+
+    def __init__(self, readFunc, channel, teeStream=None):
+        self._readFunc = readFunc
+        self._channel = channel
+        self._teeStream = teeStream
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            try:
+                buf = self._readFunc()
+            except (OSError, ValueError):
+                break
+            if not buf:
+                break
+            if self._channel is not None:
+                self._channel.write(buf)
+            if self._teeStream is not None:
+                try:
+                    self._teeStream.write(buf)
+                    self._teeStream.flush()
+                except (OSError, ValueError):
+                    pass
+
+
+class _Channel:
+
+    def __init__(self, buildLog, name):
+        self._buildLog = buildLog
+        self._name = name
+
+    def write(self, buf):
+        self._buildLog.write(self._name, buf)
+
+    def write_line(self, line):
+        self._buildLog.write(self._name, "%s %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), line))
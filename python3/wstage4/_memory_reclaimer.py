@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import asyncio
+import threading
+from ._errors import VmError
+from ._vm import Vm, VmUtil
+
+
+class MemoryReclaimer:
+    """
+    Host side policy for the virtio-balloon device of a running VM, guest memory which stays idle is taken back by host.
+
+    Memory statistics are reported by the balloon driver in guest. The balloon is inflated to leave keep_free bytes of
+    free memory in guest once free memory stays above that for idle_samples samples, but the guest never gets less than
+    min_size bytes. The balloon is deflated by keep_free bytes as soon as free memory drops below half of keep_free.
+    Nothing is done if the guest has no balloon driver.
+
+    Memory taken back by all the running reclaimers is reported by get_host_memory_savings().
+    """
+
+    STATS_INTERVAL = 2              # in seconds, interval of guest reporting statistics
+
+    RESIZE_THRESHOLD = 64 * 1024 * 1024
+
+    _activeSet = set()
+    _activeLock = threading.Lock()
+
+    def __init__(self, vm, interval=10, keep_free=512 * 1024 * 1024, min_size=512 * 1024 * 1024, idle_samples=3):
+        assert vm.has_memory_balloon()
+
+        self._vm = vm
+        self._interval = interval
+        self._keepFree = keep_free
+        self._minSize = min_size
+        self._idleSamples = idle_samples
+
+        self._idleCount = 0
+        self._reclaimed = 0
+        self._peakReclaimed = 0
+        self._thread = None
+        self._stopEvent = None
+
+    def start(self):
+        """Run the policy in a background thread, for VM driven by the blocking methods"""
+
+        assert self._thread is None
+        self._stopEvent = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopEvent.set()
+            self._thread.join()
+            self._thread = None
+            self._stopEvent = None
+
+    async def async_run(self):
+        """Run the policy until the VM stops, for VM driven by the async_* methods, cancel the task to stop"""
+
+        self._register()
+        try:
+            qmp = await self._vm.async_get_qmp()
+            await qmp.command("qom-set", path=Vm.BALLOON_PATH, property="guest-stats-polling-interval", value=self.STATS_INTERVAL)
+            while True:
+                await asyncio.sleep(self._interval)
+                if not self._vm.is_running():
+                    break
+                try:
+                    qmp = await self._vm.async_get_qmp()
+                    actual = (await qmp.command("query-balloon"))["actual"]
+                    stats = await qmp.command("qom-get", path=Vm.BALLOON_PATH, property="guest-stats")
+                    target = self._decide(actual, stats)
+                    if target is not None:
+                        await qmp.command("balloon", value=target)
+                except (VmError, OSError):
+                    break
+        except (VmError, OSError):
+            pass
+        finally:
+            self._unregister()
+
+    def get_reclaimed(self):
+        """Returns number of bytes currently taken back from the guest"""
+        return self._reclaimed
+
+    def get_peak_reclaimed(self):
+        return self._peakReclaimed
+
+    def _run(self):
+        self._register()
+        try:
+            try:
+                self._vm.qmp_command("qom-set", path=Vm.BALLOON_PATH, property="guest-stats-polling-interval", value=self.STATS_INTERVAL)
+            except (VmError, OSError):
+                return
+            while not self._stopEvent.wait(self._interval):
+                try:
+                    actual = self._vm.qmp_command("query-balloon")["actual"]
+                    stats = self._vm.qmp_command("qom-get", path=Vm.BALLOON_PATH, property="guest-stats")
+                    target = self._decide(actual, stats)
+                    if target is not None:
+                        self._vm.qmp_command("balloon", value=target)
+                except (VmError, OSError):
+                    break
+        finally:
+            self._unregister()
+
+    def _decide(self, actual, stats):
+        # returns the new balloon target in bytes, None if it needs not to be changed
+        maxSize = self._vm.get_memory_size()
+        self._reclaimed = maxSize - actual
+        self._peakReclaimed = max(self._peakReclaimed, self._reclaimed)
+
+        # statistics are never updated if there's no balloon driver or its statistics service in guest
+        free = stats["stats"].get("stat-free-memory", -1)
+        if stats.get("last-update", 0) == 0 or free < 0:
+            return None
+
+        if free < self._keepFree // 2:
+            self._idleCount = 0
+            target = min(maxSize, actual + self._keepFree)
+        elif free > self._keepFree + self.RESIZE_THRESHOLD:
+            self._idleCount += 1
+            if self._idleCount < self._idleSamples:
+                return None
+            target = max(self._minSize, actual - (free - self._keepFree))
+        else:
+            self._idleCount = 0
+            return None
+
+        if abs(target - actual) < self.RESIZE_THRESHOLD:
+            return None
+        return target
+
+    def _register(self):
+        with self._activeLock:
+            self._activeSet.add(self)
+
+    def _unregister(self):
+        with self._activeLock:
+            self._activeSet.discard(self)
+
+
+def get_host_memory_savings():
+    """
+    Returns {"ksm-running": bool, "merged": bytes, "reclaimed": bytes}.
+    "merged" is the memory saved by KSM on the whole host, "reclaimed" is the memory taken back by running MemoryReclaimers of this process.
+    """
+
+    ret = {
+        "ksm-running": False,
+        "merged": 0,
+        "reclaimed": 0,
+    }
+    try:
+        with open(os.path.join(VmUtil.KSM_DIR, "run"), "r") as f:
+            ret["ksm-running"] = (int(f.read().strip()) == 1)
+        with open(os.path.join(VmUtil.KSM_DIR, "pages_sharing"), "r") as f:
+            ret["merged"] = int(f.read().strip()) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+    with MemoryReclaimer._activeLock:
+        ret["reclaimed"] = sum([x.get_reclaimed() for x in MemoryReclaimer._activeSet])
+    return ret
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import re
+import select
+import tempfile
+import threading
+from ._util import Util
+
+
+class MountTableEntry:
+
+    def __init__(self):
+        self.mnt_id = None
+        self.dev_id = None              # "major:minor"
+        self.root = None
+        self.mnt_point = None
+        self.mnt_opts = None
+        self.fs_type = None
+        self.device = None
+        self.super_opts = None
+
+
+class MountTable:
+    """
+    Index of /proc/self/mountinfo keyed by mount point and device.
+    The file is re-parsed only when the kernel signals a change, which it does by POLLPRI|POLLERR on the open file.
+    """
+
+    _instance = None
+    _instanceLock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._instanceLock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self, path="/proc/self/mountinfo"):
+        self._lock = threading.Lock()
+        self._f = open(path, "rb", buffering=0)
+        self._poll = select.poll()
+        self._poll.register(self._f, select.POLLPRI | select.POLLERR)
+        self._entries = []
+        self._byMountPoint = dict()
+        self._byDevice = dict()
+        self._parse()
+
+    def close(self):
+        self._poll.unregister(self._f)
+        self._f.close()
+
+    def get_entries(self):
+        with self._lock:
+            self._refresh()
+            return list(self._entries)
+
+    def find_entry_by_mount_point(self, mount_point):
+        # the last one wins if a mount point is mounted several times
+        with self._lock:
+            self._refresh()
+            return self._byMountPoint.get(os.path.normpath(mount_point))
+
+    def find_entries_by_device(self, device):
+        with self._lock:
+            self._refresh()
+            return list(self._byDevice.get(device, []))
+
+    def is_mount(self, mount_point):
+        return self.find_entry_by_mount_point(mount_point) is not None
+
+    @staticmethod
+    def mount_batch(param_list):
+        """Mount all of (fs_type, mnt_opts, target, mount_point) in param_list in order, with one mount process"""
+
+        if len(param_list) == 0:
+            return
+        with tempfile.NamedTemporaryFile("w", prefix="wstage4-fstab-") as f:
+            for fsType, mntOpts, target, mountPoint in param_list:
+                f.write("%s %s %s %s 0 0\n" % (_escape(target), _escape(mountPoint), fsType, mntOpts if mntOpts != "" else "defaults"))
+            f.flush()
+            Util.cmdCall("mount", "--fstab", f.name, "-a")
+
+    @staticmethod
+    def umount_batch(mount_point_list):
+        """Unmount all of mount_point_list in order, with one umount process"""
+
+        if len(mount_point_list) == 0:
+            return
+        Util.cmdCall("umount", *mount_point_list)
+
+    def _refresh(self):
+        if len(self._poll.poll(0)) > 0:
+            self._parse()
+
+    def _parse(self):
+        # reading from the start clears the pending change event
+        os.lseek(self._f.fileno(), 0, os.SEEK_SET)
+        buf = b''
+        while True:
+            data = self._f.read(65536)
+            if not data:
+                break
+            buf += data
+
+        entries = []
+        byMountPoint = dict()
+        byDevice = dict()
+        for line in buf.decode("utf-8", "replace").split("\n"):
+            if line == "":
+                continue
+            left, right = line.split(" - ", 1)
+            left = left.split(" ")
+            right = right.split(" ")
+
+            item = MountTableEntry()
+            item.mnt_id = int(left[0])
+            item.dev_id = left[2]
+            item.root = _unescape(left[3])
+            item.mnt_point = _unescape(left[4])
+            item.mnt_opts = left[5]
+            item.fs_type = right[0]
+            item.device = _unescape(right[1])
+            item.super_opts = right[2] if len(right) > 2 else ""
+
+            entries.append(item)
+            byMountPoint[item.mnt_point] = item
+            byDevice.setdefault(item.device, []).append(item)
+
+        self._entries = entries
+        self._byMountPoint = byMountPoint
+        self._byDevice = byDevice
+
+
+def _escape(s):
+    return s.replace("\\", "\\134").replace(" ", "\\040").replace("\t", "\\011").replace("\n", "\\012")
+
+
+def _unescape(s):
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), s)
@@ -23,6 +23,9 @@
 
 import os
 import abc
+import hashlib
+import pathlib
+import tempfile
 
 
 class WindowsInstallIsoFile:
@@ -60,7 +63,7 @@ class StorageLayout:
 
         if len(disk_list) == 1:
             from ._win_storage_layouts import StorageLayouts
-            return StorageLayouts().get_storage_layout("ntfs-sys-win")._create_and_mount(disk_list, base_dir)
+            return StorageLayouts.getStorageLayoutClass("ntfs-sys-win")._mount(disk_list, base_dir)
         else:
             assert False
 
@@ -70,7 +73,14 @@ class StorageLayout:
         assert base_dir.startswith("/") and len(os.listdir(base_dir)) == 0
 
         from ._win_storage_layouts import StorageLayouts
-        return StorageLayouts().get_storage_layout(name)._create_and_mount(boot_mode, disk_list, base_dir)
+        return StorageLayouts.getStorageLayoutClass(name)._create_and_mount(disk_list, base_dir)
+
+    @classmethod
+    def create(cls, name, disk_list):
+        assert len(disk_list) > 0
+
+        from ._win_storage_layouts import StorageLayouts
+        StorageLayouts.getStorageLayoutClass(name)._create(disk_list)
 
     @property
     @abc.abstractmethod
@@ -100,6 +110,11 @@ class StorageLayout:
     def _mount(cls, disk_list, base_dir):
         pass
 
+    @classmethod
+    @abc.abstractmethod
+    def _create(cls, disk_list):
+        pass
+
     @classmethod
     @abc.abstractmethod
     def _create_and_mount(cls, disk_list, base_dir):
@@ -130,6 +145,23 @@ class ScriptInChroot(abc.ABC):
     def get_script(self):
         pass
 
+    def get_digest(self):
+        """Content digest of the script, covers the script name and all files placed by fill_script_dir()"""
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            self.fill_script_dir(tmpDir)
+            h = hashlib.sha256()
+            h.update(("script %s\n" % (self.get_script())).encode("utf-8"))
+            for fullfn in sorted(pathlib.Path(tmpDir).rglob("*")):
+                relPath = str(fullfn.relative_to(tmpDir))
+                if fullfn.is_symlink():
+                    h.update(("link %s %s\n" % (relPath, os.readlink(fullfn))).encode("utf-8"))
+                elif fullfn.is_dir():
+                    h.update(("dir %s %o\n" % (relPath, fullfn.stat().st_mode)).encode("utf-8"))
+                else:
+                    h.update(("file %s %o %s\n" % (relPath, fullfn.stat().st_mode, _fileSha256(str(fullfn)))).encode("utf-8"))
+            return h.hexdigest()
+
     def __eq__(self, other):
         if not isinstance(other, ScriptInChroot):
             return False
@@ -139,3 +171,14 @@ class ScriptInChroot(abc.ABC):
 
     def __ne__(self, other):
         return (not self.__eq__(other))
+
+
+def _fileSha256(filepath):
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while True:
+            buf = f.read(1024 * 1024)
+            if len(buf) == 0:
+                break
+            h.update(buf)
+    return h.hexdigest()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import json
+import time
+import socket
+import asyncio
+import threading
+from ._errors import VmError
+
+
+class QmpClient:
+    """
+    Minimal client of QEMU Machine Protocol, events received while waiting for command replies are queued.
+    Commands can be issued from several threads.
+    """
+
+    def __init__(self, port, timeout=30):
+        self._sock = None
+        self._lock = threading.Lock()
+        self._timeout = timeout
+        self._buf = bytearray()
+        self._events = []
+
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self._sock = socket.create_connection(("127.0.0.1", port), timeout=timeout)
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() >= deadline:
+                    raise VmError("failed to connect to QMP port %d" % (port))
+                time.sleep(0.2)
+
+        if "QMP" not in self._recvMsg():
+            raise VmError("invalid QMP greeting")
+        self.command("qmp_capabilities")
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def command(self, name, **arguments):
+        msg = {"execute": name}
+        if len(arguments) > 0:
+            msg["arguments"] = arguments
+        with self._lock:
+            if self._sock is None:
+                raise VmError("QMP connection closed")
+            self._sock.sendall((json.dumps(msg) + "\n").encode("utf-8"))
+            while True:
+                msg = self._recvMsg()
+                if "event" in msg:
+                    self._events.append(msg)
+                elif "error" in msg:
+                    raise VmError("QMP command %s failed, %s" % (name, msg["error"].get("desc", "")))
+                elif "return" in msg:
+                    return msg["return"]
+
+    def get_events(self, name=None):
+        """Returns and removes the queued events, only those named name if it is not None"""
+
+        ret = [x for x in self._events if name is None or x["event"] == name]
+        self._events = [x for x in self._events if x not in ret]
+        return ret
+
+    def wait_event(self, name, timeout=None):
+        deadline = (time.monotonic() + timeout) if timeout is not None else None
+        while True:
+            ret = self.get_events(name)
+            if len(ret) > 0:
+                return ret[0]
+            if deadline is not None:
+                remain = deadline - time.monotonic()
+                if remain <= 0:
+                    raise VmError("timeout waiting for QMP event %s" % (name))
+                self._sock.settimeout(remain)
+            else:
+                self._sock.settimeout(None)
+            try:
+                msg = self._recvMsg()
+                if "event" in msg:
+                    self._events.append(msg)
+            except socket.timeout:
+                raise VmError("timeout waiting for QMP event %s" % (name))
+            finally:
+                self._sock.settimeout(self._timeout)
+
+    def recv_event(self):
+        """Blocks until next event is received, returns it"""
+
+        ret = self.get_events()
+        if len(ret) > 0:
+            self._events = ret[1:] + self._events
+            return ret[0]
+        self._sock.settimeout(None)
+        try:
+            while True:
+                msg = self._recvMsg()
+                if "event" in msg:
+                    return msg
+        finally:
+            self._sock.settimeout(self._timeout)
+
+    def _recvMsg(self):
+        while True:
+            i = self._buf.find(b'\n')
+            if i >= 0:
+                line = bytes(self._buf[:i])
+                del self._buf[:i + 1]
+                if line.strip() != b'':
+                    return json.loads(line.decode("utf-8"))
+                continue
+            data = self._sock.recv(65536)
+            if len(data) == 0:
+                raise VmError("QMP connection closed")
+            self._buf += data
+
+
+class AsyncQmpClient:
+    """
+    asyncio counterpart of QmpClient, a reader task dispatches replies by command id and queues events,
+    so several tasks can issue commands and wait events on one connection at the same time.
+
+    Events can be consumed with "async for event in client".
+    """
+
+    def __init__(self, reader, writer, timeout):
+        # use AsyncQmpClient.connect() instead
+        self._reader = reader
+        self._writer = writer
+        self._timeout = timeout
+        self._nextId = 0
+        self._pending = dict()                  # command-id -> future of reply
+        self._events = []
+        self._eventArrived = asyncio.Event()
+        self._closeError = None
+        self._readTask = None
+
+    @classmethod
+    async def connect(cls, port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=16 * 1024 * 1024)
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() >= deadline:
+                    raise VmError("failed to connect to QMP port %d" % (port))
+                await asyncio.sleep(0.2)
+
+        ret = cls(reader, writer, timeout)
+        try:
+            try:
+                greeting = await asyncio.wait_for(ret._recvMsg(), timeout)
+            except asyncio.TimeoutError:
+                raise VmError("timeout waiting for QMP greeting")
+            if "QMP" not in greeting:
+                raise VmError("invalid QMP greeting")
+            ret._readTask = asyncio.ensure_future(ret._readLoop())
+            await ret.command("qmp_capabilities")
+        except BaseException:
+            ret.close()
+            raise
+        return ret
+
+    def close(self):
+        if self._readTask is not None:
+            self._readTask.cancel()
+            self._readTask = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._setClosed(VmError("QMP connection closed"))
+
+    async def command(self, name, **arguments):
+        if self._closeError is not None:
+            raise self._closeError
+
+        self._nextId += 1
+        msgId = "wstage4-%d" % (self._nextId)
+        msg = {"execute": name, "id": msgId}
+        if len(arguments) > 0:
+            msg["arguments"] = arguments
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[msgId] = future
+        try:
+            self._writer.write((json.dumps(msg) + "\n").encode("utf-8"))
+            await self._writer.drain()
+            try:
+                msg = await asyncio.wait_for(future, self._timeout)
+            except asyncio.TimeoutError:
+                raise VmError("timeout waiting for reply of QMP command %s" % (name))
+        finally:
+            self._pending.pop(msgId, None)
+
+        if "error" in msg:
+            raise VmError("QMP command %s failed, %s" % (name, msg["error"].get("desc", "")))
+        return msg["return"]
+
+    def get_events(self, name=None):
+        """Returns and removes the queued events, only those named name if it is not None"""
+
+        ret = [x for x in self._events if name is None or x["event"] == name]
+        self._events = [x for x in self._events if x not in ret]
+        return ret
+
+    async def wait_event(self, name, timeout=None):
+        try:
+            return await asyncio.wait_for(self._waitEvent(name), timeout)
+        except asyncio.TimeoutError:
+            raise VmError("timeout waiting for QMP event %s" % (name))
+
+    async def recv_event(self):
+        """Waits until next event is received, returns it"""
+        return await self._waitEvent(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._waitEvent(None)
+        except VmError:
+            raise StopAsyncIteration
+
+    async def _waitEvent(self, name):
+        while True:
+            for i, msg in enumerate(self._events):
+                if name is None or msg["event"] == name:
+                    del self._events[i]
+                    return msg
+            if self._closeError is not None:
+                raise self._closeError
+            self._eventArrived.clear()
+            await self._eventArrived.wait()
+
+    async def _readLoop(self):
+        try:
+            while True:
+                msg = await self._recvMsg()
+                if "event" in msg:
+                    self._events.append(msg)
+                    self._eventArrived.set()
+                elif msg.get("id") in self._pending:
+                    future = self._pending[msg["id"]]
+                    if not future.done():
+                        future.set_result(msg)
+        except (VmError, OSError, ValueError) as e:
+            self._setClosed(e if isinstance(e, VmError) else VmError("QMP connection failed, %s" % (e)))
+
+    async def _recvMsg(self):
+        while True:
+            line = await self._reader.readline()
+            if line == b'':
+                raise VmError("QMP connection closed")
+            if line.strip() != b'':
+                return json.loads(line.decode("utf-8"))
+
+    def _setClosed(self, error):
+        if self._closeError is None:
+            self._closeError = error
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(self._closeError)
+        self._eventArrived.set()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+from ._errors import VmError
+
+
+class ScreenMonitor:
+    """
+    Watch the screen of a running VM by periodic QMP screendump, to detect a guest which waits for input nobody will give.
+
+    A small perceptual hash is computed for every frame, the screen is considered unchanged as long as the hash stays
+    close to the one of the last changed frame, so blinking cursors and clocks do not count as activity.
+    The guest is considered failed if the screen is unchanged for stuck_timeout seconds, or if the screen matches one of
+    the reference screens, which are PPM files (frames saved by previous runs can be used directly) in reference_dir.
+
+    Recently changed frames and the failing frame are saved into frame_dir if it is not None.
+    The VM is powered off (without shutting down the guest) when failure is detected.
+    """
+
+    HASH_SIZE = 16                  # the hash has HASH_SIZE * HASH_SIZE bits
+
+    CHANGE_THRESHOLD = 4            # hamming distance above which the screen is considered changed
+
+    MATCH_THRESHOLD = 12            # hamming distance below which the screen is considered matching a reference screen
+
+    KEEP_FRAMES = 10
+
+    def __init__(self, vm, interval=10, stuck_timeout=30 * 60, reference_dir=None, frame_dir=None):
+        self._vm = vm
+        self._interval = interval
+        self._stuckTimeout = stuck_timeout
+        self._frameDir = frame_dir
+
+        self._refList = []              # [(name, hash)]
+        if reference_dir is not None:
+            for fn in sorted(os.listdir(reference_dir)):
+                if fn.endswith(".ppm"):
+                    width, height, pixels = ScreenUtil.readPpm(os.path.join(reference_dir, fn))
+                    self._refList.append((fn[:-len(".ppm")], ScreenUtil.getHash(width, height, pixels, self.HASH_SIZE)))
+        if self._frameDir is not None:
+            os.makedirs(self._frameDir, exist_ok=True)
+
+        self._tmpDir = None
+        self._lastHash = None
+        self._lastChangeTime = None
+        self._frameCount = 0
+        self._failure = None
+        self._thread = None
+        self._stopEvent = None
+
+    def start(self):
+        """Sample in a background thread, for VM driven by the blocking methods"""
+
+        assert self._thread is None
+        self._stopEvent = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopEvent.set()
+            self._thread.join()
+            self._thread = None
+            self._stopEvent = None
+
+    async def async_run(self):
+        """Sample until the VM stops or failure is detected, for VM driven by the async_* methods, cancel the task to stop"""
+
+        self._initSampling()
+        try:
+            while True:
+                await asyncio.sleep(self._interval)
+                if not self._vm.is_running():
+                    break
+                try:
+                    qmp = await self._vm.async_get_qmp()
+                    await qmp.command("screendump", filename=self._getScreenFile())
+                except (VmError, OSError):
+                    break
+                if await asyncio.to_thread(self._check):
+                    try:
+                        await qmp.command("quit")
+                    except (VmError, OSError):
+                        pass
+                    break
+        finally:
+            self._finiSampling()
+
+    def get_unchanged_time(self):
+        """Returns seconds since the screen was last changed, None if no frame is sampled yet"""
+
+        if self._lastChangeTime is None:
+            return None
+        return time.monotonic() - self._lastChangeTime
+
+    def get_failure(self):
+        """Returns description of the detected failure, None if no failure is detected"""
+        return self._failure
+
+    def _run(self):
+        self._initSampling()
+        try:
+            while not self._stopEvent.wait(self._interval):
+                try:
+                    self._vm.qmp_command("screendump", filename=self._getScreenFile())
+                except (VmError, OSError):
+                    break
+                if self._check():
+                    try:
+                        self._vm.qmp_command("quit")
+                    except (VmError, OSError):
+                        pass
+                    break
+        finally:
+            self._finiSampling()
+
+    def _initSampling(self):
+        self._tmpDir = tempfile.mkdtemp(prefix="wstage4-screen-")
+        self._lastHash = None
+        self._lastChangeTime = time.monotonic()
+
+    def _finiSampling(self):
+        shutil.rmtree(self._tmpDir)
+        self._tmpDir = None
+
+    def _getScreenFile(self):
+        return os.path.join(self._tmpDir, "screen.ppm")
+
+    def _check(self):
+        # returns True if failure is detected
+        width, height, pixels = ScreenUtil.readPpm(self._getScreenFile())
+        curHash = ScreenUtil.getHash(width, height, pixels, self.HASH_SIZE)
+        curTime = time.monotonic()
+
+        if self._lastHash is None or ScreenUtil.getDistance(curHash, self._lastHash) > self.CHANGE_THRESHOLD:
+            self._lastHash = curHash
+            self._lastChangeTime = curTime
+            self._saveFrame("frame-%06d" % (self._frameCount))
+            self._frameCount += 1
+            if self._frameDir is not None and self._frameCount > self.KEEP_FRAMES:
+                fullfn = os.path.join(self._frameDir, "frame-%06d.ppm" % (self._frameCount - self.KEEP_FRAMES - 1))
+                if os.path.exists(fullfn):
+                    os.unlink(fullfn)
+
+        for name, refHash in self._refList:
+            if ScreenUtil.getDistance(curHash, refHash) < self.MATCH_THRESHOLD:
+                self._failure = "screen matches known error screen \"%s\"" % (name)
+                self._saveFrame("failure-%s" % (name))
+                return True
+
+        if curTime - self._lastChangeTime >= self._stuckTimeout:
+            self._failure = "screen unchanged for %d seconds" % (curTime - self._lastChangeTime)
+            self._saveFrame("failure-stuck")
+            return True
+
+        return False
+
+    def _saveFrame(self, name):
+        if self._frameDir is not None:
+            shutil.copyfile(self._getScreenFile(), os.path.join(self._frameDir, name + ".ppm"))
+
+
+class ScreenUtil:
+
+    SAMPLES_PER_CELL = 8            # sample SAMPLES_PER_CELL * SAMPLES_PER_CELL pixels in each cell, instead of all
+
+    @staticmethod
+    def readPpm(filepath):
+        """Returns (width, height, rgb-pixels) of a binary PPM file, which is the format of QMP screendump"""
+
+        with open(filepath, "rb") as f:
+            buf = f.read()
+
+        # header is "P6 <width> <height> <maxval>" separated by whitespaces, followed by one whitespace and pixel data
+        fields = []
+        i = 0
+        while len(fields) < 4:
+            while i < len(buf) and buf[i:i + 1].isspace():
+                i += 1
+            if buf[i:i + 1] == b'#':
+                while i < len(buf) and buf[i:i + 1] != b'\n':
+                    i += 1
+                continue
+            j = i
+            while j < len(buf) and not buf[j:j + 1].isspace():
+                j += 1
+            if j == i:
+                raise VmError("invalid PPM file %s" % (filepath))
+            fields.append(buf[i:j])
+            i = j
+        if fields[0] != b'P6' or int(fields[3]) > 255:
+            raise VmError("unsupported PPM file %s" % (filepath))
+
+        width, height = int(fields[1]), int(fields[2])
+        pixels = memoryview(buf)[i + 1:]
+        if len(pixels) < width * height * 3:
+            raise VmError("truncated PPM file %s" % (filepath))
+        return (width, height, pixels)
+
+    @staticmethod
+    def getHash(width, height, pixels, hashSize):
+        """Difference hash: the frame is shrunk to (hashSize + 1) x hashSize gray cells, each bit tells if a cell is darker than its right neighbor"""
+
+        cols, rows = hashSize + 1, hashSize
+        n = ScreenUtil.SAMPLES_PER_CELL
+
+        cells = []
+        for r in range(rows):
+            y0, y1 = r * height // rows, (r + 1) * height // rows
+            yList = range(y0, max(y1, y0 + 1), max((y1 - y0) // n, 1))
+            for c in range(cols):
+                x0, x1 = c * width // cols, (c + 1) * width // cols
+                xList = range(x0, max(x1, x0 + 1), max((x1 - x0) // n, 1))
+                total = 0
+                for y in yList:
+                    rowOffset = y * width * 3
+                    for x in xList:
+                        k = rowOffset + x * 3
+                        total += pixels[k] * 299 + pixels[k + 1] * 587 + pixels[k + 2] * 114
+                cells.append(total / (len(yList) * len(xList)))
+
+        ret = 0
+        for r in range(rows):
+            for c in range(hashSize):
+                ret <<= 1
+                if cells[r * cols + c] < cells[r * cols + c + 1]:
+                    ret |= 1
+        return ret
+
+    @staticmethod
+    def getDistance(hash1, hash2):
+        return bin(hash1 ^ hash2).count("1")
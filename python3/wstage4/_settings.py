@@ -21,7 +21,7 @@
 # THE SOFTWARE.
 
 
-from ._const import Arch, Version, Edition, Lang
+from ._const import Arch, Version, Edition, Lang, DiskAllocation, MemoryBackend
 from ._errors import SettingsError
 
 
@@ -32,6 +32,38 @@ class Settings:
 
         self.log_dir = None
 
+        self.addon_store_dir = None
+
+        self.cache_dir = None
+
+        self.cache_size = None                      # step cache in cache_dir is limited to this size, None means no limit
+
+        self.disk_allocation = DiskAllocation.SPARSE
+
+        self.memory_backend = None                  # None means auto detect
+
+        self.memory_merge = False                   # mark guest memory as mergeable by KSM of host
+
+        self.memory_balloon = False                 # add virtio-balloon device, idle guest memory is taken back when VM is running scripts
+
+        self.http_cache_dir = None                  # None means no caching http proxy for guests
+
+        self.http_cache_size = 10 * 1024 * 1024 * 1024
+
+        self.scratch_dir = None                     # directory on tmpfs or fast local disk for the scratch disk, None means no scratch disk
+
+        self.scratch_disk_size = 16 * 1024 * 1024 * 1024
+
+        self.ram_build_dir = None                   # directory on tmpfs, disk image is kept there while building, None means disabled
+
+        self.ram_build_reserve = 2 * 1024 * 1024 * 1024     # memory left for host when deciding whether disk image fits in memory
+
+        self.screen_check_interval = None           # in seconds, None means screen of installer is not monitored
+
+        self.screen_stuck_timeout = 30 * 60         # in seconds
+
+        self.screen_reference_dir = None            # PPM files of known error screens
+
         self.verbose_level = 1
 
     @classmethod
@@ -56,6 +88,102 @@ class Settings:
             else:
                 return False
 
+        if obj.addon_store_dir is not None and not isinstance(obj.addon_store_dir, str):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"addon_store_dir\"")
+            else:
+                return False
+
+        if obj.cache_dir is not None and not isinstance(obj.cache_dir, str):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"cache_dir\"")
+            else:
+                return False
+
+        if obj.cache_size is not None and (not isinstance(obj.cache_size, int) or obj.cache_size <= 0):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"cache_size\"")
+            else:
+                return False
+
+        if not isinstance(obj.disk_allocation, DiskAllocation):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"disk_allocation\"")
+            else:
+                return False
+
+        if obj.memory_backend is not None and not isinstance(obj.memory_backend, MemoryBackend):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"memory_backend\"")
+            else:
+                return False
+
+        if not isinstance(obj.memory_merge, bool):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"memory_merge\"")
+            else:
+                return False
+
+        if not isinstance(obj.memory_balloon, bool):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"memory_balloon\"")
+            else:
+                return False
+
+        if obj.http_cache_dir is not None and not isinstance(obj.http_cache_dir, str):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"http_cache_dir\"")
+            else:
+                return False
+
+        if not isinstance(obj.http_cache_size, int) or obj.http_cache_size <= 0:
+            if raise_exception:
+                raise SettingsError("invalid value for key \"http_cache_size\"")
+            else:
+                return False
+
+        if obj.scratch_dir is not None and not isinstance(obj.scratch_dir, str):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"scratch_dir\"")
+            else:
+                return False
+
+        if not isinstance(obj.scratch_disk_size, int) or obj.scratch_disk_size <= 0:
+            if raise_exception:
+                raise SettingsError("invalid value for key \"scratch_disk_size\"")
+            else:
+                return False
+
+        if obj.ram_build_dir is not None and not isinstance(obj.ram_build_dir, str):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"ram_build_dir\"")
+            else:
+                return False
+
+        if not isinstance(obj.ram_build_reserve, int) or obj.ram_build_reserve < 0:
+            if raise_exception:
+                raise SettingsError("invalid value for key \"ram_build_reserve\"")
+            else:
+                return False
+
+        if obj.screen_check_interval is not None and (not isinstance(obj.screen_check_interval, (int, float)) or obj.screen_check_interval <= 0):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"screen_check_interval\"")
+            else:
+                return False
+
+        if not isinstance(obj.screen_stuck_timeout, (int, float)) or obj.screen_stuck_timeout <= 0:
+            if raise_exception:
+                raise SettingsError("invalid value for key \"screen_stuck_timeout\"")
+            else:
+                return False
+
+        if obj.screen_reference_dir is not None and not isinstance(obj.screen_reference_dir, str):
+            if raise_exception:
+                raise SettingsError("invalid value for key \"screen_reference_dir\"")
+            else:
+                return False
+
         if not (0 <= obj.verbose_level <= 2):
             if raise_exception:
                 raise SettingsError("invalid value for key \"verbose_level\"")
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+
+class StepCache:
+    """
+    Cache of build step outputs, keyed by the hash of the step inputs and the key of the previous step.
+    Because a step's output is fully determined by its inputs, the key also serves as the output hash which
+    is chained into the next step, the same way make/ccache treat their targets.
+
+    Least recently used entries are evicted when the cache exceeds max_size, the entry just saved is always kept.
+
+    Layout of the cache directory:
+        <key>/files/...       snapshot of the working directory after the step, image files are reflinked when possible
+        <key>/info.json       step name and inputs, written last so it marks a complete entry, its mtime is the LRU stamp
+        <key>.*.tmp/          entry being saved
+    """
+
+    def __init__(self, path, max_size=None):
+        assert path is not None
+        self._path = path
+        self._maxSize = max_size            # None means no limit
+
+    @staticmethod
+    def get_key(prev_key, step_name, inputs):
+        h = hashlib.sha256()
+        h.update((prev_key if prev_key is not None else "").encode("ascii"))
+        h.update(b'\n')
+        h.update(step_name.encode("utf-8"))
+        h.update(b'\n')
+        h.update(json.dumps(inputs, sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    def has(self, key):
+        return os.path.exists(os.path.join(self._path, key, "info.json"))
+
+    def save(self, key, step_name, inputs, work_dir):
+        # an existing complete entry has the same content, it is kept for builds which may be restoring it
+        if self.has(key):
+            return
+
+        os.makedirs(self._path, exist_ok=True)
+        dstDir = os.path.join(self._path, key)
+        tmpDir = tempfile.mkdtemp(dir=self._path, prefix=key + ".", suffix=".tmp")
+        try:
+            work_dir.save_snapshot(os.path.join(tmpDir, "files"))
+            with open(os.path.join(tmpDir, "info.json"), "w") as f:
+                json.dump({"step": step_name, "inputs": inputs}, f, indent=4)
+
+            # a leftover without info.json is from an interrupted save, a complete one is from a concurrent save
+            if os.path.exists(dstDir) and not self.has(key):
+                shutil.rmtree(dstDir, ignore_errors=True)
+            try:
+                os.rename(tmpDir, dstDir)
+            except OSError:
+                if not self.has(key):
+                    raise
+        finally:
+            if os.path.exists(tmpDir):
+                shutil.rmtree(tmpDir)
+
+        self._evict(key)
+
+    def restore(self, key, work_dir):
+        assert self.has(key)
+        os.utime(os.path.join(self._path, key, "info.json"))
+        work_dir.restore_snapshot(os.path.join(self._path, key, "files"))
+
+    def _evict(self, keepKey):
+        if self._maxSize is None:
+            return
+
+        entryList = []
+        total = 0
+        for fn in os.listdir(self._path):
+            if not self.has(fn):
+                continue
+            try:
+                mtime = os.stat(os.path.join(self._path, fn, "info.json")).st_mtime
+                size = _getDiskUsage(os.path.join(self._path, fn))
+            except FileNotFoundError:
+                continue
+            entryList.append((mtime, size, fn))
+            total += size
+
+        for mtime, size, key in sorted(entryList):
+            if total <= self._maxSize:
+                break
+            if key == keepKey:
+                continue
+            # remove the completion mark first, so a half-removed entry never looks valid
+            try:
+                os.unlink(os.path.join(self._path, key, "info.json"))
+            except FileNotFoundError:
+                continue
+            shutil.rmtree(os.path.join(self._path, key), ignore_errors=True)
+            total -= size
+
+
+def _getDiskUsage(path):
+    # allocated size, so sparse image files are not over-counted, extents shared by reflinked files are counted in every entry
+    ret = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fn in filenames:
+            ret += os.lstat(os.path.join(dirpath, fn)).st_blocks * 512
+    return ret
@@ -23,11 +23,18 @@
 
 import os
 import re
+import json
 import time
+import fcntl
+import shutil
 import pickle
+import hashlib
 import socket
 import tempfile
+import threading
 import subprocess
+import concurrent.futures
+from ._log import BuildLog
 
 
 class Util:
@@ -97,15 +104,25 @@ class Util:
 
     @staticmethod
     def getFreeTcpPort(start_port=10000, end_port=65536):
-        for port in range(start_port, end_port):
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            try:
-                s.bind((('', port)))
-                return port
-            except socket.error:
-                continue
-            finally:
-                s.close()
+        # the port is not occupied until the caller binds it, so search from the last returned one,
+        # or else VMs started at the same time would get the same port
+        global _lastTcpPort
+
+        with _tcpPortLock:
+            if _lastTcpPort is not None and start_port <= _lastTcpPort < end_port - 1:
+                portList = list(range(_lastTcpPort + 1, end_port)) + list(range(start_port, _lastTcpPort + 1))
+            else:
+                portList = range(start_port, end_port)
+            for port in portList:
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                try:
+                    s.bind((('', port)))
+                    _lastTcpPort = port
+                    return port
+                except socket.error:
+                    continue
+                finally:
+                    s.close()
         raise Exception("No valid tcp port in [%d,%d]." % (start_port, end_port))
 
     @staticmethod
@@ -124,17 +141,203 @@ class Util:
     @staticmethod
     def isMount(path):
         """Like os.path.ismount, but also support bind mounts"""
-        if os.path.ismount(path):
+        from ._mount_table import MountTable
+        if MountTable.get().is_mount(path):
             return 1
-        a = os.popen("mount")
-        mylines = a.readlines()
-        a.close()
-        for line in mylines:
-            mysplit = line.split()
-            if Util.pathCompare(path, mysplit[2]):
-                return 1
         return 0
 
+    @staticmethod
+    def cloneFile(srcPath, dstPath):
+        """copy file content, use reflink if the filesystem supports it"""
+
+        FICLONE = 0x40049409
+        with open(srcPath, "rb") as src:
+            with open(dstPath, "wb") as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    return
+                except OSError:
+                    pass
+                # keep holes, disk images are mostly sparse
+                Util.copySparseFile(srcPath, lambda buf, offset: os.pwrite(dst.fileno(), buf, offset))
+                dst.truncate(os.fstat(src.fileno()).st_size)
+
+    @staticmethod
+    def getMemAvailable():
+        # in bytes, returns None if it can't be got
+        try:
+            with open("/proc/meminfo", "r") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    @staticmethod
+    def cloneFileAtomic(srcPath, dstPath):
+        """same as cloneFile(), but dstPath is replaced atomically and durably, modification time of srcPath is kept"""
+
+        st = os.stat(srcPath)
+        tmpPath = dstPath + ".tmp"
+        try:
+            Util.cloneFile(srcPath, tmpPath)
+            with open(tmpPath, "rb+") as f:
+                os.fsync(f.fileno())
+            os.utime(tmpPath, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.rename(tmpPath, dstPath)
+        finally:
+            if os.path.exists(tmpPath):
+                os.unlink(tmpPath)
+
+    @staticmethod
+    def syncTree(srcDir, dstDir, dmode, fmode, manifestFile=None, maxWorkers=None):
+        """
+        Make dstDir a copy of srcDir, files are copied by a thread pool and modes are applied in the same pass.
+        If manifestFile is specified, it records (size, mtime, sha256) of every file, unchanged files are skipped next time.
+        Returns {relative-path: (size, mtime, sha256)}.
+        """
+
+        oldManifest = dict()
+        if manifestFile is not None and os.path.exists(manifestFile):
+            with open(manifestFile, "r") as f:
+                oldManifest = {k: tuple(v) for k, v in json.load(f).items()}
+
+        # create directories, collect files and symlinks
+        os.makedirs(dstDir, exist_ok=True)
+        os.chmod(dstDir, dmode)
+        dirSet = set()
+        fileList = []
+        linkList = []
+        for curDir, dirnames, filenames in os.walk(srcDir):
+            relDir = os.path.relpath(curDir, srcDir)
+            for name in sorted(dirnames + filenames):
+                rel = os.path.normpath(os.path.join(relDir, name))
+                fullfn = os.path.join(curDir, name)
+                if os.path.islink(fullfn):
+                    linkList.append(rel)
+                elif os.path.isdir(fullfn):
+                    dirSet.add(rel)
+                    os.makedirs(os.path.join(dstDir, rel), exist_ok=True)
+                    os.chmod(os.path.join(dstDir, rel), dmode)
+                else:
+                    fileList.append(rel)
+
+        # remove stale entries in dstDir
+        fileSet = set(fileList)
+        linkSet = set(linkList)
+        for curDir, dirnames, filenames in os.walk(dstDir, topdown=False):
+            relDir = os.path.relpath(curDir, dstDir)
+            for name in filenames + dirnames:
+                rel = os.path.normpath(os.path.join(relDir, name))
+                fullfn = os.path.join(curDir, name)
+                if os.path.isdir(fullfn) and not os.path.islink(fullfn):
+                    if rel not in dirSet:
+                        shutil.rmtree(fullfn)
+                elif rel not in fileSet or rel in linkSet:
+                    os.unlink(fullfn)
+
+        # symlinks are recreated, they are cheap
+        for rel in linkList:
+            os.symlink(os.readlink(os.path.join(srcDir, rel)), os.path.join(dstDir, rel))
+
+        def __syncFile(rel):
+            srcFile = os.path.join(srcDir, rel)
+            dstFile = os.path.join(dstDir, rel)
+            st = os.stat(srcFile)
+            old = oldManifest.get(rel)
+            dstExists = os.path.exists(dstFile)
+            if old is not None and dstExists and old[:2] == (st.st_size, st.st_mtime_ns):
+                return (rel, old)
+
+            h = hashlib.sha256()
+            with open(srcFile, "rb") as f:
+                while True:
+                    buf = f.read(1024 * 1024)
+                    if len(buf) == 0:
+                        break
+                    h.update(buf)
+            if old is None or not dstExists or old[2] != h.hexdigest():
+                Util.cloneFile(srcFile, dstFile)
+            os.chmod(dstFile, fmode)
+            return (rel, (st.st_size, st.st_mtime_ns, h.hexdigest()))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            ret = dict(executor.map(__syncFile, fileList))
+
+        if manifestFile is not None:
+            with open(manifestFile + ".tmp", "w") as f:
+                json.dump(ret, f)
+            os.rename(manifestFile + ".tmp", manifestFile)
+        return ret
+
+    @staticmethod
+    def linkTree(srcDir, dstDir):
+        """Populate dstDir with hardlinks to files in srcDir, copy is used if hardlink is not possible"""
+
+        for curDir, dirnames, filenames in os.walk(srcDir):
+            relDir = os.path.relpath(curDir, srcDir)
+            d = os.path.normpath(os.path.join(dstDir, relDir))
+            os.makedirs(d, exist_ok=True)
+            shutil.copymode(curDir, d)
+            for name in filenames + [x for x in dirnames if os.path.islink(os.path.join(curDir, x))]:
+                srcFile = os.path.join(curDir, name)
+                dstFile = os.path.join(d, name)
+                if os.path.islink(srcFile):
+                    os.symlink(os.readlink(srcFile), dstFile)
+                    continue
+                try:
+                    os.link(srcFile, dstFile)
+                except OSError:
+                    Util.cloneFile(srcFile, dstFile)
+                    shutil.copymode(srcFile, dstFile)
+
+    @staticmethod
+    def copySparseFile(srcPath, writeFunc, chunkSize=4 * 1024 * 1024):
+        """call writeFunc(buf, offset) for data extents of srcPath only, holes are skipped"""
+
+        with open(srcPath, "rb") as f:
+            fd = f.fileno()
+            size = os.fstat(fd).st_size
+            pos = 0
+            while pos < size:
+                try:
+                    start = os.lseek(fd, pos, os.SEEK_DATA)
+                except OSError:
+                    break                                   # no more data
+                end = os.lseek(fd, start, os.SEEK_HOLE)
+                while start < end:
+                    buf = os.pread(fd, min(chunkSize, end - start), start)
+                    writeFunc(buf, start)
+                    start += len(buf)
+                pos = end
+
+    @staticmethod
+    def getFileHash(cacheDir, filepath):
+        # hashing a whole DVD image takes long, so the result is remembered by (path, size, mtime)
+        st = os.stat(filepath)
+        key = hashlib.sha256(os.path.realpath(filepath).encode("utf-8")).hexdigest()
+        fullfn = os.path.join(cacheDir, key + ".hash")
+        stamp = "%d %d" % (st.st_size, st.st_mtime_ns)
+
+        if os.path.exists(fullfn):
+            with open(fullfn, "r") as f:
+                data = json.load(f)
+            if data["stamp"] == stamp:
+                return data["sha256"]
+
+        h = hashlib.sha256()
+        with open(filepath, "rb") as f:
+            while True:
+                buf = f.read(1024 * 1024)
+                if len(buf) == 0:
+                    break
+                h.update(buf)
+        with open(fullfn + ".tmp", "w") as f:
+            json.dump({"stamp": stamp, "sha256": h.hexdigest()}, f)
+        os.rename(fullfn + ".tmp", fullfn)
+        return h.hexdigest()
+
     @staticmethod
     def isInstanceList(obj, *instances):
         for inst in instances:
@@ -158,6 +361,9 @@ class Util:
         ret = subprocess.run([cmd] + list(kargs),
                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
                              universal_newlines=True)
+        buildLog = BuildLog.get_current()
+        if buildLog is not None:
+            buildLog.write("commands", "$ %s\n%s[exit %d]\n" % (" ".join([cmd] + list(kargs)), ret.stdout, ret.returncode))
         if ret.returncode > 128:
             # for scenario 1, caller's signal handler has the oppotunity to get executed during sleep
             time.sleep(1.0)
@@ -197,6 +403,10 @@ class Util:
         ret.check_returncode()
 
 
+_tcpPortLock = threading.Lock()
+_lastTcpPort = None
+
+
 class TempChdir:
 
     def __init__(self, dirname):
@@ -22,22 +22,64 @@
 
 
 import os
+import re
+import sys
 import json
+import time
+import fcntl
+import shlex
+import shutil
+import socket
+import asyncio
+import zoneinfo
+import datetime
+import platform
+import tempfile
+import threading
 import subprocess
+import uuid
 from ._util import Util
-from ._const import Arch, Version, Edition, Lang
+from ._const import Arch, Version, Lang, DiskAllocation, MemoryBackend
+from ._disk_image import DiskPartitioner, DiskImageUtil, PartitionSpec
+from ._mount_table import MountTable
+from ._errors import GuestAgentError, GuestAgentFileNotFoundError, VmError
+from ._qmp import QmpClient, AsyncQmpClient
+from ._log import StreamPump
+from ._guest_agent import GuestAgent, GuestAgentBridge
+from ._driver import drive, async_drive, Call, Sleep, SpawnProcess, WaitProcess
 
 
 class Vm:
+    """
+    A qemu virtual machine running a windows image.
 
-    def __init__(self, main_disk_filepath):
-        data = None
-        with open(main_disk_filepath, "rb") as f:
-            f.seek(512)
-            data = Util.readUntil(f, b'\n\0', max=512)
+    The VM can be driven either by the blocking methods, or by the async_* methods in an asyncio event loop.
+    A VM started by async_start() or async_restore_state() must be stopped by the async_* methods.
+    """
+
+    BALLOON_PATH = "/machine/peripheral/balloon0"        # QOM path of the virtio-balloon device
+
+    _APPLIED_SCRIPTS_FILE = "C:\\wstage4\\applied-scripts.txt"
+
+    _POWERDOWN_TIMEOUT = 300
+
+    _SCRATCH_SAVED_DIR = "C:\\wstage4\\scratch-saved"
+
+    _REG_MEMORY_MANAGEMENT = "HKLM\\SYSTEM\\CurrentControlSet\\Control\\Session Manager\\Memory Management"
+
+    _REG_ENVIRONMENT = "HKLM\\SYSTEM\\CurrentControlSet\\Control\\Session Manager\\Environment"
 
+    def __init__(self, main_disk_filepath, memory_backend=None, http_proxy=None, build_log=None, scratch_disk_filepath=None, memory_merge=False, memory_balloon=False):
+        disk = DiskPartitioner.openDiskImage(main_disk_filepath)
+        try:
+            data = disk.pread(512, 512)
+        finally:
+            disk.close()
+
+        data = data.split(b'\n')[0].split(b'\0')[0]
         data = json.loads(data.decode("iso8859-1"))
-        self._init(False, data["arch"], data["version"], data["edition"], data["lang"], main_disk_filepath, None, None)
+        self._init(False, data["arch"], data["version"], data["edition"], data["lang"], main_disk_filepath, None, None, memory_backend, http_proxy, build_log, scratch_disk_filepath,
+                   memory_merge, memory_balloon)
 
     def __enter__(self):
         self.start()
@@ -52,33 +94,526 @@ class Vm:
     def get_qemu_command(self):
         return self._cmdLine
 
+    def get_memory_backend(self):
+        """Returns (MemoryBackend, reason) of the running VM"""
+        return (self._memoryBackend, self._memoryBackendReason)
+
+    def get_memory_merge(self):
+        """Returns (enabled, reason) of the running VM, guest memory is marked as mergeable by KSM if enabled"""
+        return (self._memoryMerge, self._memoryMergeReason)
+
+    def get_memory_size(self):
+        """Returns memory size of the VM in bytes, it is the upper limit of the balloon"""
+        return self._memorySize * 1024 * 1024
+
+    def has_memory_balloon(self):
+        """Returns True if the running VM has a virtio-balloon device, whose QOM path is BALLOON_PATH"""
+        return self._bBalloon
+
+    def get_accelerator(self):
+        """Returns (accelerator-name, reason) of the running VM"""
+        return (self._accel, self._accelReason)
+
+    def get_rtc_base(self):
+        """Returns (qemu-rtc-base, reason) of the running VM"""
+        return (self._rtcBase, self._rtcReason)
+
     def start(self, show=False):
+        drive(self._coStart(show, None))
+
+    def stop(self, remove_scripts=True):
+        drive(self._coStop())
+
+    def save_state(self, state_filepath, wait_idle=True, idle_timeout=600):
+        """
+        Save RAM and device state of the running guest into a compressed file, then power off the VM without
+        shutting down the guest. The disk must not be changed until the state is restored by restore_state().
+        """
+
+        drive(self._coSaveState(state_filepath, wait_idle, idle_timeout))
+
+    def restore_state(self, state_filepath, show=False):
+        """Start VM from a state file saved by save_state(), the guest continues running from where it was saved"""
+
+        drive(self._coRestoreState(state_filepath, show))
+
+    def wait_until_stop(self):
+        drive(self._coWaitUntilStop())
+
+    async def async_start(self, show=False):
+        await async_drive(self._coStart(show, None))
+
+    async def async_stop(self):
+        await async_drive(self._coStop())
+
+    async def async_save_state(self, state_filepath, wait_idle=True, idle_timeout=600):
+        await async_drive(self._coSaveState(state_filepath, wait_idle, idle_timeout))
+
+    async def async_restore_state(self, state_filepath, show=False):
+        await async_drive(self._coRestoreState(state_filepath, show))
+
+    async def async_wait_until_stop(self):
+        """Waits until the guest powers off, qemu is killed if the waiting task is cancelled"""
+
+        await async_drive(self._coWaitUntilStop())
+
+    async def async_get_qmp(self):
+        """Returns the AsyncQmpClient connected to the running VM, it is shared by all tasks"""
+
+        assert self.is_running()
+
+        if not hasattr(self, "_aqmpLock"):
+            self._aqmpLock = asyncio.Lock()
+        async with self._aqmpLock:
+            if not hasattr(self, "_aqmp"):
+                self._aqmp = await AsyncQmpClient.connect(self._qmpPort)
+        return self._aqmp
+
+    def qmp_command(self, name, **arguments):
+        """Execute a QMP command in the running VM, it can be called from any thread, VmError is raised if the VM is stopped"""
+
+        with self._qmpLock:
+            if not self.is_running():
+                raise VmError("VM is not running")
+            return self._getQmp().command(name, **arguments)
+
+    def get_agent(self, timeout=600):
+        """Returns a GuestAgent connected to the agent running in the guest, waits until the agent answers"""
+
+        assert self.is_running()
+
+        # the agent script needs Windows Script Host with MSXML and ADO, which windows 98 does not have
+        if self._version == Version.WINDOWS_98:
+            raise GuestAgentError("guest agent is not supported on Windows 98")
+
+        if not hasattr(self, "_agent"):
+            self._agent = GuestAgent(self._agentBridge.connect())
+        self._agent.wait_ready(timeout)
+        return self._agent
+
+    def script_exec(self, script, quiet=False):
+        agent = self.get_agent()
+        guestDir = "C:\\wstage4\\script"
+
+        agent.exec("rmdir /s /q %s" % (guestDir))
+        with tempfile.TemporaryDirectory() as tmpDir:
+            script.fill_script_dir(tmpDir)
+            agent.push_dir(tmpDir, guestDir)
+
+        cmdline = "cd /d %s && %s" % (guestDir, script.get_script())
+        if self._httpProxy is not None:
+            cmdline = "set http_proxy=%s&& %s" % (self._httpProxy.guest_url, cmdline)
+        if self._scratchDrive is not None:
+            # registry change of TEMP does not reach the already running agent
+            cmdline = "set TEMP=%s\\temp&& set TMP=%s\\temp&& %s" % (self._scratchDrive, self._scratchDrive, cmdline)
+
+        if quiet:
+            ret = agent.exec(cmdline)
+        else:
+            ret = agent.exec(cmdline,
+                             stdout_callback=_StreamWriter(sys.stdout),
+                             stderr_callback=_StreamWriter(sys.stderr))
+        if ret != 0:
+            raise GuestAgentError("script \"%s\" failed with exit code %d" % (script.get_description(), ret))
+
+    def load_applied_script_digests(self):
+        """Returns digests of the scripts which have been applied to this image, they are recorded inside the guest"""
+
+        agent = self.get_agent()
+        with tempfile.TemporaryDirectory() as tmpDir:
+            try:
+                agent.pull_file(self._APPLIED_SCRIPTS_FILE, os.path.join(tmpDir, "applied"))
+            except GuestAgentFileNotFoundError:
+                return []
+            with open(os.path.join(tmpDir, "applied"), "r") as f:
+                return [x for x in f.read().split("\n") if x != ""]
+
+    def save_applied_script_digests(self, digest_list):
+        buf = "".join([x + "\n" for x in digest_list])
+        self.get_agent().push_buffer(buf.encode("ascii"), self._APPLIED_SCRIPTS_FILE)
+
+    def enable_scratch(self, reboot_timeout=600):
+        """
+        Move pagefile and temporary directories of the guest onto the scratch disk, the original settings are saved in guest.
+        The guest is rebooted when the pagefile is moved.
+        """
+
+        assert self._scratchDiskPath is not None
+
+        agent = self.get_agent()
+        savedDir = self._SCRATCH_SAVED_DIR
+        drive = self._findScratchDrive(agent)
+        enabledDrive = self._readGuestFile(agent, savedDir + "\\enabled")
+        if enabledDrive == drive:
+            # the scratch disk may be a re-created empty one
+            agent.exec("if not exist %s\\temp mkdir %s\\temp" % (drive, drive))
+            self._scratchDrive = drive
+            return
+
+        cmdList = []
+        if enabledDrive is None:
+            # save the original settings only once, the scratch drive letter may change if the scratch disk is re-created
+            cmdList += [
+                "if exist %s rmdir /s /q %s" % (savedDir, savedDir),
+                "mkdir %s" % (savedDir),
+                'reg export "%s" %s\\memory-management.reg' % (self._REG_MEMORY_MANAGEMENT, savedDir),
+                'reg export "%s" %s\\environment.reg' % (self._REG_ENVIRONMENT, savedDir),
+            ]
+        cmdList += [
+            'reg add "%s" /v PagingFiles /t REG_MULTI_SZ /d "%s\\pagefile.sys 0 0" /f' % (self._REG_MEMORY_MANAGEMENT, drive),
+            'reg add "%s" /v TEMP /t REG_EXPAND_SZ /d %s\\temp /f' % (self._REG_ENVIRONMENT, drive),
+            'reg add "%s" /v TMP /t REG_EXPAND_SZ /d %s\\temp /f' % (self._REG_ENVIRONMENT, drive),
+            "if not exist %s\\temp mkdir %s\\temp" % (drive, drive),
+        ]
+        for cmd in cmdList:
+            if agent.exec(cmd) != 0:
+                raise GuestAgentError("failed to enable scratch disk, \"%s\" failed" % (cmd))
+        agent.push_buffer(drive.encode("ascii"), savedDir + "\\enabled")
+
+        # pagefile is moved when windows boots, old one is not deleted automatically
+        qmp = self._getQmp()
+        qmp.get_events("RESET")
+        agent.exec("shutdown /r /f /t 0")
+        qmp.wait_event("RESET", reboot_timeout)
+        agent.wait_ready(reboot_timeout)
+        agent.exec("if exist C:\\pagefile.sys del /f /a C:\\pagefile.sys")
+        self._scratchDrive = drive
+
+    def disable_scratch(self):
+        """Restore pagefile and temporary directory settings saved by enable_scratch(), they take effect on next boot"""
+
+        agent = self.get_agent()
+        savedDir = self._SCRATCH_SAVED_DIR
+        if self._readGuestFile(agent, savedDir + "\\enabled") is None:
+            return
+
+        cmdList = [
+            "reg import %s\\memory-management.reg" % (savedDir),
+            "reg import %s\\environment.reg" % (savedDir),
+            "rmdir /s /q %s" % (savedDir),
+        ]
+        for cmd in cmdList:
+            if agent.exec(cmd) != 0:
+                raise GuestAgentError("failed to disable scratch disk, \"%s\" failed" % (cmd))
+        self._scratchDrive = None
+
+    def interactive_access(self):
+        agent = self.get_agent()
+        while True:
+            try:
+                cmd = input("wstage4> ")
+            except EOFError:
+                print("")
+                break
+            if cmd.strip() == "":
+                continue
+            agent.exec(cmd, stdout_callback=_StreamWriter(sys.stdout), stderr_callback=_StreamWriter(sys.stderr))
+
+    def _findScratchDrive(self, agent):
+        out = bytearray()
+        cmd = 'for %%d in (D E F G H I J K L M N O P Q R S T U V W X Y Z) do @(vol %%d: 2>nul | find "%s" >nul && echo %%d:)' % (VmUtil.SCRATCH_LABEL)
+        agent.exec(cmd, stdout_callback=out.extend)
+        ret = out.decode("ascii", "replace").split()
+        if len(ret) == 0:
+            raise GuestAgentError("scratch disk is not found in guest")
+        return ret[0]
+
+    def _readGuestFile(self, agent, guestPath):
+        # returns None if the file does not exist
+        out = bytearray()
+        if agent.exec("if exist %s type %s" % (guestPath, guestPath), stdout_callback=out.extend) != 0 or len(out) == 0:
+            return None
+        return out.decode("ascii", "replace").strip()
+
+    def _start(self, show, incomingStateFile):
+        drive(self._coStart(show, incomingStateFile))
+
+    def _coStart(self, show, incomingStateFile):
         try:
-            self._bShow = show
-            self._qmpPort = Util.getFreeTcpPort()
-            self._cmdLine = self._generateQemuCommand()
-            self._proc = subprocess.Popen(self._cmdLine, shell=True)
+            stateInfo = self._prepareStart(show, incomingStateFile)
+
+            # no shell in between, so that qemu is the direct child
+            argv = shlex.split(self._cmdLine.replace("\\\n", " "))
+            if self._buildLog is not None:
+                self._buildLog.get_channel("qemu").write_line("start: " + " ".join(self._cmdLine.split("\\\n")))
+            self._proc = yield SpawnProcess(argv, self._buildLog is not None)
+            if self._buildLog is not None:
+                self._startLogPumps()
+
+            if incomingStateFile is not None:
+                yield _QmpCommand(self, "migrate-incoming", uri=self._getIncomingUri(incomingStateFile, stateInfo))
+                yield from self._coWaitMigration()
         except BaseException:
-            self.stop()
+            yield from self._coKill()
+            if hasattr(self, "_proc"):
+                self._dispose()
             raise
 
-    def stop(self, remove_scripts=True):
+    def _coStop(self):
         if hasattr(self, "_proc"):
-            assert self._proc is not None
-            # send to qmp shutdown machine
-            del self._proc
-            del self._cmdLine
-            del self._qmpPort
-            del self._bShow
+            try:
+                if self._isProcRunning():
+                    # send to qmp shutdown machine, force quit if guest does not respond to the power button
+                    try:
+                        yield _QmpCommand(self, "system_powerdown")
+                        yield WaitProcess(self._proc, self._POWERDOWN_TIMEOUT)
+                    except (VmError, OSError, subprocess.TimeoutExpired):
+                        yield from self._coKill()
+            except BaseException:
+                yield from self._coKill()
+                raise
+            finally:
+                self._dispose()
 
-    def wait_until_stop(self):
-        self._proc.wait()
-        del self._proc
+    def _coSaveState(self, stateFile, waitIdle=True, idleTimeout=600):
+        assert self.is_running()
+
+        try:
+            if waitIdle:
+                # a guest which is still busy after boot has more dirty pages and makes bigger state file
+                yield Call(self.get_agent)
+                yield from self._coWaitIdle(idleTimeout)
+
+            # vm is left paused, zero pages of an idle windows guest compress very well
+            compression, uri = self._getOutgoingUri(stateFile)
+            yield _QmpCommand(self, "stop")
+            yield _QmpCommand(self, "migrate", uri=uri)
+            yield from self._coWaitMigration()
+            self._saveStateInfo(stateFile, compression)
+        finally:
+            yield from self._coKill()
+            self._dispose()
+
+    def _coRestoreState(self, stateFile, show):
+        assert not self.is_running()
+
+        yield from self._coStart(show, stateFile)
+        try:
+            yield _QmpCommand(self, "cont")
+        except BaseException:
+            yield from self._coKill()
+            self._dispose()
+            raise
+
+    def _coWaitUntilStop(self):
+        try:
+            yield WaitProcess(self._proc)
+        except BaseException:
+            yield from self._coKill()
+            raise
+        finally:
+            self._dispose()
+
+    def _prepareStart(self, show, incomingStateFile):
+        # returns the saved state info if incomingStateFile is not None
+        self._bShow = show
+        self._qmpPort = Util.getFreeTcpPort()
+        self._tmpDir = tempfile.mkdtemp(prefix="wstage4-vm-")
+        self._agentBridge = GuestAgentBridge()
+        self._incoming = (incomingStateFile is not None)
+        self._scratchDrive = None
+
+        # restored vm must have the same RAM layout and cpu model as the saved one
+        if incomingStateFile is not None:
+            with open(incomingStateFile + ".json", "r") as f:
+                stateInfo = json.load(f)
+            memoryBackendPreferred = MemoryBackend[stateInfo["memory-backend"]]
+        else:
+            stateInfo = None
+            memoryBackendPreferred = self._memoryBackendPreferred
+        self._memoryBackend, self._memoryBackendReason, self._memoryBackendOpts = VmUtil.probeMemoryBackend(self._memorySize, memoryBackendPreferred)
+        self._accel, self._accelReason, self._accelOpts, self._cpuModel = VmUtil.probeAccelerator(self._arch, self._version)
+        if stateInfo is not None:
+            if (self._memoryBackend == MemoryBackend.ANONYMOUS) != (stateInfo["memory-backend"] == MemoryBackend.ANONYMOUS.name):
+                raise VmError("can not restore state saved with memory backend %s, %s" % (stateInfo["memory-backend"].lower(), self._memoryBackendReason))
+            if self._accel != stateInfo["accelerator"] or self._cpuModel != stateInfo["cpu-model"]:
+                raise VmError("can not restore state saved with accelerator %s, %s" % (stateInfo["accelerator"], self._accelReason))
+
+        # balloon device is part of the saved device state, merging is not
+        if stateInfo is not None:
+            self._bBalloon = stateInfo.get("memory-balloon", False)
+        else:
+            self._bBalloon = self._memoryBalloonPreferred
+        if self._memoryMergePreferred:
+            self._memoryMerge, self._memoryMergeReason = VmUtil.probeMemoryMerge(self._memoryBackend)
+        else:
+            self._memoryMerge, self._memoryMergeReason = (False, "not requested")
+
+        if self._buildLog is not None:
+            self._consoleSockFile = os.path.join(self._tmpDir, "console.sock")
+            self._qmpEventPort = Util.getFreeTcpPort(self._qmpPort + 1)
+        self._rtcBase, self._rtcReason = VmUtil.getRtcBase(self._lang)
+        self._cmdLine = self._generateQemuCommand()
+        return stateInfo
+
+    def _getIncomingUri(self, stateFile, stateInfo):
+        decompressCmd = {
+            "zstd": "zstd -d -c -q",
+            "gzip": "gzip -d -c",
+            "none": "cat",
+        }[stateInfo.get("compression", "none")]
+        return "exec:%s %s" % (decompressCmd, shlex.quote(stateFile))
+
+    def _getOutgoingUri(self, stateFile):
+        # returns (compression, migration-uri)
+        if shutil.which("zstd") is not None:
+            compression, compressCmd = "zstd", "zstd -q -1 -T0"
+        else:
+            compression, compressCmd = "gzip", "gzip -1"
+        return (compression, "exec:%s > %s" % (compressCmd, shlex.quote(stateFile)))
+
+    def _saveStateInfo(self, stateFile, compression):
+        with open(stateFile + ".json", "w") as f:
+            json.dump({
+                "memory-backend": self._memoryBackend.name,
+                "accelerator": self._accel,
+                "cpu-model": self._cpuModel,
+                "compression": compression,
+                "memory-balloon": self._bBalloon,
+            }, f)
+
+    def _coWaitIdle(self, timeout):
+        # host side measurement of vcpu thread usage, no cooperation of guest needed
+        meter = _IdleMeter([x["thread-id"] for x in (yield _QmpCommand(self, "query-cpus-fast"))])
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            yield Sleep(1)
+            if meter.update():
+                return True
+        return False
+
+    def _resume(self):
+        self._getQmp().command("cont")
+
+    def _kill(self):
+        drive(self._coKill())
+
+    def _coKill(self):
+        if hasattr(self, "_proc") and self._isProcRunning():
+            try:
+                yield _QmpCommand(self, "quit")
+            except (VmError, OSError):
+                self._proc.terminate()
+            yield WaitProcess(self._proc)
+
+    def _isProcRunning(self):
+        # subprocess.Popen or asyncio.subprocess.Process
+        if isinstance(self._proc, subprocess.Popen):
+            return self._proc.poll() is None
+        return self._proc.returncode is None
+
+    def _getQmp(self):
+        with self._qmpLock:
+            if not hasattr(self, "_qmp"):
+                self._qmp = QmpClient(self._qmpPort)
+            return self._qmp
+
+    def _coWaitMigration(self):
+        while not self._checkMigration((yield _QmpCommand(self, "query-migrate"))):
+            yield Sleep(0.2)
+
+    def _checkMigration(self, ret):
+        # returns True if migration is completed
+        if ret.get("status") == "completed":
+            return True
+        if ret.get("status") in ["failed", "cancelled"]:
+            raise VmError("migration %s, %s" % (ret["status"], ret.get("error-desc", "")))
+        return False
+
+    def _startLogPumps(self):
+        def __run():
+            # qemu creates the listening sockets shortly after being started
+            sock = None
+            while (proc.poll() if isinstance(proc, subprocess.Popen) else proc.returncode) is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(self._consoleSockFile)
+                    break
+                except OSError:
+                    sock.close()
+                    sock = None
+                    time.sleep(0.5)
+            if sock is None:
+                return
+            StreamPump(lambda: sock.recv(65536), self._buildLog.get_channel("serial"))
+
+            try:
+                qmp = QmpClient(self._qmpEventPort)
+            except (VmError, OSError):
+                return
+            channel = self._buildLog.get_channel("qmp-events")
+            try:
+                while True:
+                    channel.write_line(json.dumps(qmp.recv_event()))
+            except (VmError, OSError):
+                pass
+            finally:
+                qmp.close()
+
+        async def __asyncPump(channel):
+            while True:
+                buf = await proc.stdout.read(65536)
+                if len(buf) == 0:
+                    break
+                channel.write(buf)
+                try:
+                    sys.stdout.buffer.write(buf)
+                    sys.stdout.buffer.flush()
+                except (OSError, ValueError):
+                    pass
+
+        proc = self._proc
+        if isinstance(proc, subprocess.Popen):
+            StreamPump(lambda: os.read(proc.stdout.fileno(), 65536), self._buildLog.get_channel("qemu"), sys.stdout.buffer)
+        else:
+            # pipe of asyncio subprocess can only be read in the event loop
+            self._pumpTask = asyncio.ensure_future(__asyncPump(self._buildLog.get_channel("qemu")))
+        threading.Thread(target=__run, daemon=True).start()
+
+    def _dispose(self):
+        if hasattr(self, "_agent"):
+            self._agent.close()
+            del self._agent
+        with self._qmpLock:
+            if hasattr(self, "_qmp"):
+                self._qmp.close()
+                del self._qmp
+            if hasattr(self, "_aqmp"):
+                self._aqmp.close()
+                del self._aqmp
+            if hasattr(self, "_aqmpLock"):
+                del self._aqmpLock
+            if hasattr(self, "_pumpTask"):
+                del self._pumpTask
+            del self._proc
         del self._cmdLine
+        shutil.rmtree(self._tmpDir)
+        self._agentBridge.close()
+        del self._agentBridge
+        del self._tmpDir
         del self._qmpPort
+        del self._memoryBackend
+        del self._memoryBackendReason
+        del self._memoryBackendOpts
+        del self._accel
+        del self._accelReason
+        del self._accelOpts
+        del self._cpuModel
+        del self._rtcBase
+        del self._rtcReason
+        if hasattr(self, "_consoleSockFile"):
+            del self._consoleSockFile
+            del self._qmpEventPort
+        del self._incoming
+        del self._scratchDrive
         del self._bShow
 
-    def _init(self, bBootstrap, arch, version, edition, lang, mainDiskFile, bootIsoFile, assistantFloppyFile):
+    def _init(self, bBootstrap, arch, version, edition, lang, mainDiskFile, bootIsoFile, assistantFloppyFile, memoryBackend=None, httpProxy=None, buildLog=None, scratchDiskFile=None,
+              memoryMerge=False, memoryBalloon=False):
+        self._arch = arch
+        self._version = version
+        self._lang = lang
+
         # qemu command
         if arch == Arch.X86:
             self._cmd = "qemu-system-i386"
@@ -98,13 +633,18 @@ class Vm:
         # cpu number
         self._cpuNumber = 1
 
-        # memory size
-        if arch == Arch.X86:
-            self._memorySize = "1G"
-        elif arch == Arch.X86_64:
-            self._memorySize = "4G"
-        else:
-            assert False
+        # memory size, in MiB
+        self._memorySize = VmUtil.getMemorySize(arch)
+
+        # memory backend, None means auto detect, it is probed again when vm starts
+        self._memoryBackendPreferred = memoryBackend
+
+        # identical pages of guests are merged by KSM of host, idle guest memory is taken back through virtio-balloon by MemoryReclaimer
+        self._memoryMergePreferred = memoryMerge
+        self._memoryBalloonPreferred = memoryBalloon
+
+        # QMP commands may be issued by other threads, such as ScreenMonitor
+        self._qmpLock = threading.RLock()
 
         # disk interface
         if bBootstrap:
@@ -124,6 +664,10 @@ class Vm:
 
         # main disk file path
         self._diskPath = mainDiskFile
+        self._diskFormat = DiskImageUtil.getFormat(mainDiskFile)
+
+        # scratch disk file path, can be None
+        self._scratchDiskPath = scratchDiskFile
 
         # boot iso file path, can be None
         self._bootFile = bootIsoFile
@@ -131,20 +675,29 @@ class Vm:
         # assistant floppy file path, can be None
         self._assistantFloppyFile = assistantFloppyFile
 
+        # caching http proxy run by host, can be None
+        self._httpProxy = httpProxy
+
+        # qemu output, serial console and QMP events are captured into build log, can be None
+        self._buildLog = buildLog
+
     def _generateQemuCommand(self):
         cmd = self._cmd + " \\\n"
-        if os.getuid() == 0:
-            # non-priviledged user can use us with a performance pernalty
-            cmd += "    -enable-kvm \\\n"
+        cmd += "    -accel %s \\\n" % (self._accelOpts)
         cmd += "    -no-user-config \\\n"
         cmd += "    -nodefaults \\\n"
-        cmd += "    -machine %s,usb=on \\\n" % (self._qemuVmType)
+        # merge options are given only when requested, the defaults of qemu and memory backend are kept otherwise
+        if self._memoryBackend == MemoryBackend.ANONYMOUS:
+            cmd += "    -machine %s,usb=on%s \\\n" % (self._qemuVmType, ",mem-merge=on" if self._memoryMerge else "")
+        else:
+            cmd += "    -object %s%s \\\n" % (self._memoryBackendOpts, ",merge=on" if self._memoryMerge else "")
+            cmd += "    -machine %s,usb=on,memory-backend=mem0 \\\n" % (self._qemuVmType)
 
         # platform device
-        cmd += "    -cpu host \\\n"
+        cmd += "    -cpu %s \\\n" % (self._cpuModel)
         cmd += "    -smp 1,sockets=1,cores=%d,threads=1 \\\n" % (self._cpuNumber)
-        cmd += "    -m %s \\\n" % (self._memorySize)
-        cmd += "    -rtc base=localtime \\\n"           # FIXME: how to do it more standard
+        cmd += "    -m %dM \\\n" % (self._memorySize)
+        cmd += "    -rtc base=%s,clock=host,driftfix=slew \\\n" % (self._rtcBase)
 
         # additional controllers
         if self._qemuVmType == "pc":
@@ -157,7 +710,12 @@ class Vm:
 
         # main-disk
         if True:
-            cmd += "    -blockdev 'driver=file,filename=%s,node-name=main-disk' \\\n" % (self._diskPath)
+            if self._diskFormat == "raw":
+                cmd += "    -blockdev 'driver=file,filename=%s,node-name=main-disk' \\\n" % (self._diskPath)
+            elif self._diskFormat == "qcow2":
+                cmd += "    -blockdev 'driver=qcow2,file.driver=file,file.filename=%s,node-name=main-disk' \\\n" % (self._diskPath)
+            else:
+                assert False
             if self._mainDiskInterface == "ide":
                 cmd += "    -device ide-hd,bus=ide.0,drive=main-disk,bootindex=2 \\\n"
             elif self._mainDiskInterface == "scsi":
@@ -167,6 +725,23 @@ class Vm:
             else:
                 assert False
 
+        # scratch-disk, it is the second harddisk, with the same interface as main-disk
+        if self._scratchDiskPath is not None:
+            cmd += "    -blockdev 'driver=file,filename=%s,node-name=scratch-disk' \\\n" % (self._scratchDiskPath)
+            if self._mainDiskInterface == "ide":
+                if self._qemuVmType == "pc":
+                    cmd += "    -device ide-hd,bus=ide.0,unit=1,drive=scratch-disk \\\n"
+                elif self._qemuVmType == "q35":
+                    cmd += "    -device ide-hd,bus=ide.2,drive=scratch-disk \\\n"
+                else:
+                    assert False
+            elif self._mainDiskInterface == "scsi":
+                cmd += "    -device scsi-hd,drive=scratch-disk \\\n"
+            elif self._mainDiskInterface == "virtio":
+                cmd += "    -device virtio-blk-device,drive=scratch-disk \\\n"
+            else:
+                assert False
+
         # boot-iso-file
         if self._bootFile is not None:
             cmd += "    -blockdev 'driver=file,filename=%s,node-name=boot-cdrom' \\\n" % (self._bootFile)
@@ -178,6 +753,10 @@ class Vm:
             cmd += "    -blockdev 'driver=file,filename=%s,node-name=assistant-floppy' \\\n" % (self._assistantFloppyFile)
             cmd += "    -device floppy,unit=0,drive=assistant-floppy \\\n"
 
+        # balloon device, deflate-on-oom lets the guest take memory back by itself when it is short of memory
+        if self._bBalloon:
+            cmd += "    -device virtio-balloon-pci,id=%s,deflate-on-oom=on \\\n" % (self.BALLOON_PATH.split("/")[-1])
+
         # graphics device
         if self._bShow:
             cmd += "    -display gtk \\\n"
@@ -193,14 +772,32 @@ class Vm:
     #             cmd += " -spice port=%d,addr=127.0.0.1,disable-ticketing,agent-mouse=off" % (self.spicePort)
     #             cmd += " -device VGA,bus=%s,addr=0x%02x" % (pciBus, pciSlot)
 
-        # network device
+        # network device, guest agent and http proxy are reached by guest through it
         if True:
-            cmd += "    -netdev user,id=eth0 \\\n"
+            netdevOpts = "user,id=eth0"
+            netdevOpts += ",guestfwd=tcp:%s:%d-unix:%s" % (self._agentBridge.GUEST_ADDRESS, self._agentBridge.GUEST_PORT, self._agentBridge.path)
+            if self._httpProxy is not None:
+                assert self._httpProxy.is_running()
+                netdevOpts += ",guestfwd=tcp:%s:%d-tcp:127.0.0.1:%d" % (self._httpProxy.GUEST_ADDRESS, self._httpProxy.GUEST_PORT, self._httpProxy.port)
+            cmd += "    -netdev %s \\\n" % (netdevOpts)
             cmd += "    -device rtl8139,netdev=eth0,romfile= \\\n"
 
+        # serial console, it is COM1 in guest
+        if self._buildLog is not None:
+            cmd += "    -chardev socket,id=console,path=%s,server=on,wait=off \\\n" % (self._consoleSockFile)
+            cmd += "    -device isa-serial,chardev=console \\\n"
+
         # monitor interface
         if True:
             cmd += "    -qmp tcp:127.0.0.1:%d,server,nowait \\\n" % (self._qmpPort)
+            if self._buildLog is not None:
+                # dedicated monitor for event capture, so it does not interfere with commands
+                cmd += "    -qmp tcp:127.0.0.1:%d,server,nowait \\\n" % (self._qmpEventPort)
+
+        # vm state is loaded by "migrate-incoming" command, vm is not started after loading
+        if self._incoming:
+            cmd += "    -S \\\n"
+            cmd += "    -incoming defer \\\n"
 
         # eliminate the last " \\\n"
         cmd = cmd[:-3] + "\n"
@@ -208,10 +805,75 @@ class Vm:
         return cmd
 
 
+class _QmpCommand:
+    """Driver step which executes a QMP command in the running VM"""
+
+    def __init__(self, vm, name, **arguments):
+        self._vm = vm
+        self._name = name
+        self._arguments = arguments
+
+    def run(self):
+        return self._vm._getQmp().command(self._name, **self._arguments)
+
+    async def async_run(self):
+        return await (await self._vm.async_get_qmp()).command(self._name, **self._arguments)
+
+
+class _IdleMeter:
+
+    def __init__(self, tidList, threshold=0.05, duration=10):
+        self._tidList = tidList
+        self._threshold = threshold
+        self._duration = duration
+        self._clkTck = os.sysconf("SC_CLK_TCK")
+        self._idleSince = None
+        self._lastTicks, self._lastTime = self._getTicks(), time.monotonic()
+
+    def update(self):
+        # returns True if usage of the vcpu threads stays below threshold for duration seconds
+        curTicks, curTime = self._getTicks(), time.monotonic()
+        usage = (curTicks - self._lastTicks) / self._clkTck / (curTime - self._lastTime) / len(self._tidList)
+        self._lastTicks, self._lastTime = curTicks, curTime
+        if usage < self._threshold:
+            if self._idleSince is None:
+                self._idleSince = curTime
+            elif curTime - self._idleSince >= self._duration:
+                return True
+        else:
+            self._idleSince = None
+        return False
+
+    def _getTicks(self):
+        ret = 0
+        for tid in self._tidList:
+            with open("/proc/%d/stat" % (tid), "r") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            ret += int(fields[11]) + int(fields[12])           # utime and stime
+        return ret
+
+
+class _StreamWriter:
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def __call__(self, buf):
+        self._stream.write(buf.decode("utf-8", "replace"))
+        self._stream.flush()
+
+
 class VmUtil:
 
+    SCRATCH_LABEL = "WSTAGE4TMP"
+
+    KSM_DIR = "/sys/kernel/mm/ksm"
+
+    TCG_TB_SIZE = 1024          # translation block cache size in MiB, the bigger the less re-translation for windows' huge code base
+
     @staticmethod
-    def getBootstrapVm(arch, version, edition, lang, mainDiskPath, bootIsoFile, assistantFloppyFile):
+    def getBootstrapVm(arch, version, edition, lang, addons, mainDiskPath, bootIsoFile, assistantFloppyFile, diskAllocation=DiskAllocation.SPARSE, memoryBackend=None, httpProxy=None, buildLog=None,
+                       memoryMerge=False, memoryBalloon=False):
         buf = json.dumps({
             "arch": arch,
             "version": version,
@@ -219,21 +881,224 @@ class VmUtil:
             "lang": lang,
         }) + "\n"
 
-        with open(mainDiskPath, 'wb') as f:
-            f.truncate(VmUtil.getMainDiskSize(arch, version, edition, lang) * 1000 * 1000 * 1000)
-            if True:
-                f.seek(512)
-                f.write(buf.encode("iso8859-1"))
+        DiskImageUtil.createImage(mainDiskPath, VmUtil.getMainDiskSize(arch, version, edition, lang, addons) * 1000 * 1000 * 1000, diskAllocation)
+        disk = DiskPartitioner.openDiskImage(mainDiskPath)
+        try:
+            disk.pwrite(buf.encode("iso8859-1"), 512)
+        finally:
+            disk.close()
 
         ret = Vm.__new__(Vm)
-        ret._init(True, arch, version, edition, lang, mainDiskPath, bootIsoFile, assistantFloppyFile)
+        ret._init(True, arch, version, edition, lang, mainDiskPath, bootIsoFile, assistantFloppyFile, memoryBackend, httpProxy, buildLog, None, memoryMerge, memoryBalloon)
         return ret
 
     @staticmethod
-    def getMainDiskSize(arch, version, edition, lang):
-        if version in [Version.WINDOWS_98, Version.WINDOWS_XP]:
-            return 10
+    def createScratchDisk(path, size):
+        """Create a sparse disk image with one NTFS partition, returns its generation id"""
+
+        DiskImageUtil.createImage(path, size, DiskAllocation.SPARSE)
+        disk = DiskPartitioner.openDiskImage(path)
+        try:
+            partList = DiskPartitioner.createMbr(disk, [PartitionSpec("*", Util.fsTypeNtfs, label=VmUtil.SCRATCH_LABEL)], bootIndex=0)
+            DiskPartitioner.formatPartition(disk, partList[0], VmUtil.SCRATCH_LABEL)
+        finally:
+            disk.close()
+        return VmUtil.renewScratchDiskId(path)
+
+    @staticmethod
+    def getScratchDiskId(path):
+        """Returns generation id of the scratch disk, None if it does not exist"""
+
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            f.seek(512)
+            return f.read(32).decode("ascii", "replace")
+
+    @staticmethod
+    def renewScratchDiskId(path):
+        """Change generation id of the scratch disk, it should be done before any VM uses it, returns the new id"""
+
+        # the id is in the second sector, which is not used by MBR partitioning
+        ret = uuid.uuid4().hex
+        with open(path, "r+b") as f:
+            f.seek(512)
+            f.write(ret.encode("ascii"))
+        return ret
+
+    @staticmethod
+    def probeMemoryBackend(memorySize, preferred):
+        """Returns (MemoryBackend, reason, qemu-object-options), falls back to MemoryBackend.ANONYMOUS if the preferred one is not available"""
+
+        if preferred in [None, MemoryBackend.HUGEPAGES]:
+            pageSize, freePages = VmUtil._getHugePageInfo()
+            if pageSize is None:
+                reason = "huge pages are not supported by host kernel"
+            elif freePages * pageSize < memorySize * 1024 * 1024:
+                reason = "only %d free huge pages of %d KiB, %d MiB needed" % (freePages, pageSize // 1024, memorySize)
+            else:
+                mntDir = VmUtil._getHugetlbfsMountPoint(pageSize)
+                if mntDir is not None:
+                    opts = "memory-backend-file,id=mem0,size=%dM,mem-path=%s,prealloc=on,share=off" % (memorySize, mntDir)
+                    return (MemoryBackend.HUGEPAGES, "hugetlbfs mounted on %s" % (mntDir), opts)
+                elif hasattr(os, "memfd_create"):
+                    opts = "memory-backend-memfd,id=mem0,size=%dM,hugetlb=on,hugetlbsize=%d,prealloc=on" % (memorySize, pageSize)
+                    return (MemoryBackend.HUGEPAGES, "no writable hugetlbfs mount, use hugetlb memfd", opts)
+                else:
+                    reason = "no writable hugetlbfs mount and no memfd support"
+            if preferred is None:
+                reason += ", huge pages not used"
+                return (MemoryBackend.ANONYMOUS, reason, None)
+            return (MemoryBackend.ANONYMOUS, reason + ", fall back to anonymous memory", None)
+
+        if preferred == MemoryBackend.MEMFD:
+            if not hasattr(os, "memfd_create"):
+                return (MemoryBackend.ANONYMOUS, "memfd is not supported, fall back to anonymous memory", None)
+            opts = "memory-backend-memfd,id=mem0,size=%dM,share=on" % (memorySize)
+            return (MemoryBackend.MEMFD, "requested", opts)
+
+        if preferred == MemoryBackend.ANONYMOUS:
+            return (MemoryBackend.ANONYMOUS, "requested", None)
+
+        assert False
+
+    @staticmethod
+    def probeMemoryMerge(memoryBackend):
+        """Returns (enabled, reason)"""
+
+        if memoryBackend == MemoryBackend.HUGEPAGES:
+            return (False, "huge pages can't be merged by KSM")
+        try:
+            with open(os.path.join(VmUtil.KSM_DIR, "run"), "r") as f:
+                run = int(f.read().strip())
+        except OSError:
+            return (False, "KSM is not supported by host kernel")
+        if run != 1:
+            return (True, "KSM is not running, memory is merged once it is started by writing 1 to %s/run" % (VmUtil.KSM_DIR))
+        return (True, "KSM is running")
+
+    @staticmethod
+    def probeAccelerator(arch, version):
+        """Returns (accelerator-name, reason, qemu-accel-options, cpu-model)"""
+
+        ok, reason = VmUtil._checkKvm(arch)
+        if ok:
+            return ("kvm", reason, "kvm", "host")
+
+        # "-cpu host" needs kvm, use the richest model tcg can emulate, windows 98 is not happy with too new a cpu
+        if version == Version.WINDOWS_98:
+            cpuModel = "pentium3"
+        else:
+            cpuModel = "max"
+        return ("tcg", reason, "tcg,thread=multi,tb-size=%d" % (VmUtil.TCG_TB_SIZE), cpuModel)
+
+    @staticmethod
+    def getRtcBase(lang):
+        """Returns (qemu-rtc-base, reason), windows keeps RTC in local time, which is the time of the time zone set by answer file"""
+
+        # must be the same time zones as the ones in answer files
+        tzName = {
+            Lang.en_US: "America/New_York",
+            Lang.zh_CN: "Asia/Shanghai",
+            Lang.zh_TW: "Asia/Taipei",
+        }[lang]
+        try:
+            tz = zoneinfo.ZoneInfo(tzName)
+        except zoneinfo.ZoneInfoNotFoundError:
+            return ("localtime", "time zone %s is not in host time zone database, use host local time" % (tzName))
+        return (datetime.datetime.now(tz).strftime("%Y-%m-%dT%H:%M:%S"), "host time in %s" % (tzName))
+
+    @staticmethod
+    def _checkKvm(arch):
+        # returns (usable, reason), the check is done by opening /dev/kvm, so membership of "kvm" group is honored
+        KVM_GET_API_VERSION = 0xAE00
+        KVM_CHECK_EXTENSION = 0xAE03
+        KVM_CAP_USER_MEMORY = 3
+        KVM_API_VERSION = 12
+
+        hostMachine = platform.machine()
+        if hostMachine not in ["x86_64", "i386", "i686"]:
+            return (False, "host cpu %s can't run %s guest with kvm" % (hostMachine, arch.name))
+        if arch == Arch.X86_64 and hostMachine != "x86_64":
+            return (False, "32bit host can't run 64bit guest with kvm")
+        if not os.path.exists("/dev/kvm"):
+            return (False, "/dev/kvm does not exist, kvm module is not loaded or virtualization is disabled in firmware")
+        try:
+            fd = os.open("/dev/kvm", os.O_RDWR | os.O_CLOEXEC)
+        except PermissionError:
+            return (False, "no permission to access /dev/kvm, current user should be added to group \"kvm\"")
+        except OSError as e:
+            return (False, "failed to open /dev/kvm, %s" % (e.strerror))
+        try:
+            if fcntl.ioctl(fd, KVM_GET_API_VERSION) != KVM_API_VERSION:
+                return (False, "unsupported kvm API version")
+            if fcntl.ioctl(fd, KVM_CHECK_EXTENSION, KVM_CAP_USER_MEMORY) <= 0:
+                return (False, "kvm lacks capability KVM_CAP_USER_MEMORY")
+        except OSError as e:
+            return (False, "failed to query /dev/kvm, %s" % (e.strerror))
+        finally:
+            os.close(fd)
+        return (True, "/dev/kvm is accessible")
+
+    @staticmethod
+    def _getHugePageInfo():
+        # returns (default-huge-page-size-in-bytes, number-of-free-pages)
+        pageSize = None
+        freePages = None
+        try:
+            with open("/proc/meminfo", "r") as f:
+                for line in f:
+                    if line.startswith("Hugepagesize:"):
+                        pageSize = int(line.split()[1]) * 1024
+                    elif line.startswith("HugePages_Free:"):
+                        freePages = int(line.split()[1])
+        except OSError:
+            pass
+        if pageSize is None or freePages is None:
+            return (None, 0)
+        return (pageSize, freePages)
+
+    @staticmethod
+    def _getHugetlbfsMountPoint(pageSize):
+        for entry in MountTable.get().get_entries():
+            if entry.fs_type != "hugetlbfs":
+                continue
+            m = re.search(r"(^|,)pagesize=([0-9]+)([KMG]?)", entry.super_opts)
+            if m is not None:
+                mntPageSize = int(m.group(2)) * {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}[m.group(3)]
+                if mntPageSize != pageSize:
+                    continue
+            if os.access(entry.mnt_point, os.W_OK | os.X_OK):
+                return entry.mnt_point
+        return None
+
+    @staticmethod
+    def getMemorySize(arch):
+        # in MiB
+        if arch == Arch.X86:
+            return 1024
+        elif arch == Arch.X86_64:
+            return 4096
+        else:
+            assert False
+
+    @staticmethod
+    def getMainDiskSize(arch, version, edition, lang, addons=[]):
+        # in GB, size of the installed system plus the space needed by setup and the selected addons
+        if version in [Version.WINDOWS_98]:
+            ret = 4
+        elif version in [Version.WINDOWS_XP]:
+            ret = 10 if arch == Arch.X86 else 12
         elif version in [Version.WINDOWS_7]:
-            return 20
+            ret = 20 if arch == Arch.X86 else 25
         else:
             assert False
+
+        if "lang-packs" in addons:
+            ret += 1 if version in [Version.WINDOWS_98, Version.WINDOWS_XP] else 3
+        if "hotfixes" in addons:
+            # superseded files are kept in WinSxS/$NtUninstall$ directories
+            ret += 1 if version in [Version.WINDOWS_98, Version.WINDOWS_XP] else 8
+        if "common-drivers" in addons:
+            ret += 1
+        return ret
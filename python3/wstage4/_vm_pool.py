@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import fcntl
+import hashlib
+import tempfile
+import threading
+from ._util import Util
+from ._errors import VmError
+from ._disk_image import DiskImageUtil
+from ._vm import Vm
+
+
+class VmPool:
+    """
+    Keeps pre-restored VMs for images, so that a VM is handed out in seconds instead of a cold boot of windows.
+
+    For each image a snapshot is taken once: the image is booted on an overlay until the guest agent answers,
+    then RAM and device state is saved. Every instance runs on its own throwaway overlay on top of the snapshot
+    overlay, so the image is not touched unless a lease is committed. Snapshots are kept in pool_dir and are reused
+    across processes until the image file is changed. A process holds a shared lock on <image-key>/.lock while it
+    uses the snapshot, the snapshot is only created or removed with the exclusive lock.
+
+    Layout of the pool directory:
+        <image-key>/base.qcow2           overlay of the image, disk state at the time the snapshot was taken
+        <image-key>/base.state(.json)    RAM and device state of the booted and idle guest
+        <image-key>/lease-*.qcow2        overlays of instances
+        <image-key>/.lock                lock file, it is never removed so that all processes lock the same file
+    """
+
+    def __init__(self, pool_dir, size=1, memory_backend=None, boot_timeout=1800, memory_merge=False, memory_balloon=False):
+        assert size >= 0
+
+        self._poolDir = pool_dir
+        self._size = size
+        self._memoryBackend = memory_backend
+        self._memoryMerge = memory_merge           # instances restored from the same snapshot are merged almost entirely
+        self._memoryBalloon = memory_balloon
+        self._bootTimeout = boot_timeout
+
+        self._lock = threading.Lock()
+        self._entries = dict()          # image-key -> _PoolEntry
+
+    def lease(self, image_filepath):
+        """Returns a VmLease whose VM is running"""
+
+        entry = self._getEntry(image_filepath)
+        with self._lock:
+            inst = entry.readyList.pop(0) if len(entry.readyList) > 0 else None
+        if inst is None:
+            inst = self._restoreInstance(entry)
+        try:
+            inst[0]._resume()
+        except BaseException:
+            self._destroyInstance(inst)
+            raise
+        with self._lock:
+            entry.leaseCount += 1
+        self._startRefill(entry)
+        return VmLease(self, entry, inst)
+
+    def invalidate(self, image_filepath):
+        """Drop the snapshot and idle instances of image_filepath, raises VmError if the snapshot is still in use"""
+
+        key = self._getKey(image_filepath)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._dropEntry(entry)
+            self._unlockEntry(entry)
+
+        dirpath = os.path.join(self._poolDir, key)
+        if os.path.exists(dirpath):
+            with open(os.path.join(dirpath, ".lock"), "a") as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise VmError("snapshot of \"%s\" is in use" % (image_filepath))
+                _removeSnapshotFiles(dirpath)
+
+    def close(self):
+        with self._lock:
+            entryList = list(self._entries.values())
+            self._entries = dict()
+        for entry in entryList:
+            self._dropEntry(entry)
+            self._unlockEntry(entry)
+
+    def _getKey(self, imageFile):
+        # image file changed means the snapshot is stale
+        st = os.stat(imageFile)
+        buf = "%s %d %d" % (os.path.realpath(imageFile), st.st_size, st.st_mtime_ns)
+        return hashlib.sha256(buf.encode("utf-8")).hexdigest()[:16]
+
+    def _getEntry(self, imageFile):
+        key = self._getKey(imageFile)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = _PoolEntry(imageFile, os.path.join(self._poolDir, key))
+            entry = self._entries[key]
+        with entry.snapshotLock:
+            if entry.lockFile is None:
+                os.makedirs(entry.dirpath, exist_ok=True)
+                entry.lockFile = open(os.path.join(entry.dirpath, ".lock"), "a")
+                fcntl.flock(entry.lockFile, fcntl.LOCK_SH)
+            if not os.path.exists(entry.stateFile + ".json"):
+                # converting the lock is not atomic, so the snapshot may be created by another process in between
+                fcntl.flock(entry.lockFile, fcntl.LOCK_EX)
+                try:
+                    if not os.path.exists(entry.stateFile + ".json"):
+                        self._createSnapshot(entry)
+                finally:
+                    fcntl.flock(entry.lockFile, fcntl.LOCK_SH)
+        return entry
+
+    def _createSnapshot(self, entry):
+        # base.qcow2 and base.state are left-overs of a failed creation if they exist, they are overwritten
+        Util.cmdCall("qemu-img", "create", "-q", "-f", "qcow2",
+                     "-b", os.path.abspath(entry.imageFile), "-F", DiskImageUtil.getFormat(entry.imageFile), entry.baseFile)
+        vm = Vm(entry.baseFile, memory_backend=self._memoryBackend, memory_merge=self._memoryMerge, memory_balloon=self._memoryBalloon)
+        vm.start()
+        try:
+            vm.get_agent(timeout=self._bootTimeout)
+        except BaseException:
+            vm._kill()
+            vm.stop()
+            raise
+        vm.save_state(entry.stateFile + ".tmp")
+        os.rename(entry.stateFile + ".tmp", entry.stateFile)
+        os.rename(entry.stateFile + ".tmp.json", entry.stateFile + ".json")
+
+    def _restoreInstance(self, entry):
+        # returns (vm, overlay-file), vm is paused
+        fd, overlayFile = tempfile.mkstemp(dir=entry.dirpath, prefix="lease-", suffix=".qcow2")
+        os.close(fd)
+        try:
+            Util.cmdCall("qemu-img", "create", "-q", "-f", "qcow2", "-b", entry.baseFile, "-F", "qcow2", overlayFile)
+            vm = Vm(overlayFile, memory_backend=self._memoryBackend, memory_merge=self._memoryMerge, memory_balloon=self._memoryBalloon)
+            vm._start(False, entry.stateFile)
+            return (vm, overlayFile)
+        except BaseException:
+            os.unlink(overlayFile)
+            raise
+
+    def _destroyInstance(self, inst):
+        vm, overlayFile = inst
+        vm._kill()
+        vm.stop()
+        if os.path.exists(overlayFile):
+            os.unlink(overlayFile)
+
+    def _startRefill(self, entry):
+        def __refill():
+            try:
+                while True:
+                    with self._lock:
+                        if entry.bDropped or len(entry.readyList) >= self._size:
+                            return
+                    inst = self._restoreInstance(entry)
+                    with self._lock:
+                        if not entry.bDropped:
+                            entry.readyList.append(inst)
+                            inst = None
+                    if inst is not None:
+                        self._destroyInstance(inst)
+            except Exception:
+                pass                        # the next lease restores synchronously and reports the error
+            finally:
+                with self._lock:
+                    entry.refillThread = None
+
+        with self._lock:
+            if entry.refillThread is None and self._size > 0:
+                entry.refillThread = threading.Thread(target=__refill, daemon=True)
+                entry.refillThread.start()
+
+    def _unlockEntry(self, entry):
+        # the shared lock is held until the entry is dropped and all its leases are gone
+        with self._lock:
+            if not entry.bDropped or entry.leaseCount > 0 or entry.lockFile is None:
+                return
+            f = entry.lockFile
+            entry.lockFile = None
+        f.close()
+
+    def _dropEntry(self, entry):
+        with self._lock:
+            entry.bDropped = True
+            instList = entry.readyList
+            entry.readyList = []
+            t = entry.refillThread
+        if t is not None:
+            t.join()
+        for inst in instList:
+            self._destroyInstance(inst)
+
+
+class VmLease:
+
+    def __init__(self, pool, entry, inst):
+        self._pool = pool
+        self._entry = entry
+        self._inst = inst
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self._inst is not None:
+            self.release()
+
+    @property
+    def vm(self):
+        return self._inst[0]
+
+    def release(self):
+        """Throw away the VM and all its changes"""
+
+        assert self._inst is not None
+        self._pool._destroyInstance(self._inst)
+        self._inst = None
+        with self._pool._lock:
+            self._entry.leaseCount -= 1
+        self._pool._unlockEntry(self._entry)
+
+    def commit(self):
+        """Shutdown guest cleanly, then write all its changes into the image, snapshot of the image is dropped"""
+
+        assert self._inst is not None
+        with self._pool._lock:
+            if self._entry.leaseCount > 1:
+                raise VmError("can not commit while other leases of \"%s\" are active" % (self._entry.imageFile))
+
+        # other processes using the snapshot hold the shared lock, a failed conversion loses the lock so it is taken again
+        try:
+            fcntl.flock(self._entry.lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fcntl.flock(self._entry.lockFile, fcntl.LOCK_SH)
+            raise VmError("can not commit while \"%s\" is used by other processes" % (self._entry.imageFile))
+
+        vm, overlayFile = self._inst
+        try:
+            vm.stop()
+            try:
+                # changes in the snapshot overlay are committed too, they are what the guest saw when it started
+                Util.cmdCall("qemu-img", "commit", "-q", "-b", os.path.abspath(self._entry.imageFile), overlayFile)
+            finally:
+                os.unlink(overlayFile)
+                self._inst = None
+                with self._pool._lock:
+                    self._entry.leaseCount -= 1
+            self._pool._dropEntry(self._entry)
+            with self._pool._lock:
+                self._pool._entries = {k: v for k, v in self._pool._entries.items() if v is not self._entry}
+            _removeSnapshotFiles(self._entry.dirpath)
+        finally:
+            if self._entry.lockFile is not None:
+                fcntl.flock(self._entry.lockFile, fcntl.LOCK_SH)
+            self._pool._unlockEntry(self._entry)
+
+
+class _PoolEntry:
+
+    def __init__(self, imageFile, dirpath):
+        self.imageFile = imageFile
+        self.dirpath = dirpath
+        self.baseFile = os.path.join(dirpath, "base.qcow2")
+        self.stateFile = os.path.join(dirpath, "base.state")
+        self.snapshotLock = threading.Lock()
+        self.lockFile = None                # file object holding the lock on .lock
+        self.readyList = []                 # [(vm, overlay-file)]
+        self.refillThread = None
+        self.leaseCount = 0
+        self.bDropped = False
+
+
+def _removeSnapshotFiles(dirpath):
+    # caller holds the exclusive lock, the state is removed first so a half-removed snapshot never looks valid,
+    # overlays of instances are removed by their owners
+    for fn in ["base.state.json", "base.state", "base.qcow2"]:
+        try:
+            os.unlink(os.path.join(dirpath, fn))
+        except FileNotFoundError:
+            pass
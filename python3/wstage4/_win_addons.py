@@ -22,16 +22,18 @@
 
 
 from ._const import Version
+from ._errors import AddonStoreError
 
 
 class AddonRepo:
 
-    def __init__(self, arch, version, edition, lang):
+    def __init__(self, arch, version, edition, lang, store=None):
         self._arch = arch
         self._version = version
         self._variantList = edition
         self._langList = lang
-    
+        self._store = store
+
     def getAddonNames(self):
         if self._version == Version.WINDOWS_98:
             return ["lang-packs", "hotfixes", "common-drivers", "virtio-drivers"]
@@ -42,42 +44,16 @@ class AddonRepo:
         else:
             assert False
 
+    def hasAddon(self, name):
+        assert name in self.getAddonNames()
+        return self._store is not None and self._store.has_addon(self._version, self._arch, name)
+
     def getAddon(self, name):
-        if self._version == Version.WINDOWS_98:
-            if name == "lang-packs":
-                pass
-            elif name == "hotfixes":
-                pass
-            elif name == "common-drivers":
-                pass
-            elif name == "virtio-drivers":
-                pass
-            else:
-                assert False
-        elif self._version == Version.WINDOWS_XP:
-            if name == "lang-packs":
-                pass
-            elif name == "hotfixes":
-                pass
-            elif name == "common-drivers":
-                pass
-            elif name == "virtio-drivers":
-                pass
-            else:
-                assert False
-        elif self._version == Version.WINDOWS_7:
-            if name == "lang-packs":
-                pass
-            elif name == "hotfixes":
-                pass
-            elif name == "common-drivers":
-                pass
-            elif name == "virtio-drivers":
-                pass
-            else:
-                assert False
-        else:
-            assert False
+        # addons are resolved from the local store only, no network access is needed once the store is populated
+        assert name in self.getAddonNames()
+        if self._store is None:
+            raise AddonStoreError("no addon store specified")
+        return self._store.get_addon(self._version, self._arch, name)
 
 
 class Windows98Addon:
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import io
+import re
+import json
+import hashlib
+import tempfile
+import pycdlib
+import xml.etree.ElementTree
+from ._util import Util
+from ._const import Arch, Version
+from ._errors import InstallMediaError
+
+
+class HotfixSlipstream:
+    """
+    Integrate the packages of the "hotfixes" addon into the install media, so that setup installs an already-patched system.
+
+    Windows XP: packages are put into <arch-dir>/SVCPACK with 8.3 names and listed in SVCPACK.INF, setup runs them at T-13
+                before first boot.
+    Windows 7: cab files are extracted from msu packages and installed by setup in offlineServicing pass,
+               the answer file needs the list returned by get_servicing_packages().
+
+    Result is cached in cache_dir per (ISO hash, hotfix set).
+    """
+
+    HOTFIX_GUEST_DIR = "wstage4\\hotfixes"
+
+    # bumped when the result changes for the same input, it is part of the cache key and an input of the step cache
+    VERSION = 2
+
+    def __init__(self, arch, version, cache_dir):
+        self._arch = arch
+        self._version = version
+        self._cacheDir = os.path.join(cache_dir, "slipstream")
+        self._hashCacheDir = os.path.join(cache_dir, "hashes")
+
+    def get_iso(self, src_iso_filepath, hotfix_addon):
+        """Returns (iso-filepath, servicing-package-list)"""
+
+        os.makedirs(self._cacheDir, exist_ok=True)
+        os.makedirs(self._hashCacheDir, exist_ok=True)
+
+        h = hashlib.sha256()
+        h.update(Util.getFileHash(self._hashCacheDir, src_iso_filepath).encode("ascii"))
+        h.update(hotfix_addon.get_digest().encode("ascii"))
+        h.update(str(self.VERSION).encode("ascii"))
+        key = h.hexdigest()
+
+        isoFile = os.path.join(self._cacheDir, key + ".iso")
+        infoFile = os.path.join(self._cacheDir, key + ".json")
+        if not os.path.exists(isoFile) or not os.path.exists(infoFile):
+            with tempfile.TemporaryDirectory(dir=self._cacheDir) as tmpDir:
+                tmpIsoFile = os.path.join(tmpDir, "out.iso")
+                if self._version == Version.WINDOWS_XP:
+                    packageList = self._slipstreamWindowsXP(src_iso_filepath, hotfix_addon, tmpIsoFile)
+                elif self._version == Version.WINDOWS_7:
+                    packageList = self._slipstreamWindows7(src_iso_filepath, hotfix_addon, tmpIsoFile, tmpDir)
+                else:
+                    assert False
+                os.rename(tmpIsoFile, isoFile)
+                with open(infoFile + ".tmp", "w") as f:
+                    json.dump(packageList, f)
+                os.rename(infoFile + ".tmp", infoFile)
+
+        with open(infoFile, "r") as f:
+            return (isoFile, json.load(f))
+
+    def _slipstreamWindowsXP(self, srcIsoFile, hotfixAddon, dstIsoFile):
+        archDir = "I386" if self._arch == Arch.X86 else "AMD64"
+
+        iso = pycdlib.PyCdlib()
+        iso.open(srcIsoFile)
+        try:
+            # service pack slipstreamed media already has the directory
+            svcpackDir = "/%s/SVCPACK" % (archDir)
+            if not self._exists(iso, svcpackDir, bDir=True):
+                if iso.has_joliet():
+                    iso.add_directory(iso_path=svcpackDir, joliet_path=svcpackDir)
+                else:
+                    iso.add_directory(iso_path=svcpackDir)
+
+            usedList = []
+            for c in iso.list_children(iso_path=svcpackDir):
+                if c.is_file():
+                    usedList.append(c.file_identifier().decode("ascii").split(";")[0])
+
+            fnList = []
+            for relPath, blobPath in hotfixAddon.get_files():
+                if not relPath.lower().endswith(".exe"):
+                    continue
+                fn = SlipstreamUtil.getShortFilename(os.path.basename(relPath), usedList)
+                with open(blobPath, "rb") as f:
+                    self._addFile(iso, "%s/%s" % (svcpackDir, fn), f.read())
+                usedList.append(fn)
+                fnList.append(fn)
+            if len(fnList) == 0:
+                raise InstallMediaError("no hotfix package found")
+
+            # the stock SVCPACK.IN_ is a compressed empty file, replace it with an uncompressed one,
+            # an uncompressed one exists in slipstreamed media, the hotfixes it lists are kept
+            oldList = []
+            if self._exists(iso, "/%s/SVCPACK.INF" % (archDir)):
+                oldList = SlipstreamUtil.getSetupHotfixesToRun(self._readFile(iso, "/%s/SVCPACK.INF" % (archDir)).decode("iso8859-1"))
+                self._rmFile(iso, "/%s/SVCPACK.INF" % (archDir))
+            if self._exists(iso, "/%s/SVCPACK.IN_" % (archDir)):
+                self._rmFile(iso, "/%s/SVCPACK.IN_" % (archDir))
+
+            buf = ""
+            buf += "[Version]\r\n"
+            buf += 'Signature="$Windows NT$"\r\n'
+            buf += "MajorVersion=5\r\n"
+            buf += "MinorVersion=1\r\n"
+            buf += "BuildNumber=2600\r\n"
+            buf += "\r\n"
+            buf += "[SetupData]\r\n"
+            buf += "CatalogSubDir=\"\\%s\\svcpack\"\r\n" % (archDir)
+            buf += "\r\n"
+            buf += "[SetupHotfixesToRun]\r\n"
+            for line in oldList:
+                buf += "%s\r\n" % (line)
+            for fn in fnList:
+                buf += "%s /Q /N /Z\r\n" % (fn)
+            self._addFile(iso, "/%s/SVCPACK.INF" % (archDir), buf.encode("iso8859-1"))
+
+            # let setup copy the svcpack directory and the uncompressed SVCPACK.INF
+            self._patchFile(iso, "/%s/DOSNET.INF" % (archDir), SlipstreamUtil.patchDosnetInf)
+            self._patchFile(iso, "/%s/TXTSETUP.SIF" % (archDir), SlipstreamUtil.patchTxtsetupSif)
+
+            iso.write(dstIsoFile)
+        finally:
+            iso.close()
+
+        return []
+
+    def _slipstreamWindows7(self, srcIsoFile, hotfixAddon, dstIsoFile, tmpDir):
+        archName = "x86" if self._arch == Arch.X86 else "amd64"
+
+        iso = pycdlib.PyCdlib()
+        iso.open(srcIsoFile)
+        try:
+            iso.add_directory(udf_path="/wstage4")
+            iso.add_directory(udf_path="/wstage4/hotfixes")
+
+            ret = []
+            for relPath, blobPath in hotfixAddon.get_files():
+                if not relPath.lower().endswith(".msu"):
+                    continue
+
+                # msu is a cab file, the real package is the cab inside it
+                extDir = os.path.join(tmpDir, os.path.basename(relPath))
+                os.mkdir(extDir)
+                Util.cmdCall("cabextract", "-q", "-F", "Windows6.1-*-%s.cab" % (archName), "-d", extDir, blobPath)
+                cabList = [x for x in os.listdir(extDir) if x.lower().endswith(".cab")]
+                if len(cabList) != 1:
+                    raise InstallMediaError("invalid hotfix package \"%s\"" % (relPath))
+                cabFile = os.path.join(extDir, cabList[0])
+                Util.cmdCall("cabextract", "-q", "-F", "update.mum", "-d", extDir, cabFile)
+
+                with open(cabFile, "rb") as f:
+                    self._addFile(iso, "/wstage4/hotfixes/%s" % (cabList[0]), f.read(), udf=True)
+                ret.append({
+                    "cab": "%s\\%s" % (self.HOTFIX_GUEST_DIR, cabList[0]),
+                    "identity": SlipstreamUtil.parseUpdateMum(os.path.join(extDir, "update.mum")),
+                })
+            if len(ret) == 0:
+                raise InstallMediaError("no hotfix package found")
+
+            iso.write(dstIsoFile)
+        finally:
+            iso.close()
+
+        return ret
+
+    def _addFile(self, iso, path, buf, udf=False):
+        # path must be a valid ISO9660 level 1 path, the same name is used in joliet
+        if udf:
+            iso.add_fp(io.BytesIO(buf), len(buf), udf_path=path)
+        elif iso.has_joliet():
+            iso.add_fp(io.BytesIO(buf), len(buf), iso_path=path + ";1", joliet_path=path)
+        else:
+            iso.add_fp(io.BytesIO(buf), len(buf), iso_path=path + ";1")
+
+    def _readFile(self, iso, path):
+        bio = io.BytesIO()
+        iso.get_file_from_iso_fp(bio, iso_path=path + ";1")
+        return bio.getvalue()
+
+    def _rmFile(self, iso, path):
+        if iso.has_joliet():
+            iso.rm_file(iso_path=path + ";1", joliet_path=path)
+        else:
+            iso.rm_file(iso_path=path + ";1")
+
+    def _patchFile(self, iso, path, patchFunc):
+        buf = patchFunc(self._readFile(iso, path).decode("iso8859-1")).encode("iso8859-1")
+        self._rmFile(iso, path)
+        self._addFile(iso, path, buf)
+
+    def _exists(self, iso, path, bDir=False):
+        try:
+            iso.get_record(iso_path=(path if bDir else path + ";1"))
+            return True
+        except pycdlib.pycdlibexception.PyCdlibInvalidInput:
+            return False
+
+
+class SlipstreamUtil:
+
+    @staticmethod
+    def getShortFilename(filename, usedList):
+        """
+        Returns an ISO9660 level 1 name (8.3, upper case letters, digits and underscore) for a hotfix package.
+        KB number is kept when it fits, so that the name in SVCPACK.INF is still recognizable.
+        """
+
+        stem, ext = os.path.splitext(filename.upper())
+        ext = re.sub(r"[^A-Z0-9_]", "_", ext[1:])[:3]
+        candidateList = []
+        if re.fullmatch(r"[A-Z0-9_]{1,8}", stem) is not None:
+            candidateList.append(stem)
+        m = re.search(r"KB\d{1,6}(?!\d)", stem)
+        if m is not None:
+            candidateList.append(m.group(0))
+        candidateList += ["HF%06d" % (i) for i in range(1, len(usedList) + 2)]
+
+        for c in candidateList:
+            ret = c + "." + ext if ext != "" else c
+            if ret not in usedList:
+                return ret
+        assert False
+
+    @staticmethod
+    def getSetupHotfixesToRun(buf):
+        m = re.search(r"^\[SetupHotfixesToRun\][^\[]*", buf, re.M | re.I)
+        if m is None:
+            return []
+        lineList = [x.strip() for x in m.group(0).split("\n")[1:]]
+        return [x for x in lineList if x != "" and not x.startswith(";")]
+
+    @staticmethod
+    def patchDosnetInf(buf):
+        m = re.search(r"^\[OptionalSrcDirs\][^\[]*", buf, re.M)
+        if m is None:
+            return buf.rstrip("\r\n") + "\r\n\r\n[OptionalSrcDirs]\r\nsvcpack\r\n"
+        if re.search(r"^svcpack\s*$", m.group(0), re.M | re.I) is not None:
+            return buf
+        return buf[:m.start()] + "[OptionalSrcDirs]\r\nsvcpack\r\n" + buf[m.start() + len("[OptionalSrcDirs]\r\n"):]
+
+    @staticmethod
+    def patchTxtsetupSif(buf):
+        # change "svcpack.inf = 1,,,,,,,20,0,0" so that the uncompressed file is copied
+        return re.sub(r"^svcpack\.inf\s*=.*$", "svcpack.inf = 1,,,,,,,20,0,0\r", buf, flags=re.M | re.I)
+
+    @staticmethod
+    def parseUpdateMum(filepath):
+        root = xml.etree.ElementTree.parse(filepath).getroot()
+        for elem in root.iter():
+            if elem.tag.endswith("assemblyIdentity"):
+                return {k: elem.attrib[k] for k in ["name", "version", "processorArchitecture", "publicKeyToken", "language"]}
+        raise InstallMediaError("invalid update.mum in hotfix package")
@@ -23,42 +23,46 @@
 
 import os
 from ._util import Util
-from ._prototype import StorageLayout
+from ._errors import StorageLayoutError
+from ._mount_table import MountTable
+from ._prototype import StorageLayout, StorageLayoutMountEntry
+from ._disk_image import DiskPartitioner, DiskImageUtil, PartitionSpec
 
 
 class StorageLayouts:
 
+    @staticmethod
     def getStorageLayoutClass(name):
         d = {
-            "fat-win": None,                                            # FIXME
-            "fat-win-data": None,                                       # FIXME
-            "ntfs-win": None,                                           # FIXME
-            "ntfs-win-data": None,                                      # FIXME
+            "fat-win": StorageLayoutFatWin,
+            "fat-win-data": StorageLayoutFatWinData,
+            "ntfs-win": StorageLayoutNtfsWin,
+            "ntfs-win-data": StorageLayoutNtfsWinData,
             "ntfs-sys-win": StorageLayoutNtfsSysWin,
-            "ntfs-sys-win-data": None,                                  # FIXME
-            "ntfs-sys-msr-win": None,                                   # FIXME
-            "ntfs-sys-msr-win-data": None,                              # FIXME
+            "ntfs-sys-win-data": StorageLayoutNtfsSysWinData,
+            "ntfs-sys-msr-win": StorageLayoutNtfsSysMsrWin,
+            "ntfs-sys-msr-win-data": StorageLayoutNtfsSysMsrWinData,
         }
         return d[name]
 
 
-class StorageLayoutNtfsSysWin(StorageLayout):
+class _StorageLayoutBase(StorageLayout):
 
-    """System Reserved partition(NTFS) + windows partition(NTFS) in single harddisk"""
+    # overrided by sub-classes
+    _name = None
+    _partitionType = None
+    _diskPlans = None               # [[(PartitionSpec, mount-directory or None), ...], ...], one list for each disk
 
     def __init__(self):
-        self._hdd = None
-        self._hddSysParti = None
-        self._hddWinParti = None
         self._mnt = None
 
     @property
-    def name():
-        return "sys-win"
+    def name(self):
+        return self._name
 
     @property
     def partition_type(self):
-        return Util.partitionTypeMbr
+        return self._partitionType
 
     @property
     def base_dir(self):
@@ -68,37 +72,187 @@ class StorageLayoutNtfsSysWin(StorageLayout):
         if True:
             self._mnt.umount()
             del self._mnt
-        del self._hddWinParti
-        del self._hddSysParti
-        del self._hdd
 
     def get_mount_entries(self):
-        self._mnt.get_mount_entries()
+        return self._mnt.get_mount_entries()
+
+    @classmethod
+    def _create(cls, disk_list):
+        """Partition and format disk image files (raw or qcow2), no root privilege or loop device is needed"""
+
+        assert len(disk_list) == len(cls._diskPlans)
+
+        for diskPath, plan in zip(disk_list, cls._diskPlans):
+            disk = DiskPartitioner.openDiskImage(diskPath)
+            try:
+                specList = [x[0] for x in plan]
+                if cls._partitionType == Util.partitionTypeMbr:
+                    # only the first disk is bootable
+                    partList = DiskPartitioner.createMbr(disk, specList, bootIndex=(1 if diskPath == disk_list[0] else 0))
+                elif cls._partitionType == Util.partitionTypeGpt:
+                    partList = DiskPartitioner.createGpt(disk, specList)
+                else:
+                    assert False
+                for spec, partInfo in zip(specList, partList):
+                    if spec.fs_type is not None:
+                        DiskPartitioner.formatPartition(disk, partInfo, spec.label)
+            finally:
+                disk.close()
 
     @classmethod
     def _mount(cls, disk_list, base_dir):
-        assert len(disk_list) == 1
+        """Mount partitions of raw disk image files with loop devices, qcow2 images must be converted to raw first"""
+
+        assert len(disk_list) == len(cls._diskPlans)
+
+        # offset and sizelimit of loop mount are positions in the file, which are not disk positions for qcow2
+        for diskPath in disk_list:
+            if DiskImageUtil.getFormat(diskPath) != "raw":
+                raise StorageLayoutError("can not mount \"%s\", only raw disk image is supported" % (diskPath))
+
+        mntParams = []
+        for diskPath, plan in zip(disk_list, cls._diskPlans):
+            disk = DiskPartitioner.openDiskImage(diskPath)
+            try:
+                partList = DiskPartitioner.readPartitions(disk)
+            finally:
+                disk.close()
+            if len(partList) != len(plan):
+                raise StorageLayoutError("partition layout of \"%s\" does not match %s" % (diskPath, cls._name))
+            for (spec, mntDir), partInfo in zip(plan, partList):
+                if mntDir is not None:
+                    mntParams.append(_MountParam(mntDir, diskPath, spec.fs_type, ["offset=%d" % (partInfo.start), "sizelimit=%d" % (partInfo.size)]))
+
+        ret = cls()
+        ret._mnt = _Mount(False, base_dir, mntParams, {})
+        return ret
 
     @classmethod
     def _create_and_mount(cls, disk_list, base_dir):
-        assert len(disk_list) == 1
+        cls._create(disk_list)
+        return cls._mount(disk_list, base_dir)
 
-        # initialize disk
-        Util.initializeDisk(disk_list[0], Util.diskPartTableMbr, [
-            ("100M", Util.fsTypeNtfs),
-            ("*", Util.fsTypeNtfs),
-        ])
 
-        # return
-        ret = cls()
-        ret._hdd = hdd
-        ret._hddSysParti = sysParti
-        ret._hddWinParti = winParti
-        ret._mnt = _Mount(False, base_dir, [
-            _MountParam(Util.driveReserve, ret._hddSysParti, Util.fsTypeNtfs, ""),
-            _MountParam(Util.driveC, ret._hddWinParti, Util.fsTypeNtfs, ""),
-        ], {})
-        return ret
+class StorageLayoutFatWin(_StorageLayoutBase):
+
+    """windows partition(FAT32) in single harddisk"""
+
+    _name = "fat-win"
+    _partitionType = Util.partitionTypeMbr
+    _diskPlans = [
+        [
+            (PartitionSpec("*", Util.fsTypeFat), Util.driveC),
+        ],
+    ]
+
+
+class StorageLayoutFatWinData(_StorageLayoutBase):
+
+    """windows partition(FAT32) in the first harddisk + data partition(FAT32) in the second harddisk"""
+
+    _name = "fat-win-data"
+    _partitionType = Util.partitionTypeMbr
+    _diskPlans = [
+        [
+            (PartitionSpec("*", Util.fsTypeFat), Util.driveC),
+        ],
+        [
+            (PartitionSpec("*", Util.fsTypeFat), Util.driveD),
+        ],
+    ]
+
+
+class StorageLayoutNtfsWin(_StorageLayoutBase):
+
+    """windows partition(NTFS) in single harddisk"""
+
+    _name = "ntfs-win"
+    _partitionType = Util.partitionTypeMbr
+    _diskPlans = [
+        [
+            (PartitionSpec("*", Util.fsTypeNtfs), Util.driveC),
+        ],
+    ]
+
+
+class StorageLayoutNtfsWinData(_StorageLayoutBase):
+
+    """windows partition(NTFS) in the first harddisk + data partition(NTFS) in the second harddisk"""
+
+    _name = "ntfs-win-data"
+    _partitionType = Util.partitionTypeMbr
+    _diskPlans = [
+        [
+            (PartitionSpec("*", Util.fsTypeNtfs), Util.driveC),
+        ],
+        [
+            (PartitionSpec("*", Util.fsTypeNtfs), Util.driveD),
+        ],
+    ]
+
+
+class StorageLayoutNtfsSysWin(_StorageLayoutBase):
+
+    """System Reserved partition(NTFS) + windows partition(NTFS) in single harddisk"""
+
+    _name = "ntfs-sys-win"
+    _partitionType = Util.partitionTypeMbr
+    _diskPlans = [
+        [
+            (PartitionSpec(100 * 1024 * 1024, Util.fsTypeNtfs, label="System Reserved"), Util.driveReserve),
+            (PartitionSpec("*", Util.fsTypeNtfs), Util.driveC),
+        ],
+    ]
+
+
+class StorageLayoutNtfsSysWinData(_StorageLayoutBase):
+
+    """System Reserved partition(NTFS) + windows partition(NTFS) in the first harddisk + data partition(NTFS) in the second harddisk"""
+
+    _name = "ntfs-sys-win-data"
+    _partitionType = Util.partitionTypeMbr
+    _diskPlans = [
+        [
+            (PartitionSpec(100 * 1024 * 1024, Util.fsTypeNtfs, label="System Reserved"), Util.driveReserve),
+            (PartitionSpec("*", Util.fsTypeNtfs), Util.driveC),
+        ],
+        [
+            (PartitionSpec("*", Util.fsTypeNtfs), Util.driveD),
+        ],
+    ]
+
+
+class StorageLayoutNtfsSysMsrWin(_StorageLayoutBase):
+
+    """EFI system partition(FAT32) + Microsoft Reserved partition + windows partition(NTFS) in single GPT harddisk"""
+
+    _name = "ntfs-sys-msr-win"
+    _partitionType = Util.partitionTypeGpt
+    _diskPlans = [
+        [
+            (PartitionSpec(100 * 1024 * 1024, Util.fsTypeFat, part_type="esp", label="SYSTEM"), Util.driveReserve),
+            (PartitionSpec(128 * 1024 * 1024, None, part_type="msr"), None),
+            (PartitionSpec("*", Util.fsTypeNtfs), Util.driveC),
+        ],
+    ]
+
+
+class StorageLayoutNtfsSysMsrWinData(_StorageLayoutBase):
+
+    """EFI system partition(FAT32) + Microsoft Reserved partition + windows partition(NTFS) in the first GPT harddisk + data partition(NTFS) in the second GPT harddisk"""
+
+    _name = "ntfs-sys-msr-win-data"
+    _partitionType = Util.partitionTypeGpt
+    _diskPlans = [
+        [
+            (PartitionSpec(100 * 1024 * 1024, Util.fsTypeFat, part_type="esp", label="SYSTEM"), Util.driveReserve),
+            (PartitionSpec(128 * 1024 * 1024, None, part_type="msr"), None),
+            (PartitionSpec("*", Util.fsTypeNtfs), Util.driveC),
+        ],
+        [
+            (PartitionSpec("*", Util.fsTypeNtfs), Util.driveD),
+        ],
+    ]
 
 
 ###############################################################################
@@ -119,13 +273,14 @@ class _Mount:
         # do mount
         if not bIsMounted:
             for p in self._mntParams:
-                if not os.path.exists(p.getRealDir()):
-                    os.mkdir(p.getRealDir())
-                elif os.path.isdir(p.getRealDir()) and not os.path.islink(p.getRealDir()):
+                realDir = p.getRealDir(self._mntDir)
+                if not os.path.exists(realDir):
+                    os.mkdir(realDir)
+                elif os.path.isdir(realDir) and not os.path.islink(realDir):
                     pass
                 else:
-                    raise errors.StorageLayoutMountError("mount directory \"%s\" is invalid" % (p.getRealDir()))
-                Util.cmdCall("mount", "-t", p.fs_type, "-o", p.mnt_opts, p.target, p.getRealDir())
+                    raise StorageLayoutError("mount directory \"%s\" is invalid" % (realDir))
+            MountTable.mount_batch([(p.fs_type, p.mnt_opts, p.target, p.getRealDir(self._mntDir)) for p in self._mntParams])
 
     @property
     def mount_point(self):
@@ -138,19 +293,20 @@ class _Mount:
     def get_mount_entries(self):
         ret = []
         for p in self._mntParams:
-            item = MountEntry()
+            item = StorageLayoutMountEntry()
             item.mnt_point = p.dir_path
-            item.real_dir_path = p.getRealDir()
+            item.real_dir_path = p.getRealDir(self._mntDir)
             item.target = p.target
             item.fs_type = p.fs_type
-            item.mnt_opts = PhysicalDiskMounts.find_entry_by_mount_point(p.getRealDir()).mnt_opts
+            item.mnt_opts = MountTable.get().find_entry_by_mount_point(item.real_dir_path).mnt_opts
             ret.append(item)
         return ret
 
     def umount(self):
-        for p in reversed(self._mntParams):
-            Util.cmdCall("umount", p.getRealDir())
-            os.rmdir(p.getRealDir())
+        dirList = [p.getRealDir(self._mntDir) for p in reversed(self._mntParams)]
+        MountTable.umount_batch(dirList)
+        for d in dirList:
+            os.rmdir(d)
 
 
 class _MountParam:
@@ -170,5 +326,5 @@ class _MountParam:
     def mnt_opts(self):
         return ",".join(self.mnt_opt_list)
 
-    def getRealDir(self):
-        return os.path.join(mountObj.mount_point, self.dir_path)
+    def getRealDir(self, mntDir):
+        return os.path.join(mntDir, self.dir_path)
@@ -23,12 +23,20 @@
 
 import os
 from ._const import Arch, Version, Edition, Lang
+from ._win_slipstream import HotfixSlipstream
+from ._guest_agent import GuestAgentBridge
+from ._guest_agent_script import FLOPPY_FILENAME as AGENT_FLOPPY_FILENAME, INSTALL_COMMAND as AGENT_INSTALL_COMMAND
 
 
 class AnswerFileGenerator:
 
-    def __init__(self, target_settings):
+    # bumped when generated files change for the same settings, it is an input of the step cache
+    VERSION = 1
+
+    def __init__(self, target_settings, hotfix_packages=[], http_proxy=None):
         self._ts = target_settings
+        self._hotfixPackages = hotfix_packages
+        self._httpProxy = http_proxy                # "host:port" as seen by guest, can be None
 
     def generateFile(self, path):
         if self._ts.version == Version.WINDOWS_98:
@@ -36,13 +44,13 @@ class AnswerFileGenerator:
             obj.generateFile(self._ts, path)
         elif self._ts.version == Version.WINDOWS_XP:
             obj = AnswerFileGeneratorForWindowsXP()
-            obj.generateFile(self._ts, path)
+            obj.generateFile(self._ts, path, self._httpProxy)
         elif self._ts.version == Version.WINDOWS_VISTA:
             # FIXME
             assert False
         elif self._ts.version == Version.WINDOWS_7:
             obj = AnswerFileGeneratorForWindows7()
-            obj.generateFile(self._ts, path)
+            obj.generateFile(self._ts, path, self._hotfixPackages, self._httpProxy)
         elif self._ts.version == Version.WINDOWS_8:
             # FIXME
             assert False
@@ -130,9 +138,6 @@ class AnswerFileGeneratorForWindows98:
         else:
             key = ts.product_key
 
-        timezone = "GMT"
-        # FIXME: get timezone by lang
-
         buf = ""
         buf += "[Setup]\n"
         buf += "Express=1\n"                            # what does it mean?
@@ -150,7 +155,7 @@ class AnswerFileGeneratorForWindows98:
         buf += "Display=0\n"                            # what does it mean?
         buf += "DevicePath=0\n"                         # what does it mean?
         buf += "NoDirWarn=1\n"                          # what does it mean?
-        buf += 'TimeZone="%s"\n' % (timezone)
+        buf += 'TimeZone="%s"\n' % (_Util.getWin98TimezoneByLang(ts.lang))
         buf += "Uninstall=0\n"                          # what does it mean?
         buf += "NoPrompt2Boot=0\n"                      # here 0 means "do not prompt user". Sigh.
         # buf += "VRC=0\n"
@@ -395,17 +400,19 @@ class AnswerFileGeneratorForWindows98:
 
 class AnswerFileGeneratorForWindowsXP:
 
-    def generateFile(self, ts, dstDir):
-        fn, buf = self._get_filename_and_buffer(ts)
+    def generateFile(self, ts, dstDir, httpProxy=None):
+        fn, buf = self._get_filename_and_buffer(ts, httpProxy)
         with open(os.path.join(dstDir, fn), "wb") as f:
             f.write(buf)
+        with open(os.path.join(dstDir, AGENT_FLOPPY_FILENAME), "wb") as f:
+            f.write(GuestAgentBridge.get_guest_script())
 
-    def updateIso(self, ts, isoObj):
-        fn, buf = self._get_filename_and_buffer(ts)
+    def updateIso(self, ts, isoObj, httpProxy=None):
+        fn, buf = self._get_filename_and_buffer(ts, httpProxy)
         isoObj.add_file(udf_path=("/" + fn), file_content=buf)
 
     @staticmethod
-    def _get_filename_and_buffer(ts):
+    def _get_filename_and_buffer(ts, httpProxy):
         if ts.product_key is None:
             key = _Util.getDefaultProductKeyByEdition(ts.arch, ts.version, ts.edition, ts.lang)
         else:
@@ -450,9 +457,16 @@ class AnswerFileGeneratorForWindowsXP:
         buf += "[Networking]\n"
         buf += "InstallDefaultComponents=Yes\n"
         buf += "\n"
+        if httpProxy is not None:
+            buf += "[Proxy]\n"
+            buf += "Proxy_Enable=1\n"
+            buf += "Use_Same_Proxy=0\n"
+            buf += "HTTP_Proxy_Server=%s\n" % (httpProxy)
+            buf += "Proxy_Override=<local>\n"
+            buf += "\n"
         buf += "[GuiRunOnce]\n"
-        buf += 'Command1="ping -n 120"\n'               # wait about 2 minutes for NTP synchronization, shutdown's timeout malfunctions if system time change
-        buf += 'Command2="shutdown /s /f /t 0"\n'
+        buf += 'Command1="%s"\n' % (AGENT_INSTALL_COMMAND)
+        buf += 'Command2="shutdown /s /f /t 0"\n'      # guest clock is synchronized with host from boot, no NTP adjustment to wait for
 
         return ("winnt.sif", buf.encode("iso8859-1"))
 
@@ -474,17 +488,19 @@ class AnswerFileGeneratorForWindowsXP:
 
 class AnswerFileGeneratorForWindows7:
 
-    def generateFile(self, ts, dstDir):
-        fn, buf = self._get_filename_and_buffer(ts)
+    def generateFile(self, ts, dstDir, hotfixPackages=[], httpProxy=None):
+        fn, buf = self._get_filename_and_buffer(ts, hotfixPackages, httpProxy)
         with open(os.path.join(dstDir, fn), "wb") as f:
             f.write(buf)
+        with open(os.path.join(dstDir, AGENT_FLOPPY_FILENAME), "wb") as f:
+            f.write(GuestAgentBridge.get_guest_script())
 
-    def updateIso(self, ts, isoObj):
-        fn, buf = self._get_filename_and_buffer(ts)
+    def updateIso(self, ts, isoObj, hotfixPackages=[], httpProxy=None):
+        fn, buf = self._get_filename_and_buffer(ts, hotfixPackages, httpProxy)
         isoObj.add_file(udf_path=("/" + fn), file_content=buf)
 
     @staticmethod
-    def _get_filename_and_buffer(ts):
+    def _get_filename_and_buffer(ts, hotfixPackages, httpProxy):
         if ts.product_key is None:
             key = _Util.getDefaultProductKeyByEdition(ts.arch, ts.version, ts.edition, ts.lang)
         else:
@@ -507,12 +523,6 @@ class AnswerFileGeneratorForWindows7:
             Lang.zh_TW: "1028:00000404",
         }
 
-        timezoneDict = {
-            Lang.en_US: "Eastern Standard Time",
-            Lang.zh_CN: "China Standard Time",
-            Lang.zh_TW: "China Standard Time",
-        }
-
         buf = """
             <?xml version="1.0" encoding="utf-8"?>
             <unattend xmlns="urn:schemas-microsoft-com:unattend">
@@ -527,6 +537,7 @@ class AnswerFileGeneratorForWindows7:
                         <UserLocale>@@pe_lang@@</UserLocale>
                     </component>
                     <component name="Microsoft-Windows-Setup" @@component_tag_postfix@@>
+                        @@run_synchronous@@
                         <DiskConfiguration>
                             <Disk>
                                 <DiskID>0</DiskID>
@@ -603,7 +614,11 @@ class AnswerFileGeneratorForWindows7:
                         <FirstLogonCommands>
                             <SynchronousCommand>
                                 <Order>1</Order>
-                                <CommandLine>shutdown /s /t 60</CommandLine>
+                                <CommandLine>@@agent_install_command@@</CommandLine>
+                            </SynchronousCommand>
+                            <SynchronousCommand>
+                                <Order>2</Order>
+                                <CommandLine>shutdown /s /f /t 0</CommandLine>
                             </SynchronousCommand>
                         </FirstLogonCommands>
                     </component>
@@ -619,9 +634,23 @@ class AnswerFileGeneratorForWindows7:
                         <SuggestedSitesEnabled>false</SuggestedSitesEnabled>
                         <Home_Page>about:blank</Home_Page>
                     </component>
+                    @@proxy@@
                 </settings>
+                @@servicing@@
             </unattend>
         """
+        # machine-wide proxy setting, used by IE, BITS and msiexec when they download
+        if httpProxy is not None:
+            proxyBuf = ""
+            proxyBuf += "<component name=\"Microsoft-Windows-IE-ClientNetworkProtocolImplementation\" @@component_tag_postfix@@>\n"
+            proxyBuf += "    <HKLMProxyEnable>true</HKLMProxyEnable>\n"
+            proxyBuf += "    <HKLMProxyServer>http=%s</HKLMProxyServer>\n" % (httpProxy)
+            proxyBuf += "    <HKLMProxyBypass>&lt;local&gt;</HKLMProxyBypass>\n"
+            proxyBuf += "</component>\n"
+        else:
+            proxyBuf = ""
+        buf = buf.replace("@@proxy@@", proxyBuf)
+
         buf = buf.replace("@@component_tag_postfix@@", " ".join([
                 'processorArchitecture="%s"' % (archDict[ts.arch]),
                 'publicKeyToken="31bf3856ad364e35"',
@@ -638,7 +667,34 @@ class AnswerFileGeneratorForWindows7:
         buf = buf.replace("@@username@@", "A")
         buf = buf.replace("@@password@@", "")
         buf = buf.replace("@@product_key@@", key)
-        buf = buf.replace("@@timezone@@", timezoneDict[ts.lang])
+        buf = buf.replace("@@timezone@@", _Util.getTimezoneNameByLang(ts.lang))
+        buf = buf.replace("@@agent_install_command@@", AGENT_INSTALL_COMMAND)
+
+        # hotfixes integrated by HotfixSlipstream are installed in offlineServicing pass
+        # the install media is mapped to W: so that the package paths don't depend on drive letter assignment
+        if len(hotfixPackages) > 0:
+            runBuf = ""
+            runBuf += "<RunSynchronous>\n"
+            runBuf += "    <RunSynchronousCommand wcm:action=\"add\">\n"
+            runBuf += "        <Order>1</Order>\n"
+            runBuf += "        <Path>cmd /c for %%i in (C D E F G H I J K L M N O P Q R S T U V) do if exist %%i:\\%s subst W: %%i:\\</Path>\n" % (HotfixSlipstream.HOTFIX_GUEST_DIR)
+            runBuf += "    </RunSynchronousCommand>\n"
+            runBuf += "</RunSynchronous>\n"
+
+            svcBuf = ""
+            svcBuf += "<servicing>\n"
+            for pkg in hotfixPackages:
+                svcBuf += "    <package action=\"install\">\n"
+                svcBuf += "        <assemblyIdentity %s/>\n" % (" ".join(['%s="%s"' % (k, pkg["identity"][k]) for k in sorted(pkg["identity"].keys())]))
+                svcBuf += "        <source location=\"W:\\%s\"/>\n" % (pkg["cab"])
+                svcBuf += "    </package>\n"
+            svcBuf += "</servicing>\n"
+        else:
+            runBuf = ""
+            svcBuf = ""
+
+        buf = buf.replace("@@run_synchronous@@", runBuf)
+        buf = buf.replace("@@servicing@@", svcBuf)
 
         # unattend.xml can not be used in <windowsPE> stage and <offlineServicing> stage
         # autounattend.xml is to be used in all stages
@@ -647,17 +703,38 @@ class AnswerFileGeneratorForWindows7:
 
 class _Util:
 
+    # time zones must be the same as the ones in VmUtil.getRtcBase(), so that guest clock is right from boot
+
     @staticmethod
     def getTimezoneCodeByLang(lang):
+        # index used by windows XP answer file
         if lang == Lang.en_US:
-            return "85"
+            return "035"
         elif lang == Lang.zh_CN:
-            return "85"
+            return "210"
         elif lang == Lang.zh_TW:
-            return "85"
+            return "220"
         else:
             assert False
 
+    @staticmethod
+    def getTimezoneNameByLang(lang):
+        d = {
+            Lang.en_US: "Eastern Standard Time",
+            Lang.zh_CN: "China Standard Time",
+            Lang.zh_TW: "Taipei Standard Time",
+        }
+        return d[lang]
+
+    @staticmethod
+    def getWin98TimezoneByLang(lang):
+        d = {
+            Lang.en_US: "Eastern",
+            Lang.zh_CN: "China",
+            Lang.zh_TW: "Taipei",
+        }
+        return d[lang]
+
     @staticmethod
     def getLanguageGroupCodeByLang(lang):
         d = {
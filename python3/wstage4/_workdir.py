@@ -22,9 +22,14 @@
 
 
 import os
+import json
 import stat
+import shutil
 import pathlib
+import tempfile
+import subprocess
 import robust_layer.simple_fops
+from ._util import Util
 from ._errors import WorkDirError
 
 
@@ -41,6 +46,9 @@ class WorkDir:
         self._path = path
         self._qemuCmdFile = os.path.join(path, "qemu.sh")
         self._imageFile = os.path.join(path, "disk.img")
+        self._journalFile = os.path.join(path, "progress.journal")
+        self._trashDir = os.path.join(path, ".trash")
+        self._reclaimProcList = []
 
     @property
     def path(self):
@@ -55,7 +63,7 @@ class WorkDir:
             os.mkdir(self._path, mode=self._MODE)
         else:
             self._verifyDir(True)
-            robust_layer.simple_fops.truncate_dir(self._path)
+            self._moveContentToTrash()
 
     def verify_existing(self, raise_exception=None):
         assert raise_exception is not None
@@ -79,13 +87,116 @@ class WorkDir:
 
     def save_record(self, record_name, value):
         fullfn = os.path.join(self._path, record_name + ".save")
-        with open(fullfn, "w") as f:
-            f.write(value)
+        self._atomicWrite(fullfn, value)
 
     def delete_record(self, record_name):
         fullfn = os.path.join(self._path, record_name + ".save")
         robust_layer.simple_fops.rm(fullfn)
 
+    def load_journal(self):
+        """Returns the progress journal, or None if there's none or it is unreadable"""
+
+        if not os.path.isfile(self._journalFile):
+            return None
+        try:
+            with open(self._journalFile, "r") as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def save_journal(self, data):
+        self._atomicWrite(self._journalFile, json.dumps(data, indent=4))
+
+    def delete_journal(self):
+        robust_layer.simple_fops.rm(self._journalFile)
+
+    def get_file_fingerprints(self):
+        """Returns {filename: [size, mtime_ns]} for all the files which are build artifacts"""
+
+        ret = dict()
+        for fn in sorted(os.listdir(self._path)):
+            fullfn = os.path.join(self._path, fn)
+            if os.path.isfile(fullfn) and fullfn not in [self._qemuCmdFile, self._journalFile] and not fn.endswith(".tmp"):
+                s = os.stat(fullfn)
+                ret[fn] = [s.st_size, s.st_mtime_ns]
+        return ret
+
+    def save_snapshot(self, dirpath):
+        """Copy all files in working directory into dirpath, big files are reflinked when the filesystem supports it"""
+
+        os.mkdir(dirpath)
+        for fn in os.listdir(self._path):
+            fullfn = os.path.join(self._path, fn)
+            if os.path.isfile(fullfn) and fullfn not in [self._qemuCmdFile, self._journalFile]:
+                Util.cloneFile(fullfn, os.path.join(dirpath, fn))
+
+    def restore_snapshot(self, dirpath):
+        self._moveContentToTrash()
+        for fn in os.listdir(dirpath):
+            Util.cloneFile(os.path.join(dirpath, fn), os.path.join(self._path, fn))
+
+    def get_trash_size(self):
+        """Returns number of bytes which will be freed when the background reclaim finishes"""
+
+        ret = 0
+        for dirpath, dirnames, filenames in os.walk(self._trashDir):
+            for fn in filenames:
+                try:
+                    s = os.lstat(os.path.join(dirpath, fn))
+                except FileNotFoundError:
+                    continue                    # being deleted
+                if s.st_nlink == 1:
+                    ret += s.st_blocks * 512
+        return ret
+
+    def is_trash_reclaimed(self):
+        self._reclaimProcList = [x for x in self._reclaimProcList if x.poll() is None]
+        return len(self._reclaimProcList) == 0
+
+    def wait_trash_reclaimed(self, timeout=None):
+        for proc in self._reclaimProcList:
+            proc.wait(timeout)
+        self._reclaimProcList = []
+
+    def _moveContentToTrash(self):
+        # renaming is instant, unlinking big sparse images on ext4 is not, so the latter is done in background
+        os.makedirs(self._trashDir, exist_ok=True)
+        leftoverList = [os.path.join(self._trashDir, x) for x in os.listdir(self._trashDir)]
+        batchDir = tempfile.mkdtemp(dir=self._trashDir)
+        for fn in os.listdir(self._path):
+            if fn != os.path.basename(self._trashDir):
+                os.rename(os.path.join(self._path, fn), os.path.join(batchDir, fn))
+
+        # left-overs are from a previous process, which may have been killed before its reclaim finished
+        if not any([x.poll() is None for x in self._reclaimProcList]):
+            leftoverList = [x for x in leftoverList if os.path.exists(x)]
+        else:
+            leftoverList = []
+        self._startReclaim(leftoverList + [batchDir])
+
+    def _startReclaim(self, dirList):
+        cmd = ["rm", "-rf", "--one-file-system"] + dirList
+        if shutil.which("ionice") is not None:
+            cmd = ["ionice", "-c", "3"] + cmd
+        if shutil.which("nice") is not None:
+            cmd = ["nice", "-n", "19"] + cmd
+        # use a new session so that the reclaim continues after we exit
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        self._reclaimProcList.append(proc)
+
+    def _atomicWrite(self, fullfn, value):
+        # the content is either the old one or the new one after a crash, never a truncated one
+        with open(fullfn + ".tmp", "w") as f:
+            f.write(value)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(fullfn + ".tmp", fullfn)
+        fd = os.open(self._path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
     def _verifyDir(self, raiseException):
         # work directory can be a directory or directory symlink
         # so here we use os.stat() instead of os.lstat()
@@ -21,8 +21,13 @@
 # THE SOFTWARE.
 
 
+import io
 import os
-import shutil
+import stat
+import time
+import hashlib
+import pathlib
+import tarfile
 from .. import ScriptInChroot
 from .._util import Util
 
@@ -37,8 +42,9 @@ class ScriptFromHostFile(ScriptInChroot):
         self._filepath = script_filepath
 
     def fill_script_dir(self, script_dir_hostpath):
-        os.copy(self._filepath, script_dir_hostpath)
-        os.chmod(os.path.join(script_dir_hostpath, os.path.basename(self._filepath)), 0o0755)
+        fullfn = os.path.join(script_dir_hostpath, os.path.basename(self._filepath))
+        Util.cloneFile(self._filepath, fullfn)
+        os.chmod(fullfn, 0o0755)
 
     def get_description(self):
         return self._desc
@@ -49,7 +55,7 @@ class ScriptFromHostFile(ScriptInChroot):
 
 class ScriptFromHostDir(ScriptInChroot):
 
-    def __init__(self, description, dirpath, script_filename):
+    def __init__(self, description, dirpath, script_filename, mirror_dirpath=None, max_workers=None):
         assert description is not None
         assert dirpath is not None
         assert "/" not in script_filename
@@ -58,10 +64,31 @@ class ScriptFromHostDir(ScriptInChroot):
         self._dirpath = dirpath
         self._filename = script_filename
 
+        # a persistent copy of dirpath, it is updated incrementally and then hardlinked into script directory
+        self._mirrorDir = mirror_dirpath
+        self._maxWorkers = max_workers
+
     def fill_script_dir(self, script_dir_hostpath):
-        Util.shellCall("cp %s/* %s" % (self._dirpath, script_dir_hostpath))
-        Util.shellCall("find \"%s\" -type f | xargs chmod 644" % (script_dir_hostpath))
-        Util.shellCall("find \"%s\" -type d | xargs chmod 755" % (script_dir_hostpath))
+        if self._mirrorDir is None:
+            Util.syncTree(self._dirpath, script_dir_hostpath, 0o755, 0o644, maxWorkers=self._maxWorkers)
+        else:
+            Util.syncTree(self._dirpath, self._mirrorDir, 0o755, 0o644, manifestFile=self._getManifestFile(), maxWorkers=self._maxWorkers)
+            Util.linkTree(self._mirrorDir, script_dir_hostpath)
+
+    def get_digest(self):
+        if self._mirrorDir is None:
+            return super().get_digest()
+
+        # file hashes are already in the manifest of the mirror, no need to populate a script directory
+        manifest = Util.syncTree(self._dirpath, self._mirrorDir, 0o755, 0o644, manifestFile=self._getManifestFile(), maxWorkers=self._maxWorkers)
+        h = hashlib.sha256()
+        h.update(("script %s\n" % (self._filename)).encode("utf-8"))
+        for relPath in sorted(manifest.keys()):
+            h.update(("file %s %s\n" % (relPath, manifest[relPath][2])).encode("utf-8"))
+        for fullfn in sorted(pathlib.Path(self._mirrorDir).rglob("*")):
+            if fullfn.is_symlink():
+                h.update(("link %s %s\n" % (fullfn.relative_to(self._mirrorDir), os.readlink(fullfn))).encode("utf-8"))
+        return h.hexdigest()
 
     def get_description(self):
         return self._desc
@@ -69,6 +96,9 @@ class ScriptFromHostDir(ScriptInChroot):
     def get_script(self):
         return self._filename
 
+    def _getManifestFile(self):
+        return self._mirrorDir.rstrip("/") + ".manifest"
+
 
 class ScriptFromBuffer(ScriptInChroot):
 
@@ -118,10 +148,11 @@ class OneLinerScript(ScriptInChroot):
 
 class PlacingFilesScript(ScriptInChroot):
 
-    def __init__(self, description):
+    def __init__(self, description, packed=True):
         assert description is not None
 
         self._desc = description
+        self._packed = packed           # put all entries into one archive, which is extracted in a single pass
         self._infoList = []
 
     def append_file(self, target_filepath, buf, owner=0, group=0, mode=0o644):
@@ -177,8 +208,97 @@ class PlacingFilesScript(ScriptInChroot):
         self._infoList.append(("s", target_linkpath, owner, group, None, hostpath))
 
     def fill_script_dir(self, script_dir_hostpath):
+        if self._packed:
+            self._fillDataArchive(os.path.join(script_dir_hostpath, "data.tar"))
+            scriptContent = self._packedScriptContent
+        else:
+            self._fillDataDir(os.path.join(script_dir_hostpath, "data"))
+            scriptContent = self._scriptContent
+
+        # create script file
+        fullfn = os.path.join(script_dir_hostpath, _SCRIPT_FILE_NAME)
+        with open(fullfn, "w") as f:
+            f.write(scriptContent.strip("\n") + "\n")  # remove all redundant carrage returns
+        os.chmod(fullfn, 0o0755)
+
+    def get_description(self):
+        return self._desc
+
+    def get_script(self):
+        return _SCRIPT_FILE_NAME
+
+    def _fillDataArchive(self, archiveFile):
+        # entries from host keep their mtime, generated entries get the current time, tar extracts mtime as is
+        now = time.time()
+
+        def __tarInfo(path, t, owner, group, mode, mtime):
+            ti = tarfile.TarInfo(path.lstrip("/"))
+            ti.type = t
+            ti.uid = owner
+            ti.gid = group
+            ti.mode = mode
+            ti.mtime = mtime
+            return ti
+
+        def __addHostTree(tar, src, dst, owner, group, dmode, fmode):
+            tar.addfile(__tarInfo(dst, tarfile.DIRTYPE, owner, group, dmode, os.stat(src).st_mtime))
+            for name in sorted(os.listdir(src)):
+                srcname = os.path.join(src, name)
+                dstname = os.path.join(dst, name)
+                if os.path.islink(srcname):
+                    ti = __tarInfo(dstname, tarfile.SYMTYPE, owner, group, 0o777, os.lstat(srcname).st_mtime)
+                    ti.linkname = os.readlink(srcname)
+                    tar.addfile(ti)
+                elif os.path.isdir(srcname):
+                    __addHostTree(tar, srcname, dstname, owner, group, dmode, fmode)
+                else:
+                    with open(srcname, "rb") as f:
+                        st = os.fstat(f.fileno())
+                        ti = __tarInfo(dstname, tarfile.REGTYPE, owner, group, fmode, st.st_mtime)
+                        ti.size = st.st_size
+                        tar.addfile(ti, f)
+
+        # file content is streamed from host files into the archive, no intermediate copy is made
+        with tarfile.open(archiveFile, "w", format=tarfile.GNU_FORMAT) as tar:
+            for info in self._infoList:
+                if info[0] == "f":
+                    t, target_filepath, owner, group, mode, buf, hostpath = info
+                    if buf is not None:
+                        assert hostpath is None
+                        if isinstance(buf, str):
+                            buf = buf.encode("utf-8")
+                        ti = __tarInfo(target_filepath, tarfile.REGTYPE, owner, group, mode, now)
+                        ti.size = len(buf)
+                        tar.addfile(ti, io.BytesIO(buf))
+                    else:
+                        assert hostpath is not None
+                        with open(hostpath, "rb") as f:
+                            st = os.fstat(f.fileno())
+                            ti = __tarInfo(target_filepath, tarfile.REGTYPE, owner, group, mode, st.st_mtime)
+                            ti.size = st.st_size
+                            tar.addfile(ti, f)
+                elif info[0] == "d":
+                    t, target_dirpath, owner, group, dmode, fmode, hostpath = info
+                    if hostpath is not None:
+                        assert fmode is not None
+                        __addHostTree(tar, hostpath, target_dirpath, owner, group, dmode, fmode)
+                    else:
+                        assert fmode is None
+                        tar.addfile(__tarInfo(target_dirpath, tarfile.DIRTYPE, owner, group, dmode, now))
+                elif info[0] == "s":
+                    t, target_linkpath, owner, group, target, hostpath = info
+                    if target is not None:
+                        ti = __tarInfo(target_linkpath, tarfile.SYMTYPE, owner, group, 0o777, now)
+                        ti.linkname = target
+                    else:
+                        ti = __tarInfo(target_linkpath, tarfile.SYMTYPE, owner, group, 0o777, os.lstat(hostpath).st_mtime)
+                        ti.linkname = os.readlink(hostpath)
+                    tar.addfile(ti)
+                else:
+                    assert False
+
+    def _fillDataDir(self, dataDir):
         # establish data directory
-        dataDir = os.path.join(script_dir_hostpath, "data")
         os.mkdir(dataDir)
         for info in self._infoList:
             if info[0] == "f":
@@ -196,7 +316,7 @@ class PlacingFilesScript(ScriptInChroot):
                         assert False
                 else:
                     assert hostpath is not None
-                    shutil.copy(hostpath, fullfn)
+                    self._placeHostFile(hostpath, fullfn, owner, group, mode)
                 os.chown(fullfn, owner, group)
                 os.chmod(fullfn, mode)
             elif info[0] == "d":
@@ -217,21 +337,20 @@ class PlacingFilesScript(ScriptInChroot):
                     os.symlink(target, fullfn)
                 else:
                     os.symlink(os.readlink(hostpath), fullfn)
-                os.chown(fullfn, owner, group)
+                os.chown(fullfn, owner, group, follow_symlinks=False)
             else:
                 assert False
 
-        # create script file
-        fullfn = os.path.join(script_dir_hostpath, _SCRIPT_FILE_NAME)
-        with open(fullfn, "w") as f:
-            f.write(self._scriptContent.strip("\n") + "\n")  # remove all redundant carrage returns
-        os.chmod(fullfn, 0o0755)
-
-    def get_description(self):
-        return self._desc
-
-    def get_script(self):
-        return _SCRIPT_FILE_NAME
+    def _placeHostFile(self, src, dst, owner, group, mode):
+        # hardlink is only usable when nothing needs to be changed, chown/chmod on it would modify the host file
+        st = os.stat(src)
+        if (st.st_uid, st.st_gid, stat.S_IMODE(st.st_mode)) == (owner, group, mode):
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        Util.cloneFile(src, dst)
 
     def _copytree(self, src, dst, owner, group, dmode, fmode):
         os.mkdir(dst)
@@ -245,7 +364,7 @@ class PlacingFilesScript(ScriptInChroot):
             elif os.path.isdir(srcname):
                 self._copytree(srcname, dstname, owner, group, dmode, fmode)
             else:
-                shutil.copy(srcname, dstname)
+                self._placeHostFile(srcname, dstname, owner, group, fmode)
                 os.chown(dstname, owner, group)
                 os.chmod(dstname, fmode)
 
@@ -260,5 +379,14 @@ find . -type d -exec mkdir -p /\{} \;
 find . -type f -exec mv -f \{} /\{} \;
 """
 
+    _packedScriptContent = r"""
+#!/bin/bash
+
+DATA_FILE=$(dirname $(realpath $0))/data.tar
+
+# merge directories and files in a single pass, owner and mode are preserved, existing directories are not changed
+tar -x -p --same-owner --numeric-owner --no-overwrite-dir -f $DATA_FILE -C /
+"""
+
 
 _SCRIPT_FILE_NAME = "main.script"
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import sys
+import asyncio
+import unittest
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python3"))
+from wstage4._driver import drive, async_drive, Call, Sleep, SpawnProcess, WaitProcess
+
+
+def _operation(log):
+    # result of a step is sent back, exception of a step is thrown in at the yield
+    log.append((yield Call(lambda x: x * 2, 21)))
+    try:
+        yield Call(int, "not-a-number")
+    except ValueError:
+        log.append("caught")
+    proc = yield SpawnProcess(["sleep", "10"], False)
+    try:
+        yield WaitProcess(proc, 0.1)
+    except subprocess.TimeoutExpired:
+        log.append("timeout")
+    finally:
+        proc.kill()
+        yield WaitProcess(proc)
+    return "done"
+
+
+def _cancellable(log):
+    try:
+        yield Sleep(10)
+    except BaseException as e:
+        log.append(type(e).__name__)
+        yield Sleep(0)                                      # cleanup may still wait after cancellation
+        log.append("cleaned")
+        raise
+
+
+class DriverTest(unittest.TestCase):
+
+    def test_drive(self):
+        log = []
+        self.assertEqual(drive(_operation(log)), "done")
+        self.assertEqual(log, [42, "caught", "timeout"])
+
+    def test_async_drive(self):
+        log = []
+        self.assertEqual(asyncio.run(async_drive(_operation(log))), "done")
+        self.assertEqual(log, [42, "caught", "timeout"])
+
+    def test_error(self):
+        def __op():
+            yield Call(int, "not-a-number")
+
+        with self.assertRaises(ValueError):
+            drive(__op())
+        with self.assertRaises(ValueError):
+            asyncio.run(async_drive(__op()))
+
+    def test_cancel(self):
+        async def __main():
+            task = asyncio.ensure_future(async_drive(_cancellable(log)))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        log = []
+        asyncio.run(__main())
+        self.assertEqual(log, ["CancelledError", "cleaned"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import sys
+import time
+import select
+import socket
+import tempfile
+import unittest
+import threading
+import http.client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python3"))
+from wstage4 import GuestAgent, GuestAgentBridge, GuestAgentError, GuestAgentFileNotFoundError
+from wstage4._guest_agent_server import GuestAgentServer, CHUNK_SIZE
+
+
+class _FakeAgent:
+    """Runs GuestAgentServer on one end of a socketpair, the other end is for GuestAgent"""
+
+    def __init__(self):
+        self.sock, self._peerSock = socket.socketpair()
+        f = self._peerSock.makefile("rwb", buffering=0)
+        self._thread = threading.Thread(target=GuestAgentServer(f, f).serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._peerSock.shutdown(socket.SHUT_RDWR)
+        self._thread.join()
+        self._peerSock.close()
+
+
+class _FakeBridgeClient:
+    """Moves lines between GuestAgentBridge and a fake agent by HTTP requests, like the guest agent script does"""
+
+    def __init__(self, sockPath):
+        self._sockPath = sockPath
+        self._agent = _FakeAgent()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop = True
+        self._thread.join()
+        self._agent.sock.close()
+        self._agent.close()
+
+    def _run(self):
+        i = 0
+        while not self._stop:
+            body = b""
+            while len(select.select([self._agent.sock], [], [], 0.05)[0]) > 0:
+                buf = self._agent.sock.recv(65536)
+                if len(buf) == 0:
+                    return
+                body += buf
+            # no long poll, the fake agent replies asynchronously, unlike the guest agent script
+            try:
+                reply = _post(self._sockPath, "/agent?id=test-%d&wait=0" % (i), body)
+            except OSError:
+                return                                      # bridge is closed
+            self._agent.sock.sendall(reply)
+            i += 1
+
+
+class GuestAgentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fakeAgent = _FakeAgent()
+        self.agent = GuestAgent(self.fakeAgent.sock)
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.agent.close()
+        self.fakeAgent.close()
+        for fn in os.listdir(self.tmpDir):
+            os.unlink(os.path.join(self.tmpDir, fn))
+        os.rmdir(self.tmpDir)
+
+    def test_ping(self):
+        self.agent.wait_ready(5)
+        self.assertGreaterEqual(self.agent.ping(), 0)
+
+    def test_exec(self):
+        out = bytearray()
+        err = bytearray()
+        ret = self.agent.exec("echo hello && echo world 1>&2 && exit 3", stdout_callback=out.extend, stderr_callback=err.extend, timeout=10)
+        self.assertEqual(ret, 3)
+        self.assertEqual(bytes(out).strip(), b"hello")
+        self.assertEqual(bytes(err).strip(), b"world")
+
+    def test_push_pull(self):
+        buf = os.urandom(CHUNK_SIZE * 2 + 123)
+        guestPath = os.path.join(self.tmpDir, "pushed")
+        self.agent.push_buffer(buf, guestPath)
+        self.agent.pull_file(guestPath, os.path.join(self.tmpDir, "pulled"))
+        with open(os.path.join(self.tmpDir, "pulled"), "rb") as f:
+            self.assertEqual(f.read(), buf)
+
+    def test_failed_request(self):
+        with self.assertRaises(GuestAgentError) as cm:
+            self.agent.pull_file(self.tmpDir, os.path.join(self.tmpDir, "pulled"))
+        self.assertNotIsInstance(cm.exception, GuestAgentFileNotFoundError)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpDir, "pulled")))
+        self.agent.ping()                                   # the agent still works after a failure
+
+    def test_pull_not_found(self):
+        with self.assertRaises(GuestAgentFileNotFoundError):
+            self.agent.pull_file(os.path.join(self.tmpDir, "not-exist"), os.path.join(self.tmpDir, "pulled"))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpDir, "pulled")))
+        self.agent.ping()
+
+    def test_timeout(self):
+        with self.assertRaises(GuestAgentError):
+            self.agent.exec("sleep 2", timeout=0.5)
+        self.agent.ping()                                   # messages of the abandoned request are discarded
+        self.assertEqual(self.agent.exec("exit 0", timeout=10), 0)
+
+
+class GuestAgentBridgeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bridge = GuestAgentBridge()
+
+    def tearDown(self):
+        self.bridge.close()
+
+    def test_guest_script(self):
+        buf = GuestAgentBridge.get_guest_script().decode("ascii")
+        self.assertIn("http://%s:%d/agent" % (GuestAgentBridge.GUEST_ADDRESS, GuestAgentBridge.GUEST_PORT), buf)
+        self.assertNotIn("@@", buf)
+
+    def test_retried_request(self):
+        sock = self.bridge.connect()
+        try:
+            sock.sendall(b"PING 1\n")
+            self.assertEqual(_post(self.bridge.path, "/agent?id=a&wait=1", b""), b"PING 1\n")
+            self.assertEqual(_post(self.bridge.path, "/agent?id=a&wait=1", b""), b"PING 1\n")
+
+            self.assertEqual(_post(self.bridge.path, "/agent?id=b&wait=0", b"PONG 1\n"), b"")
+            self.assertEqual(_post(self.bridge.path, "/agent?id=b&wait=0", b"PONG 1\n"), b"")
+            sock.settimeout(5)
+            self.assertEqual(sock.recv(65536), b"PONG 1\n")
+            sock.settimeout(0.2)
+            with self.assertRaises(socket.timeout):
+                sock.recv(65536)
+        finally:
+            sock.close()
+
+    def test_socket_access(self):
+        self.assertEqual(os.stat(os.path.dirname(self.bridge.path)).st_mode & 0o777, 0o700)
+
+    def test_long_poll(self):
+        t = time.monotonic()
+        self.assertEqual(_post(self.bridge.path, "/agent?id=a&wait=0", b""), b"")
+        self.assertLess(time.monotonic() - t, GuestAgentBridge.POLL_TIMEOUT)
+
+    def test_agent(self):
+        client = _FakeBridgeClient(self.bridge.path)
+        self.addCleanup(client.close)                       # runs after tearDown() which closes the bridge
+        agent = GuestAgent(self.bridge.connect())
+        try:
+            agent.wait_ready(10)
+            out = bytearray()
+            self.assertEqual(agent.exec("echo hello", stdout_callback=out.extend, timeout=10), 0)
+            self.assertEqual(bytes(out).strip(), b"hello")
+
+            with tempfile.TemporaryDirectory() as tmpDir:
+                buf = os.urandom(CHUNK_SIZE * 3)
+                agent.push_buffer(buf, os.path.join(tmpDir, "pushed"))
+                agent.pull_file(os.path.join(tmpDir, "pushed"), os.path.join(tmpDir, "pulled"))
+                with open(os.path.join(tmpDir, "pulled"), "rb") as f:
+                    self.assertEqual(f.read(), buf)
+        finally:
+            agent.close()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection to a UNIX socket, like the one slirp guestfwd makes for the guest"""
+
+    def __init__(self, sockPath, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self._sockPath = sockPath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._sockPath)
+
+
+def _post(sockPath, path, body):
+    conn = _UnixHTTPConnection(sockPath, timeout=GuestAgentBridge.POLL_TIMEOUT * 2)
+    try:
+        conn.request("POST", path, body=body, headers={"Content-Type": "text/plain"})
+        resp = conn.getresponse()
+        assert resp.status == 200
+        return resp.read()
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
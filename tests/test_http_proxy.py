@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import sys
+import time
+import tempfile
+import unittest
+import threading
+import http.client
+import http.server
+import urllib.request
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python3"))
+from wstage4._http_proxy import CachingHttpProxy
+
+
+class _OriginHandler(http.server.BaseHTTPRequestHandler):
+    """
+    /file/<name>        1000 bytes with Content-Length
+    /chunked            1000 bytes in chunked transfer encoding
+    /close              1000 bytes delimited by connection close
+    /truncated          Content-Length says 1000, connection closes after 500 bytes
+    /private            1000 bytes with Cache-Control: private
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        body = (self.path.encode("ascii") * 1000)[:1000]
+        if self.path.startswith("/file/") or self.path == "/private":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            if self.path == "/private":
+                self.send_header("Cache-Control", "private")
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(body), 300):
+                chunk = body[i:i + 300]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        elif self.path == "/close":
+            self.send_response(200)
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(body)
+            self.close_connection = True
+        elif self.path == "/truncated":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:500])
+            self.close_connection = True
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CachingHttpProxyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpDir.cleanup)
+
+        self.origin = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _OriginHandler)
+        self.origin.daemon_threads = True
+        self.origin.requests = []
+        t = threading.Thread(target=self.origin.serve_forever, daemon=True)
+        t.start()
+        self.addCleanup(self.origin.server_close)
+        self.addCleanup(self.origin.shutdown)
+
+        self.proxy = CachingHttpProxy(os.path.join(self.tmpDir.name, "cache"), max_size=2500, timeout=10)
+        self.proxy.start()
+        self.addCleanup(self.proxy.stop)
+
+        proxyUrl = "http://127.0.0.1:%d" % (self.proxy.port)
+        self.opener = urllib.request.build_opener(urllib.request.ProxyHandler({"http": proxyUrl}))
+        self.requestCount = 0
+
+    def test_hit_and_miss(self):
+        buf = self._get("/file/a")
+        self.assertEqual(len(buf), 1000)
+        self.assertEqual(self._get("/file/a"), buf)
+        self.assertEqual(self.origin.requests, ["/file/a"])
+
+        stats = self._getStats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hit_bytes"], 1000)
+        self.assertEqual(stats["miss_bytes"], 1000)
+        self.assertEqual(stats["cache_size"], 1000)
+
+    def test_chunked(self):
+        buf = self._get("/chunked")
+        self.assertEqual(len(buf), 1000)
+        self.assertEqual(self._get("/chunked"), buf)
+        self.assertEqual(self.origin.requests, ["/chunked"])
+
+    def test_close_delimited(self):
+        # the body is passed through, but it is not cached since truncation can't be detected
+        buf = self._get("/close")
+        self.assertEqual(len(buf), 1000)
+        self.assertEqual(self._get("/close"), buf)
+        self.assertEqual(self.origin.requests, ["/close", "/close"])
+
+        stats = self._getStats()
+        self.assertEqual(stats["hits"], 0)
+        self.assertEqual(stats["uncacheable"], 2)
+        self.assertEqual(stats["cache_size"], 0)
+
+    def test_truncated(self):
+        with self.assertRaises(http.client.IncompleteRead):
+            self._get("/truncated")
+        self._get("/file/a")
+        stats = self._getStats()
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["cache_size"], 1000)
+        self.assertEqual(self.origin.requests, ["/truncated", "/file/a"])
+
+    def test_uncacheable(self):
+        self._get("/private")
+        self._get("/private")
+        self.assertEqual(self.origin.requests, ["/private", "/private"])
+        self.assertEqual(self._getStats()["uncacheable"], 2)
+
+    def test_eviction(self):
+        # max_size holds two entries, the least recently used one is evicted
+        self._get("/file/a")
+        self._get("/file/b")
+        self._get("/file/a")
+        self._get("/file/c")
+        self.assertEqual(self._getStats()["cache_size"], 2000)
+
+        self._get("/file/a")
+        self._get("/file/c")
+        self._get("/file/b")
+        self.assertEqual(self.origin.requests, ["/file/a", "/file/b", "/file/c", "/file/b"])
+
+        stats = self._getStats()
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["misses"], 4)
+
+    def _getStats(self):
+        # the proxy counts a request after the whole response is sent, so the client may return earlier
+        deadline = time.monotonic() + 5
+        while True:
+            stats = self.proxy.get_stats()
+            if stats["hits"] + stats["misses"] + stats["uncacheable"] >= self.requestCount or time.monotonic() > deadline:
+                return stats
+            time.sleep(0.01)
+
+    def _get(self, path):
+        self.requestCount += 1
+        with self.opener.open("http://127.0.0.1:%d%s" % (self.origin.server_address[1], path), timeout=10) as resp:
+            return resp.read()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020-2021 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import sys
+import time
+import tarfile
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python3"))
+from wstage4.scripts import PlacingFilesScript
+
+
+class PlacingFilesScriptTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpDir.cleanup)
+
+    def test_archive_metadata(self):
+        # generated entries get the current time, entries from host keep their mtime
+        start = int(time.time())
+        hostFile = os.path.join(self.tmpDir.name, "host-file")
+        with open(hostFile, "w") as f:
+            f.write("host")
+        hostDir = os.path.join(self.tmpDir.name, "host-dir")
+        os.mkdir(hostDir)
+        with open(os.path.join(hostDir, "a"), "w") as f:
+            f.write("a")
+        os.symlink("a", os.path.join(hostDir, "b"))
+        os.utime(hostFile, (1500000000, 1500000000))
+        os.utime(os.path.join(hostDir, "a"), (1500000100, 1500000100))
+        os.utime(hostDir, (1500000200, 1500000200))
+
+        s = PlacingFilesScript("test")
+        s.append_file("/etc/buf", "buf", owner=1, group=2, mode=0o600)
+        s.append_host_file("/etc/file", hostFile, owner=3, group=4, mode=0o640)
+        s.append_dir("/var/empty", owner=5, group=6, mode=0o700)
+        s.append_host_dir("/opt/dir", hostDir, owner=7, group=8, dmode=0o750, fmode=0o604)
+        s.append_symlink("/etc/link", "buf")
+
+        scriptDir = os.path.join(self.tmpDir.name, "script")
+        os.mkdir(scriptDir)
+        s.fill_script_dir(scriptDir)
+
+        with tarfile.open(os.path.join(scriptDir, "data.tar")) as tar:
+            members = {ti.name: ti for ti in tar.getmembers()}
+            self.assertEqual(tar.extractfile("etc/file").read(), b"host")
+
+        def __check(name, type, uid, gid, mode, mtime=None):
+            ti = members[name]
+            self.assertEqual((ti.type, ti.uid, ti.gid, ti.mode), (type, uid, gid, mode))
+            if mtime is not None:
+                self.assertEqual(ti.mtime, mtime)
+            else:
+                self.assertGreaterEqual(ti.mtime, start)
+
+        __check("etc/buf", tarfile.REGTYPE, 1, 2, 0o600)
+        __check("etc/file", tarfile.REGTYPE, 3, 4, 0o640, 1500000000)
+        __check("var/empty", tarfile.DIRTYPE, 5, 6, 0o700)
+        __check("opt/dir", tarfile.DIRTYPE, 7, 8, 0o750, 1500000200)
+        __check("opt/dir/a", tarfile.REGTYPE, 7, 8, 0o604, 1500000100)
+        __check("opt/dir/b", tarfile.SYMTYPE, 7, 8, 0o777)
+        __check("etc/link", tarfile.SYMTYPE, 0, 0, 0o777)
+        self.assertEqual(members["opt/dir/b"].linkname, "a")
+
+
+if __name__ == "__main__":
+    unittest.main()